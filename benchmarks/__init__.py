@@ -0,0 +1,9 @@
+"""
+Benchmarks comparing the current implementation of some operations to the
+method used previously.  These are not tests and are not run by pytest.
+
+Run them as modules from the repository root in an environment with the
+wsi_deid plugin installed, for instance the tox test environment::
+
+    python -m benchmarks.<name> --help
+"""
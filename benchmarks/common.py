@@ -0,0 +1,30 @@
+import argparse
+import time
+
+
+def argumentParser(doc):
+    """
+    Create an argument parser for a benchmark.
+
+    :param doc: the module docstring of the benchmark.  The first paragraph
+        is used as the description and the remainder is shown after the list
+        of arguments.
+    :returns: an argparse.ArgumentParser.
+    """
+    summary, _, details = doc.strip().partition('\n\n')
+    return argparse.ArgumentParser(
+        description=' '.join(summary.split()), epilog=details.strip() or None,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+def timed(func, *args, **kwargs):
+    """
+    Call a function and report how long it took.
+
+    :param func: the function to call with the remaining arguments.
+    :returns: the return value of the function, the elapsed time in seconds,
+        and the processor time used in seconds.
+    """
+    starttime, startcpu = time.time(), time.process_time()
+    result = func(*args, **kwargs)
+    return result, time.time() - starttime, time.process_time() - startcpu
@@ -0,0 +1,33 @@
+"""
+Compare the cost of config.getConfig using the cached configuration snapshot
+to reading the configuration on each call, as getConfig did before.
+
+The wsi_deid settings are read from the Girder database, so run this in an
+environment with the wsi_deid plugin installed and a database available, for
+instance the tox test environment.
+"""
+
+from wsi_deid import config
+
+from .common import argumentParser, timed
+
+
+def main(opts):
+    # Make sure the settings model is ready before timing anything
+    config.readConfig()
+    _, readTime, _ = timed(lambda: [
+        config.readConfig().get(opts.key, config.defaultConfig.get(opts.key))
+        for _ in range(opts.calls)])
+    _, snapshotTime, _ = timed(lambda: [config.getConfig(opts.key) for _ in range(opts.calls)])
+    print(f'{opts.calls} calls of getConfig({opts.key!r})')
+    print(f'Read each call: {readTime / opts.calls * 1e6:9.2f} us per call')
+    print(f'Snapshot:       {snapshotTime / opts.calls * 1e6:9.2f} us per call')
+
+
+if __name__ == '__main__':
+    parser = argumentParser(__doc__)
+    parser.add_argument(
+        '--calls', type=int, default=10000, help='Number of calls to time.')
+    parser.add_argument(
+        '--key', default='folder_name_field', help='The configuration key to get.')
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""
+Compare matching manifest records to image files with the ImageFileIndex to
+the previous scan of the list of image files.
+
+Synthetic import directories are generated with the specified number of
+image files.  Half of the manifest records name their file relative to the
+manifest, a quarter only match by base name because the manifest is in a
+different directory, and a quarter have no file.  A few image files are not
+listed in any manifest.
+"""
+
+import os
+
+from wsi_deid.import_export import ImageFileIndex
+
+from .common import argumentParser, timed
+
+
+def synthetic(count):
+    importPath = '/import'
+    imageFiles = []
+    records = []
+    for idx in range(count):
+        folder = os.path.join(importPath, 'batch%03d' % (idx // 500))
+        name = 'slide%06d.svs' % idx
+        imageFiles.append(os.path.join(folder, name))
+        if idx % 4 in {0, 1}:
+            records.append({'excel': os.path.join(folder, 'manifest.xlsx'), 'name': name})
+        elif idx % 4 == 2:
+            records.append({'excel': os.path.join(importPath, 'manifest.xlsx'), 'name': name})
+        else:
+            records.append({
+                'excel': os.path.join(folder, 'manifest.xlsx'), 'name': 'missing' + name})
+    for idx in range(count // 100):
+        imageFiles.append(os.path.join(importPath, 'extra', 'unlisted%06d.svs' % idx))
+    return records, imageFiles
+
+
+def match_scan(records, imageFiles):
+    imageFiles = imageFiles[:]
+    matched = []
+    for record in records:
+        imagePath = os.path.join(os.path.dirname(record['excel']), record['name'])
+        if imagePath not in imageFiles:
+            imagePath = None
+            for testPath in imageFiles:
+                if os.path.basename(testPath) == record['name']:
+                    imagePath = testPath
+                    break
+        if imagePath is not None:
+            imageFiles.remove(imagePath)
+        matched.append(imagePath)
+    return matched, imageFiles
+
+
+def match_index(records, imageFiles):
+    imageIndex = ImageFileIndex(imageFiles)
+    matched = [
+        imageIndex.match(
+            os.path.join(os.path.dirname(record['excel']), record['name']), record['name'])
+        for record in records]
+    return matched, imageIndex.unmatched()
+
+
+def main(opts):
+    for count in opts.count:
+        records, imageFiles = synthetic(count)
+        indexResult, indexTime, _ = timed(match_index, records, imageFiles)
+        print(f'{count} files: index {indexTime:7.3f}s', end='')
+        if count <= opts.max_scan:
+            scanResult, scanTime, _ = timed(match_scan, records, imageFiles)
+            print(f', list scan {scanTime:7.3f}s, same results: {indexResult == scanResult}',
+                  end='')
+        print()
+
+
+if __name__ == '__main__':
+    parser = argumentParser(__doc__)
+    parser.add_argument(
+        '--count', type=int, action='append',
+        help='Number of image files; may be specified multiple times.  Default '
+        'is 1000, 5000, 10000, and 50000.')
+    parser.add_argument(
+        '--max-scan', type=int, default=10000,
+        help='Only time the list scan for up to this many files, since it is '
+        'quadratic.')
+    opts = parser.parse_args()
+    opts.count = opts.count or [1000, 5000, 10000, 50000]
+    main(opts)
@@ -0,0 +1,120 @@
+"""
+Compare redacting an isyntax file by copying it and overwriting the xml
+header to the previous method of writing the header and then copying the
+rest of the file in 1 MB reads and writes.
+
+A synthetic isyntax-shaped file is generated with an xml header containing
+label and macro images followed by the specified amount of random data.
+The file is generated in the output directory, since whether the copy can
+be a reflink depends on the file system.
+"""
+
+import base64
+import io
+import os
+import tempfile
+import types
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+
+from wsi_deid import process
+
+from .common import argumentParser, timed
+
+
+def jpeg64(width, height):
+    image = PIL.Image.fromarray(
+        (np.random.rand(height, width, 3) * 255).astype('uint8'))
+    jpeg = io.BytesIO()
+    image.save(jpeg, 'jpeg', quality=90)
+    return base64.b64encode(jpeg.getvalue()).decode()
+
+
+def synthetic(path, size):
+    images = ''.join(
+        '<DataObject ObjectType="DPScannedImage">\n'
+        '<Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" '
+        f'PMSVR="IString">{key}</Attribute>\n'
+        '<Attribute Name="PIM_DP_IMAGE_DATA" Group="0x301D" Element="0x1005" '
+        f'PMSVR="IString">{jpeg64(width, height)}</Attribute>\n'
+        '</DataObject>\n'
+        for key, width, height in [('MACROIMAGE', 1600, 600), ('LABELIMAGE', 600, 600)])
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<DataObject ObjectType="DPUfsImport">\n'
+        '<Attribute Name="DICOM_SOFTWARE_VERSIONS" Group="0x0018" Element="0x1020" '
+        'PMSVR="IStringArray">&quot;1.0&quot;</Attribute>\n'
+        '<Attribute Name="PIIM_DP_SCANNER_OPERATOR_ID" Group="0x101D" Element="0x1009" '
+        'PMSVR="IString">operator</Attribute>\n'
+        '<Attribute Name="PIM_DP_UFS_BARCODE" Group="0x301D" Element="0x1002" '
+        'PMSVR="IString">YmFyY29kZQ==</Attribute>\n'
+        '<Attribute Name="PIM_DP_SCANNED_IMAGES" Group="0x301D" Element="0x1003" '
+        f'PMSVR="IDataObjectArray">\n<Array>\n{images}</Array>\n</Attribute>\n'
+        '</DataObject>\n').encode()
+    chunk = 64 * 1024 ** 2
+    with open(path, 'wb') as fptr:
+        fptr.write(xml + b'\r\n\x04')
+        remaining = size
+        while remaining:
+            fptr.write(os.urandom(min(chunk, remaining)))
+            remaining -= min(chunk, remaining)
+    return len(xml)
+
+
+def copy_previous(sourcePath, outputPath, header):
+    with open(outputPath, 'wb') as dest:
+        with open(sourcePath, 'rb') as src:
+            dest.write(header)
+            src.seek(len(header))
+            chunk = 1024 ** 2
+            while True:
+                data = src.read(chunk)
+                if not len(data):
+                    break
+                dest.write(data)
+
+
+def main(opts):
+    with tempfile.TemporaryDirectory(dir=opts.dir) as path:
+        sourcePath = os.path.join(path, 'source.isyntax')
+        xmllen = synthetic(sourcePath, opts.size * 1024 ** 2)
+        tileSource = types.SimpleNamespace(
+            _xmllen=xmllen,
+            _getLargeImagePath=lambda: sourcePath,
+            getInternalMetadata=lambda: {'isyntax': {'software_versions': '"1.0"'}})
+        redactList = {'metadata': {}, 'images': {}}
+        label = PIL.Image.new('RGB', (600, 600), (255, 255, 255))
+        with mock.patch.object(process, 'ImageItem') as imageItem, mock.patch.object(
+                process, 'get_deid_field', return_value='DSA Redacted'):
+            imageItem.return_value.tileSource.return_value = tileSource
+            (outputPath, _), redactTime, redactCpu = timed(
+                process.redact_format_isyntax, {}, path, redactList, 'title', label, None)
+        with open(outputPath, 'rb') as fptr:
+            header = fptr.read(xmllen)
+        previousPath = os.path.join(path, 'previous.isyntax')
+        _, previousTime, previousCpu = timed(copy_previous, sourcePath, previousPath, header)
+        same = True
+        with open(outputPath, 'rb') as f1, open(previousPath, 'rb') as f2:
+            while same:
+                data = f1.read(64 * 1024 ** 2)
+                same = data == f2.read(64 * 1024 ** 2)
+                if not data:
+                    break
+        print(f'{opts.size} MB isyntax, {xmllen} byte header')
+        print(f'Copy and overwrite header: {redactTime:7.3f}s, {redactCpu:7.3f}s cpu '
+              '(including redacting the header)')
+        print(f'Copy in 1 MB chunks:       {previousTime:7.3f}s, {previousCpu:7.3f}s cpu')
+        print(f'Same results: {same}')
+
+
+if __name__ == '__main__':
+    parser = argumentParser(__doc__)
+    parser.add_argument(
+        '--size', type=int, default=4096,
+        help='Size of the image data after the header in MB.')
+    parser.add_argument(
+        '--dir', help='Directory for the synthetic and redacted files.  This '
+        'should be on the file system used for assetstores and temporary files.')
+    main(parser.parse_args())
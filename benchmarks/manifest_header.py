@@ -0,0 +1,85 @@
+"""
+Compare reading manifests with readExcelData to the previous method of
+parsing the manifest once for each possible header row.
+
+Synthetic csv and Excel manifests are generated with the specified number of
+data rows and with a header row preceded by a number of title and blank
+rows.
+"""
+
+import os
+import tempfile
+from unittest import mock
+
+import openpyxl
+import pandas as pd
+
+from wsi_deid import config
+from wsi_deid.import_export import readExcelData
+
+from .common import argumentParser, timed
+
+Columns = ['TokenID', 'Proc_Seq', 'Proc_Type', 'Spec_Site', 'Slide_ID', 'ImageID',
+           'ScannedFileName']
+
+
+def synthetic(path, rows, header):
+    junk = []
+    for idx in range(header):
+        junk.append([] if idx % 3 == 1 else ['Manifest title line %d' % idx])
+    data = []
+    for idx in range(rows):
+        token = '%04d%02d' % (idx // 100, idx % 100)
+        data.append([token, '01', 'Biopsy', 'Skin', '%02d' % (idx % 7), f'{token}_01_{idx % 7:02d}',
+                     'slide%06d.svs' % idx])
+    csvPath = os.path.join(path, 'manifest.csv')
+    with open(csvPath, 'w') as fptr:
+        for row in junk + [Columns] + data:
+            # The previous method can't read csv files with short rows
+            # before the header, so pad the title rows.
+            if len(row) == 1:
+                row = row + [''] * (len(Columns) - 1)
+            fptr.write(','.join(row) + '\n')
+    excelPath = os.path.join(path, 'manifest.xlsx')
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for row in junk + [Columns] + data:
+        ws.append(row)
+    wb.save(excelPath)
+    return [csvPath, excelPath]
+
+
+def read_previous(filepath):
+    reader = pd.read_excel if filepath.endswith('.xlsx') else pd.read_csv
+    potential_header = 0
+    df = reader(filepath, header=potential_header, dtype=str)
+    rows = df.shape[0]
+    while potential_header < rows:
+        if 'TokenID' in df.columns and 'ImageID' in df.columns:
+            return df, potential_header
+        potential_header += 1
+        df = reader(filepath, header=potential_header, dtype=str)
+    return None, None
+
+
+def main(opts):
+    settings = {}
+    with tempfile.TemporaryDirectory() as path, mock.patch.object(
+            config, 'getConfig', side_effect=lambda key, default=None: settings.get(key, default)):
+        for filepath in synthetic(path, opts.rows, opts.header):
+            (df, header), readTime, _ = timed(readExcelData, filepath)
+            (prevDf, prevHeader), prevTime, _ = timed(read_previous, filepath)
+            print(f'{os.path.basename(filepath)}: {opts.rows} rows, header on row {header}: '
+                  f'single parse {readTime:7.3f}s, parse per row {prevTime:7.3f}s, '
+                  f'same results: {header == prevHeader and df.equals(prevDf)}')
+
+
+if __name__ == '__main__':
+    parser = argumentParser(__doc__)
+    parser.add_argument(
+        '--rows', type=int, default=10000, help='Number of data rows in the manifest.')
+    parser.add_argument(
+        '--header', type=int, default=20,
+        help='Number of rows before the header row.  Blank rows are included, so '
+        'for csv files the header row number is smaller than this.')
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+"""
+Compare the adaptive OCR rotation search to reading all four rotations.
+
+Each label image is read in each of four orientations, first by reading all
+rotations and then by the adaptive search.  The time taken and the fraction
+of confident words found by the exhaustive search that the adaptive search
+also finds (recall) are reported.
+
+If no images are specified, the sample label and the labels of the test data
+whole slide images are used.
+"""
+
+import os
+import types
+from unittest import mock
+
+import PIL.Image
+
+from wsi_deid import config, process
+
+from .common import argumentParser, timed
+
+# Minimum confidence of a word for it to count toward recall
+Confidence = 0.9
+
+
+def label_images(paths):
+    if not paths:
+        paths = [os.path.join(
+            os.path.dirname(__file__), '..', 'tests', 'data', 'sample_label.jpg')]
+        try:
+            from tests.datastore import datastore
+
+            paths += [datastore.fetch(name) for name in datastore.registry
+                      if name.endswith('.svs')]
+        except Exception:
+            pass
+    for path in paths:
+        try:
+            image = PIL.Image.open(path)
+            image.load()
+        except Exception:
+            import large_image
+
+            ts = large_image.open(path)
+            if 'label' not in ts.getAssociatedImagesList():
+                continue
+            image = ts.getAssociatedImage('label', format=large_image.constants.TILE_FORMAT_PIL)[0]
+        for rotated in process.ocr_rotations(image.convert('RGB')):
+            yield os.path.basename(path), rotated
+
+
+def run(sources, reader, adaptive, parse):
+    settings = {'ocr_adaptive_rotation': adaptive, 'ocr_parse_values': parse}
+    with mock.patch.object(config, 'getConfig', side_effect=settings.get):
+        results, elapsed, _ = timed(process.get_text_from_associated_images, sources, reader)
+        return results, elapsed
+
+
+def confident(words):
+    return {word for word, record in words.items()
+            if len(word) > 1 and record['average_confidence'] >= Confidence}
+
+
+def main(opts):
+    parse = [{'key': 'value', 'pattern': opts.pattern}] if opts.pattern else []
+    sources = [
+        (types.SimpleNamespace(item={'name': name}), 'label', image)
+        for name, image in label_images(opts.image)]
+    reader = process.get_reader()
+    # Warm up the reader
+    run(sources[:1], reader, False, parse)
+    exhaustive, exhaustiveTime = run(sources, reader, False, parse)
+    adaptive, adaptiveTime = run(sources, reader, True, parse)
+    found = expected = 0
+    for source, full, fast in zip(sources, exhaustive, adaptive):
+        fullWords, fastWords = confident(full), confident(fast)
+        found += len(fullWords & fastWords)
+        expected += len(fullWords)
+        print(f'{source[0].item["name"]} {source[2].size}: '
+              f'{len(fullWords & fastWords)}/{len(fullWords)} words')
+    print(f'Exhaustive: {exhaustiveTime:5.3f}s for {len(sources)} images')
+    print(f'Adaptive:   {adaptiveTime:5.3f}s for {len(sources)} images')
+    print(f'Recall: {found / max(expected, 1):5.3f}')
+
+
+if __name__ == '__main__':
+    parser = argumentParser(__doc__)
+    parser.add_argument('image', nargs='*', help='Label images or whole slide images.')
+    parser.add_argument(
+        '--pattern', help='An ocr_parse_values pattern used to stop the adaptive search.')
+    main(parser.parse_args())
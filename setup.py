@@ -56,7 +56,7 @@ setup(
         'pydicom>=3.0.0',
         'python-magic',
         'pyvips',
-        'zxing-cpp',
+        'zxing-cpp>=2.2',
         'xlrd',
     ],
     license='Apache Software License 2.0',
@@ -64,7 +64,7 @@ setup(
     long_description_content_type='text/x-rst',
     include_package_data=True,
     keywords='girder-plugin, wsi_deid',
-    packages=find_packages(exclude=['test', 'test.*']),
+    packages=find_packages(exclude=['test', 'test.*', 'benchmarks', 'benchmarks.*']),
     url='https://github.com/DigitalSlideArchive',
     zip_safe=False,
     python_requires='>=3.10',
@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+
+import paramiko
+import pytest
+
+SftpUser = 'user'
+SftpPassword = 'password'
+
+
+class LocalServer(paramiko.ServerInterface):
+    """An SSH server that accepts one user and SFTP sessions."""
+
+    def check_auth_password(self, username, password):
+        if username == SftpUser and password == SftpPassword:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+
+class LocalSftpInterface(paramiko.SFTPServerInterface):
+    """An SFTP server that serves a local directory."""
+
+    def __init__(self, server, root, *args, **kwargs):
+        self.root = root
+        super().__init__(server, *args, **kwargs)
+
+    def _path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            result = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        fobj = os.fdopen(fd, mode)
+        handle = LocalSftpHandle(flags)
+        handle.filename = path
+        handle.readfile = fobj
+        handle.writefile = fobj
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(self._path(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as exc:
+            return paramiko.SFTPServer.convert_errno(exc.errno)
+        return paramiko.SFTP_OK
+
+
+def _serve(sock, hostKey, root, transports):
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            return
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(hostKey)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSftpInterface, root)
+        transport.start_server(server=LocalServer())
+        transports.append(transport)
+
+
+@pytest.fixture(scope='session')
+def sftpHostKey():
+    return paramiko.RSAKey.generate(2048)
+
+
+@pytest.fixture
+def sftpServer(sftpHostKey, tmp_path):
+    """
+    Run an SFTP server on localhost that serves a temporary directory.
+
+    :returns: the host, port, and the local path of the served directory.
+    """
+    root = tmp_path / 'sftp'
+    os.makedirs(root)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    transports = []
+    thread = threading.Thread(
+        target=_serve, args=(sock, sftpHostKey, str(root), transports), daemon=True)
+    thread.start()
+    yield '127.0.0.1', sock.getsockname()[1], root
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
+    for transport in transports:
+        transport.close()
@@ -0,0 +1,44 @@
+import girder.utility.config
+import pytest
+
+from wsi_deid import config
+from wsi_deid.constants import PluginSettings
+
+from .utilities import resetConfig  # noqa
+
+
+def test_config_values_are_copies(resetConfig, db):  # noqa
+    noRedact = config.getConfig('no_redact_control_keys')
+    expected = dict(noRedact)
+    noRedact['^internal;added$'] = ''
+    columns = config.getConfig('import_text_association_columns')
+    columns.append('Added')
+    config.getConfig()['reject_reasons'].append({'category': 'Added'})
+    assert config.getConfig('no_redact_control_keys') == expected
+    assert config.getConfig('import_text_association_columns') == []
+    assert config.getConfig('reject_reasons') == config.defaultConfig['reject_reasons']
+    assert {'category': 'Added'} not in config.defaultConfig['reject_reasons']
+    # The snapshot itself can't be modified
+    with pytest.raises(TypeError):
+        config.getConfigSnapshot()['import_text_association_columns'] = ['Added']
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_config_snapshot_invalidation(server, resetConfig):  # noqa
+    from girder.models.setting import Setting
+
+    key = PluginSettings.WSI_DEID_BASE + 'import_text_association_columns'
+    snapshot = config.getConfigSnapshot()
+    assert config.getConfigSnapshot() is snapshot
+    # Other settings don't discard the snapshot
+    Setting().set('core.brand_name', 'Brand')
+    assert config.getConfigSnapshot() is snapshot
+    Setting().set(key, ['SurgPathNum'])
+    assert config.getConfig('import_text_association_columns') == ['SurgPathNum']
+    assert config.getConfigSnapshot() is not snapshot
+    Setting().unset(key)
+    assert config.getConfig('import_text_association_columns') == []
+    # Replacing the config file section is also noticed
+    girder.utility.config.getConfig()[config.CONFIG_SECTION] = {
+        'import_text_association_columns': ['Last_Name']}
+    assert config.getConfig('import_text_association_columns') == ['Last_Name']
@@ -0,0 +1,327 @@
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from wsi_deid import import_export
+from wsi_deid.import_export import ImageFileIndex
+
+
+def test_image_file_index():
+    imageFiles = [
+        '/import/a/slide1.svs',
+        '/import/b/slide1.svs',
+        '/import/b/slide2.svs',
+        {'name': 'slide3.svs'},
+        '/import/moved/slide4.svs',
+        '/import/c/unlisted.svs',
+    ]
+    index = ImageFileIndex(imageFiles)
+    # An exact path match is used before a match by name
+    assert index.match('/import/b/slide1.svs', 'slide1.svs') == '/import/b/slide1.svs'
+    assert index.match('/import/d/slide1.svs', 'slide1.svs') == '/import/a/slide1.svs'
+    # Each file is only matched once
+    assert index.match('/import/a/slide1.svs', 'slide1.svs') is None
+    # A file that was moved is found by name
+    assert index.match('/import/slide4.svs', 'slide4.svs') == '/import/moved/slide4.svs'
+    # Items are matched by name
+    assert index.match(None, 'slide3.svs') == {'name': 'slide3.svs'}
+    assert index.match('/import/slide3.svs', 'slide3.svs') is None
+    assert index.match('/import/missing.svs', 'missing.svs') is None
+    assert index.unmatched() == ['/import/b/slide2.svs', '/import/c/unlisted.svs']
+
+
+def test_image_file_index_duplicate_names():
+    imageFiles = ['/import/a/slide.svs', '/import/b/slide.svs', '/import/c/slide.svs']
+    index = ImageFileIndex(imageFiles)
+    # A name match uses the first unmatched file, even if a later record will
+    # use that file by path
+    assert index.match('/import/d/slide.svs', 'slide.svs') == '/import/a/slide.svs'
+    assert index.match('/import/a/slide.svs', 'slide.svs') == '/import/b/slide.svs'
+    assert index.match('/import/c/slide.svs', 'slide.svs') == '/import/c/slide.svs'
+    assert index.match('/import/c/slide.svs', 'slide.svs') is None
+    assert index.unmatched() == []
+
+
+def test_image_file_index_matches_scan():
+    # The index matches the same files as scanning the list of files does
+    imageFiles = ['/import/%s/slide%d.svs' % (folder, idx % 7)
+                  for idx, folder in enumerate(['a', 'b', 'c', 'moved'] * 5)]
+    records = [('/import/%s/slide%d.svs' % (folder, idx % 5), 'slide%d.svs' % (idx % 5))
+               for idx, folder in enumerate(['a', 'c', 'd'] * 6)]
+    remaining = imageFiles[:]
+    expected = []
+    for imagePath, name in records:
+        if imagePath not in remaining:
+            imagePath = next((path for path in remaining
+                              if os.path.basename(path) == name), None)
+        if imagePath is not None:
+            remaining.remove(imagePath)
+        expected.append(imagePath)
+    index = ImageFileIndex(imageFiles)
+    assert [index.match(imagePath, name) for imagePath, name in records] == expected
+    assert index.unmatched() == remaining
+
+
+def copySource(tmp_path, size=10000):
+    sourcePath = str(tmp_path / 'source.svs')
+    with open(sourcePath, 'wb') as fptr:
+        fptr.write(os.urandom(size))
+    os.utime(sourcePath, ns=(1000000000000000000, 1200000000000000000))
+    return sourcePath
+
+
+def fakeReflink(fdst, request, fsrc):
+    os.lseek(fsrc, 0, os.SEEK_SET)
+    os.write(fdst, os.read(fsrc, os.fstat(fsrc).st_size))
+
+
+def failOSError(*args, **kwargs):
+    msg = 'Not supported'
+    raise OSError(msg)
+
+
+@pytest.mark.parametrize('method', ['reflink', 'copy_file_range', 'sendfile', 'read', 'partial'])
+def test_copy_file(tmp_path, method):
+    import fcntl
+
+    sourcePath = copySource(tmp_path)
+    destPath = str(tmp_path / 'dest.svs')
+    copyFileRange = os.copy_file_range
+    calls = []
+
+    def partialCopyFileRange(*args):
+        if calls:
+            failOSError()
+        calls.append(args)
+        return copyFileRange(*args)
+
+    patches = {
+        'reflink': {'ioctl': fakeReflink},
+        'copy_file_range': {},
+        'sendfile': {'copy_file_range': failOSError},
+        'read': {'copy_file_range': failOSError, 'sendfile': failOSError},
+        'partial': {'copy_file_range': partialCopyFileRange, 'sendfile': failOSError},
+    }[method]
+    progress = mock.Mock()
+    with mock.patch.object(fcntl, 'ioctl', side_effect=patches.get(
+            'ioctl', failOSError)) as ioctl, mock.patch.object(
+            os, 'copy_file_range', side_effect=patches.get(
+                'copy_file_range', copyFileRange)) as copyFileRangeMock, mock.patch.object(
+            os, 'sendfile', side_effect=patches.get('sendfile', os.sendfile)) as sendfile, \
+            mock.patch.object(import_export, 'CopyChunkSize', 4096):
+        import_export.copyFile(sourcePath, destPath, progress)
+    ioctl.assert_called_once()
+    assert copyFileRangeMock.called == (method != 'reflink')
+    assert sendfile.called == (method in {'sendfile', 'read', 'partial'})
+    with open(sourcePath, 'rb') as fsrc, open(destPath, 'rb') as fdst:
+        assert fsrc.read() == fdst.read()
+    assert os.stat(destPath).st_mtime_ns == os.stat(sourcePath).st_mtime_ns
+    assert sum(call[0][0] for call in progress.call_args_list) == 10000
+    if method not in {'reflink', 'partial'}:
+        assert progress.call_count == 3
+    if method == 'partial':
+        assert progress.call_args_list[0][0][0] == 4096
+
+
+def test_copy_file_failure(tmp_path):
+    sourcePath = copySource(tmp_path)
+    destPath = str(tmp_path / 'dest.svs')
+    progress = mock.Mock(side_effect=[None, Exception('Cancelled')])
+    with mock.patch.object(import_export, 'CopyChunkSize', 4096), pytest.raises(
+            Exception, match='Cancelled'):
+        import_export.copyFile(sourcePath, destPath, progress)
+    assert not os.path.exists(destPath)
+
+
+def test_export_copy_files(tmp_path):
+    toCopy = []
+    for idx in range(6):
+        sourcePath = copySource(tmp_path, 1000 * (idx + 1))
+        os.rename(sourcePath, str(tmp_path / ('source%d.svs' % idx)))
+        toCopy.append({
+            'filepath': os.path.join('folder', 'image%d.svs' % idx),
+            # The girder file size is not necessarily the exported file's size
+            'file': {'size': 1},
+            'item': {'_id': idx},
+            'sourcePath': str(tmp_path / ('source%d.svs' % idx)),
+            'destPath': str(tmp_path / 'export' / 'folder' / ('image%d.svs' % idx)),
+            'report': {},
+        })
+    ctx = mock.Mock()
+    exportRecords = []
+
+    def appendExportRecord(item, *args, **kwargs):
+        exportRecords.append(item['_id'])
+        return {'time': 'time%d' % item['_id']}
+
+    with mock.patch.object(import_export, 'appendExportRecord', side_effect=appendExportRecord):
+        import_export.exportCopyFiles(ctx, toCopy, None, exportRecords)
+    assert exportRecords == list(range(6))
+    for idx, entry in enumerate(toCopy):
+        assert entry['report'] == {'status': 'finished', 'time': 'time%d' % idx}
+        assert os.path.getsize(entry['destPath']) == 1000 * (idx + 1)
+    total = sum(1000 * (idx + 1) for idx in range(6))
+    assert all(call[1]['total'] == total for call in ctx.update.call_args_list)
+    assert all(call[1]['current'] <= total for call in ctx.update.call_args_list)
+    assert ctx.update.call_args[1]['current'] == total
+
+
+def exportTree(admin, tmp_path):
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+    from girder.models.setting import Setting
+    from girder.models.upload import Upload
+
+    from wsi_deid.constants import PluginSettings
+
+    folder = Folder().createFolder(admin, 'Finished', parentType='user', creator=admin)
+    exportPath = tmp_path / 'export'
+    Setting().set(PluginSettings.WSI_DEID_EXPORT_PATH, str(exportPath))
+    Setting().set(PluginSettings.HUI_FINISHED_FOLDER, str(folder['_id']))
+    items = {}
+    sources = {}
+    # Items that haven't been exported, that have been exported and are
+    # unchanged in the export path, that have changed in the export path, and
+    # that have been removed from the export path
+    for name in ['new', 'exported', 'changed', 'removed']:
+        subfolder = Folder().createFolder(folder, name, creator=admin)
+        item = Item().createItem(name + '.svs', creator=admin, folder=subfolder)
+        data = name.encode() * 100
+        Upload().uploadFromFile(
+            io.BytesIO(data), len(data), name + '.svs', parentType='item', parent=item,
+            user=admin)
+        sources[item['_id']] = str(tmp_path / (name + '.svs'))
+        with open(sources[item['_id']], 'wb') as fptr:
+            fptr.write(data)
+        if name != 'new':
+            item = Item().setMetadata(item, {
+                import_export.EXPORT_HISTORY_KEY: [{'time': 'earlier'}],
+                import_export.SFTP_HISTORY_KEY: [{'time': 'earlier'}]})
+        if name in {'exported', 'changed'}:
+            os.makedirs(exportPath / name)
+            with open(exportPath / name / (name + '.svs'), 'wb') as fptr:
+                fptr.write(data if name == 'exported' else b'different')
+        items[name] = item
+    return folder, items, sources
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_export_item_list(server, admin, fsAssetstore, tmp_path):
+    folder, items, _ = exportTree(admin, tmp_path)
+    for all, previous, names in [
+            (True, False, ['new', 'exported', 'changed', 'removed']),
+            (False, False, ['new']),
+            (False, True, ['exported', 'changed', 'removed'])]:
+        for key in (import_export.EXPORT_HISTORY_KEY, import_export.SFTP_HISTORY_KEY):
+            found = import_export.exportItemList(folder, admin, all, key, previous=previous)
+            assert sorted(item['name'] for item in found) == sorted(
+                name + '.svs' for name in names)
+            assert sorted(filepath for filepath, _, _ in import_export.exportFileList(
+                folder, admin, all, key, previous=previous)) == sorted(
+                'Finished/%s/%s.svs' % (name, name) for name in names)
+
+
+@pytest.mark.plugin('wsi_deid')
+@pytest.mark.parametrize(('all', 'statuses'), [
+    (True, {'new': 'finished', 'exported': 'present', 'changed': 'different',
+            'removed': 'finished'}),
+    # Previously exported items are reported if they are in the export path,
+    # but are not exported again
+    (False, {'new': 'finished', 'exported': 'present', 'changed': 'different'}),
+])
+def test_export_items_report(server, admin, fsAssetstore, tmp_path, all, statuses):
+    from girder.utility.progress import noProgress
+
+    _, items, sources = exportTree(admin, tmp_path)
+    with mock.patch.object(
+            import_export, 'getExportSourcePath',
+            side_effect=lambda item, file: sources[item['_id']]), mock.patch.object(
+            import_export, 'exportNoteRejected'), mock.patch.object(
+            import_export, 'exportReport') as exportReport:
+        import_export.exportItems(noProgress, admin, all)
+    report = exportReport.call_args[0][2]
+    assert {entry['item']['name'].split('.')[0]: entry['status']
+            for entry in report} == statuses
+    assert len(report) == len(statuses)
+    for name in ('new', 'removed'):
+        assert os.path.exists(tmp_path / 'export' / name / (name + '.svs')) == (
+            name in statuses)
+
+
+@pytest.mark.plugin('wsi_deid')
+@pytest.mark.parametrize(('all', 'previous', 'sent'), [
+    (True, 0, ['new', 'exported', 'changed', 'removed']),
+    (False, 3, ['new']),
+])
+def test_sftp_transfer_files_previous(server, admin, fsAssetstore, tmp_path, all, previous, sent):
+    folder, items, sources = exportTree(admin, tmp_path)
+    checked = []
+
+    def checkItem(filepath, file, item, *args):
+        checked.append(item['name'].split('.')[0])
+        return import_export.ExportResult.ALREADY_EXISTS_AT_DESTINATION, None
+
+    with mock.patch.object(import_export, 'sftp_check_item', side_effect=checkItem):
+        count = import_export.sftp_transfer_files(
+            None, folder, admin, all, '/remote', mock.Mock(), None, None, [], [])
+    assert count == previous
+    assert sorted(checked) == sorted(sent)
+
+
+def test_is_image_item():
+    import_export._probeImageFile.cache_clear()
+    files = {'file1': {'_id': 'file1', 'itemId': 'item1', 'size': 100, 'mtime': 1}}
+    tileSource = mock.Mock(side_effect=[Exception('Not an image'), 'source', Exception('Busy')])
+    with mock.patch.object(import_export, 'File') as File, mock.patch.object(
+            import_export, 'Item'), mock.patch.object(import_export, 'ImageItem') as ImageItem:
+        File.return_value.load.side_effect = lambda fileId, force: files[fileId]
+        ImageItem.return_value.tileSource = tileSource
+        assert import_export.isImageItem({}) is False
+        assert import_export.isImageItem({'largeImage': {
+            'fileId': 'file1', 'expected': True}}) is False
+        assert import_export.isImageItem({'largeImage': {
+            'fileId': 'file1', 'sourceName': 'tiff'}}) is True
+        assert tileSource.call_count == 0
+        item = {'largeImage': {'fileId': 'file1'}}
+        # Failures are not cached
+        assert import_export.isImageItem(item) is False
+        assert import_export.isImageItem(item) is True
+        assert tileSource.call_count == 2
+        # Successes are cached until the file changes
+        assert import_export.isImageItem(item) is True
+        assert tileSource.call_count == 2
+        files['file1']['size'] = 200
+        assert import_export.isImageItem(item) is False
+        assert tileSource.call_count == 3
+        # Files that can't be loaded aren't images
+        assert import_export.isImageItem({'largeImage': {'fileId': 'file2'}}) is False
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_save_export_records(server, admin):
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+
+    folder = Folder().createFolder(admin, 'Finished', parentType='user', creator=admin)
+    items = [Item().createItem('item%d' % idx, creator=admin, folder=folder) for idx in range(3)]
+    exportRecords = []
+    import_export.saveExportRecords(exportRecords)
+    records = [import_export.appendExportRecord(
+        item, admin, import_export.EXPORT_HISTORY_KEY, status='approved' if idx else None,
+        exportRecords=exportRecords) for idx, item in enumerate(items[:2])]
+    assert len(exportRecords) == 2
+    # Nothing is stored until the records are saved
+    assert not Item().load(items[0]['_id'], force=True).get('meta')
+    import_export.saveExportRecords(exportRecords)
+    assert exportRecords == []
+    for idx, item in enumerate(items):
+        stored = Item().load(item['_id'], force=True)
+        if idx < 2:
+            assert stored['meta'][import_export.EXPORT_HISTORY_KEY] == [records[idx]]
+            assert abs((stored['updated'] - item['updated']).total_seconds()) < 0.01
+        else:
+            assert import_export.EXPORT_HISTORY_KEY not in stored.get('meta', {})
+    assert records[1]['status'] == 'approved'
+    assert 'status' not in records[0]
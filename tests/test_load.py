@@ -5,3 +5,10 @@ from girder.plugin import loadedPlugins
 @pytest.mark.plugin('wsi_deid')
 def test_import(server):
     assert 'wsi_deid' in loadedPlugins()
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_load_does_not_start_ocr_pool(server):
+    from wsi_deid import ocr
+
+    assert ocr.OCRPool is None
@@ -0,0 +1,279 @@
+import concurrent.futures
+import datetime
+import os
+import types
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from wsi_deid import ocr, process
+
+from .utilities import resetConfig  # noqa
+
+
+def sampleLabel():
+    return PIL.Image.open(
+        os.path.join(os.path.dirname(__file__), 'data', 'sample_label.jpg')).convert('RGB')
+
+
+def labelArrays():
+    image = sampleLabel()
+    small = image.resize((image.width // 2, image.height // 2))
+    return [np.asarray(rotated) for rotated in
+            process.ocr_rotations(image) + process.ocr_rotations(small)]
+
+
+def test_run_ocr_batches_shapes():
+    arrays = labelArrays()
+    reader = mock.Mock()
+    reader.readtext_batched.side_effect = lambda batch, **kwargs: [
+        [(None, 'image%d' % next(
+            idx for idx, array in enumerate(arrays) if array is entry), 1)]
+        for entry in batch]
+    results = process._run_ocr_batches(list(enumerate(arrays)), {}, reader, 3)
+    assert [key for key, _ in results] == list(range(len(arrays)))
+    assert [result[0][1] for _, result in results] == [
+        'image%d' % idx for idx in range(len(arrays))]
+    # Each batch is of unpadded images of the same shape
+    for call in reader.readtext_batched.call_args_list:
+        batch = call[0][0]
+        assert len(batch) <= 3
+        assert len({entry.shape for entry in batch}) == 1
+        assert all(any(entry is array for array in arrays) for entry in batch)
+    assert reader.readtext_batched.call_count == 4
+
+
+def test_run_ocr_batches_match_single(resetConfig, db):  # noqa
+    reader = process.get_reader()
+    params = process.get_ocr_settings('label')['readtext']
+    images = list(enumerate(labelArrays()))
+    single = process._run_ocr_batches(images, params, reader, None)
+    batched = process._run_ocr_batches(images, params, reader, 16)
+    assert [key for key, _ in batched] == [key for key, _ in single]
+    assert any(len(result) for _, result in single)
+    for (_, one), (_, many) in zip(single, batched):
+        assert [entry[1] for entry in one] == [entry[1] for entry in many]
+        assert [entry[2] for entry in one] == pytest.approx(
+            [entry[2] for entry in many], abs=1e-3)
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_ocr_cache(server, resetConfig):  # noqa
+    from wsi_deid.models import OCRCache
+
+    indices = OCRCache().collection.index_information()
+    assert any(index['key'] == [('expires', 1)] and index.get('expireAfterSeconds') == 0
+               for index in indices.values())
+    image = sampleLabel()
+    tileSource = mock.Mock()
+    tileSource.item = {'name': 'sample'}
+    results = process.aggregate_ocr_results([
+        [(None, 'Zeta', 0.5), (None, 'alpha', 0.9123456789), (None, 'Beta', 0.25)],
+        [(None, 'Beta', 0.75), (None, 'alpha', 0.8)]])
+    with mock.patch.object(process, 'get_associated_image', return_value=image):
+        _, cacheKey, cached = process.get_cached_text(tileSource, 'label')
+        assert cached is None
+        OCRCache().setResult(cacheKey, 'ocr', [[k, v] for k, v in results.items()])
+        doc = OCRCache().collection.find_one({'key': cacheKey})
+        assert doc['kind'] == 'ocr'
+        # Make the record appear old; reading it extends its expiration
+        OCRCache().collection.update_one({'key': cacheKey}, {'$set': {
+            'expires': doc['expires'] - datetime.timedelta(days=30)}})
+        _, _, cached = process.get_cached_text(tileSource, 'label')
+    assert list(cached.items()) == list(results.items())
+    assert cached['alpha']['average_confidence'] == results['alpha']['average_confidence']
+    assert OCRCache().collection.find_one({'key': cacheKey})['expires'] >= doc['expires']
+
+    # A cache time of 0 disables the cache
+    with mock.patch.object(process.config, 'getConfig', side_effect=lambda key, default=None: (
+            0 if key == 'ocr_cache_days' else default)):
+        assert OCRCache().getResult(cacheKey) is None
+        OCRCache().setResult('other', 'ocr', [])
+    assert OCRCache().collection.find_one({'key': 'other'}) is None
+
+
+def test_ocr_cache_key(resetConfig, db):  # noqa
+    image = sampleLabel()
+    settings = process.get_ocr_settings('label')
+    key = process.ocr_cache_key(image, 'ocr', settings)
+    assert process.ocr_cache_key(image.copy(), 'ocr', settings) == key
+    assert process.ocr_cache_key(image, 'barcode', settings) != key
+    changed = image.copy()
+    changed.putpixel((0, 0), tuple(255 - v for v in image.getpixel((0, 0))))
+    assert process.ocr_cache_key(changed, 'ocr', settings) != key
+    assert process.ocr_cache_key(image.convert('L'), 'ocr', settings) != key
+    assert process.ocr_cache_key(image, 'ocr', process.get_ocr_settings('macro')) != key
+    with mock.patch.object(process.config, 'getConfig', side_effect=lambda key, default=None: (
+            False if key == 'ocr_adaptive_rotation' else default)):
+        assert process.ocr_cache_key(image, 'ocr', process.get_ocr_settings('label')) != key
+
+
+@pytest.mark.parametrize(('settings', 'cpus', 'cuda', 'available', 'workers'), [
+    ({}, 8, False, 64, 8),
+    ({}, None, False, 64, 1),
+    ({}, 8, True, 64, 1),
+    ({'ocr_concurrency': 3}, 8, False, 64, 3),
+    ({'ocr_concurrency': 3}, 8, True, 64, 3),
+    ({'ocr_memory_per_worker': 16}, 8, False, 64, 4),
+    ({'ocr_memory_per_worker': 16}, 8, False, 8, 1),
+    ({'ocr_concurrency': 2, 'ocr_memory_per_worker': 4}, 8, False, 64, 2),
+])
+def test_ocr_worker_count(settings, cpus, cuda, available, workers):
+    with mock.patch.object(
+            ocr.config, 'getConfig', side_effect=lambda key, default=None: settings.get(
+                key, default)), mock.patch.object(
+            ocr.os, 'cpu_count', return_value=cpus), mock.patch.object(
+            ocr, 'cuda_available', return_value=cuda), mock.patch.object(
+            ocr.psutil, 'virtual_memory',
+            return_value=types.SimpleNamespace(available=available * 1024 ** 3)):
+        assert ocr.ocr_worker_count() == workers
+
+
+@pytest.mark.parametrize('failure', ['submit', 'broken', 'cancelled'])
+def test_ocr_readtext_fallback(failure):
+    pool = mock.Mock()
+    future = concurrent.futures.Future()
+    if failure == 'submit':
+        pool.submit.side_effect = RuntimeError('cannot schedule new futures after shutdown')
+    else:
+        pool.submit.return_value = future
+        if failure == 'broken':
+            future.set_exception(concurrent.futures.process.BrokenProcessPool())
+        else:
+            future.cancel()
+    with mock.patch.object(ocr, 'get_pool', return_value=pool), mock.patch.object(
+            ocr, 'reset_pool') as resetPool, mock.patch.object(
+            ocr, '_worker_readtext', return_value=['result']) as workerReadtext:
+        result = ocr.readtext(['array'], {'param': 1}, 2)
+        assert result() == ['result']
+    resetPool.assert_called_once()
+    workerReadtext.assert_called_once_with(['array'], {'param': 1}, 2)
+
+
+def test_ocr_pool_setting_changed():
+    pool = mock.Mock()
+    with mock.patch.object(ocr, 'OCRPool', pool):
+        ocr.settingChangedEvent(types.SimpleNamespace(info={'key': 'other'}))
+        assert ocr.OCRPool is pool
+        ocr.settingChangedEvent(types.SimpleNamespace(
+            info={'key': ocr.PluginSettings.WSI_DEID_BASE + 'ocr_concurrency'}))
+        assert ocr.OCRPool is None
+    pool.shutdown.assert_called_once()
+
+
+def labelRotation(turns):
+    return process.ocr_rotations(sampleLabel())[turns]
+
+
+@pytest.mark.parametrize('turns', [0, 1, 2])
+def test_ocr_rotation_order(turns):
+    # Rotating the rotated label by this much makes it upright
+    upright = (4 - turns) % 4
+    image = labelRotation(turns)
+    order = process.ocr_rotation_order(image)
+    assert sorted(order) == [0, 1, 2, 3]
+    # The sample label has a barcode that determines the orientation
+    assert order[0] == upright
+    # Without a barcode, the direction of the lines of text picks the axis
+    with mock.patch('zxingcpp.read_barcodes', return_value=[]) as readBarcodes:
+        order = process.ocr_rotation_order(image)
+    readBarcodes.assert_called_once()
+    assert upright in order[:2]
+    # Known barcode results are used rather than reading the image again
+    with mock.patch('zxingcpp.read_barcodes') as readBarcodes:
+        assert process.ocr_rotation_order(image, None)[:2] == order[:2]
+        assert process.ocr_rotation_order(image, -turns * 90)[0] == upright
+        assert process.ocr_rotation_order(image, 270)[0] == 3
+    readBarcodes.assert_not_called()
+
+
+class RotationReader:
+    """
+    A fake OCR reader that finds confident text only on the upright sample
+    label and a low confidence word on other images.
+    """
+
+    def __init__(self, maxSize=1024):
+        image = sampleLabel()
+        image.thumbnail((maxSize, maxSize))
+        self.upright = np.asarray(image)
+        self.reads = 0
+
+    def readtext(self, array, **kwargs):
+        self.reads += 1
+        if array.shape == self.upright.shape and np.array_equal(array, self.upright):
+            return [(None, 'FNLCR', 0.99), (None, '220600', 0.95), (None, 'C17-3456', 0.93)]
+        return [(None, 'VNT', 0.2)]
+
+    def readtext_batched(self, arrays, **kwargs):
+        return [self.readtext(array, **kwargs) for array in arrays]
+
+
+@pytest.mark.parametrize('turns', [1, 2])
+@pytest.mark.parametrize(('settings', 'reads'), [
+    ({'ocr_adaptive_rotation': False}, 4),
+    ({}, 1),
+    ({'ocr_parse_values': [{'key': 'case', 'pattern': 'C##-####'}]}, 1),
+    ({'ocr_parse_values': [{'key': 'case', 'pattern': 'S##-####'}]}, 4),
+])
+def test_ocr_rotation_early_exit(turns, settings, reads):
+    reader = RotationReader()
+    tileSource = mock.Mock()
+    tileSource.item = {'name': 'sample'}
+    with mock.patch.object(process.config, 'getConfig', side_effect=lambda key, default=None: (
+            settings.get(key, default))):
+        words = process.get_text_from_associated_image(
+            tileSource, 'label', reader, labelRotation(turns))
+    assert reader.reads == reads
+    assert list(words)[:3] == ['FNLCR', '220600', 'C17-3456']
+    assert all(words[word]['count'] == 1 for word in list(words)[:3])
+    # When all rotations are read, the words found on the other rotations are
+    # also in the results
+    assert ('VNT' in words) == (reads == 4)
+    if reads == 4:
+        assert words['VNT']['count'] == 3
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_cached_barcode_orientation(server, resetConfig):  # noqa
+    from wsi_deid.models import OCRCache
+
+    image = labelRotation(1)
+    cacheKey = process.ocr_cache_key(image, 'barcode', process.BarcodeReaderVersion)
+    assert process.get_cached_barcode_orientation(image) is False
+    OCRCache().setResult(cacheKey, 'barcode', [])
+    assert process.get_cached_barcode_orientation(image) is None
+    OCRCache().setResult(cacheKey, 'barcode', {'text': ['C17-3456'], 'orientation': -92})
+    assert process.get_cached_barcode_orientation(image) == -92
+    with mock.patch('zxingcpp.read_barcodes') as readBarcodes:
+        assert process.ocr_rotation_order(
+            image, process.get_cached_barcode_orientation(image))[0] == 3
+    readBarcodes.assert_not_called()
+
+
+def test_read_barcodes():
+    import zxingcpp
+
+    barcodes = process.read_barcodes(sampleLabel())
+    assert [barcode.text.split(';')[0] for barcode in barcodes] == ['FNLCR']
+    # A small barcode on a large image with a label too small for its barcode
+    # to be read is only found by reading crops of the image
+    code = PIL.Image.fromarray(np.asarray(zxingcpp.write_barcode(
+        zxingcpp.BarcodeFormat.DataMatrix, 'S99-0001', width=0, height=0))).resize(
+        (16, 16), PIL.Image.NEAREST)
+    label = sampleLabel()
+    label = label.resize((label.width // 4, label.height // 4), PIL.Image.LANCZOS)
+    canvas = PIL.Image.new('RGB', (2000, 2000), (255, 255, 255))
+    canvas.paste(label, (0, 0))
+    canvas.paste(code, (1500, 1500))
+    assert not zxingcpp.read_barcodes(canvas.convert('L'))
+    with mock.patch('zxingcpp.read_barcodes', wraps=zxingcpp.read_barcodes) as readBarcodes:
+        barcodes = process.read_barcodes(canvas)
+    assert [barcode.text for barcode in barcodes] == ['S99-0001']
+    # The crop scan stops at the first scale that finds a barcode
+    assert readBarcodes.call_count == 1 + 9
+    with mock.patch('zxingcpp.read_barcodes', wraps=zxingcpp.read_barcodes) as readBarcodes:
+        assert process.read_barcodes(PIL.Image.new('RGB', (800, 600), (255, 255, 255))) == []
+    assert readBarcodes.call_count == 1 + 9 + 25 + 49
@@ -0,0 +1,411 @@
+import copy
+import io
+import os
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+import pydicom
+import pytest
+import pyvips
+import tifftools
+from lxml import etree as lxmlElementTree
+
+from wsi_deid import process
+
+from .utilities import resetConfig  # noqa
+
+
+def tiffImage(path, width, height, description, seed):
+    data = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    PIL.Image.fromarray(data).save(path, compression='raw')
+    ifd = tifftools.read_tiff(str(path))['ifds'][0]
+    ifd['tags'][tifftools.Tag.ImageDescription.value] = {
+        'datatype': tifftools.Datatype.ASCII, 'data': description}
+    return ifd, data
+
+
+def stripData(path, ifd):
+    offsets = ifd['tags'][tifftools.Tag.StripOffsets.value]['data']
+    counts = ifd['tags'][tifftools.Tag.StripByteCounts.value]['data']
+    with open(path, 'rb') as fptr:
+        data = b''
+        for offset, count in zip(offsets, counts):
+            fptr.seek(offset)
+            data += fptr.read(count)
+    return data
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+@pytest.mark.parametrize('bigEndian', [False, True])
+@pytest.mark.parametrize(('redactList', 'inPlace'), [
+    ({'area': {}}, True),
+    ({'area': {'_wsi': {'geojson': {'type': 'FeatureCollection', 'features': []}}}}, False),
+])
+def test_write_redacted_tiff(tmp_path, bigtiff, bigEndian, redactList, inPlace, resetConfig, db):  # noqa
+    main, mainData = tiffImage(tmp_path / 'main.tiff', 256, 192, 'Aperio |SecretMain', 1)
+    thumb, thumbData = tiffImage(tmp_path / 'thumb.tiff', 64, 48, 'SecretThumb', 2)
+    label, labelData = tiffImage(tmp_path / 'label.tiff', 80, 60, 'SecretLabel', 3)
+    sourcePath = str(tmp_path / 'source.tiff')
+    tifftools.write_tiff([main, thumb, label], sourcePath, bigtiff=bigtiff, bigEndian=bigEndian)
+    oldLabelStrip = stripData(sourcePath, tifftools.read_tiff(sourcePath)['ifds'][2])
+
+    tiffinfo = tifftools.read_tiff(sourcePath)
+    ifds = tiffinfo['ifds']
+    ifds[0]['tags'][tifftools.Tag.ImageDescription.value]['data'] = 'Aperio |Redacted'
+    ifds[1]['tags'][tifftools.Tag.ImageDescription.value]['data'] = 'Thumb'
+    newLabel, newLabelData = tiffImage(tmp_path / 'newlabel.tiff', 80, 60, 'label', 4)
+    ifds[2] = newLabel
+    outputPath = str(tmp_path / 'output.tiff')
+    process.write_redacted_tiff(tiffinfo, ifds, outputPath, redactList)
+
+    with open(outputPath, 'rb') as fptr:
+        output = fptr.read()
+    for secret in (b'SecretMain', b'SecretThumb', b'SecretLabel'):
+        assert secret not in output
+    assert oldLabelStrip not in output
+    outinfo = tifftools.read_tiff(outputPath)
+    assert len(outinfo['ifds']) == 3
+    assert [ifd['tags'][tifftools.Tag.ImageDescription.value]['data']
+            for ifd in outinfo['ifds']] == ['Aperio |Redacted', 'Thumb', 'label']
+    # The images are uncompressed, so the strip data is the pixel data
+    for ifd, expected in zip(outinfo['ifds'], [mainData, thumbData, newLabelData]):
+        assert stripData(outputPath, ifd) == expected.tobytes()
+    # When written in place, the image data of the source is not moved
+    sourceOffsets = tiffinfo['ifds'][0]['tags'][tifftools.Tag.StripOffsets.value]['data']
+    outputOffsets = outinfo['ifds'][0]['tags'][tifftools.Tag.StripOffsets.value]['data']
+    assert (sourceOffsets == outputOffsets) == inPlace
+    if inPlace:
+        assert outinfo['bigtiff'] == bigtiff
+        assert outinfo['bigEndian'] == bigEndian
+
+
+def tiledImage(path, compression='jpeg', tile=True):
+    data = np.random.default_rng(5).integers(64, 255, (768, 1024, 3), dtype=np.uint8)
+    image = pyvips.Image.new_from_memory(data.tobytes(), 1024, 768, 3, 'uchar')
+    image.tiffsave(str(path), tile=tile, tile_width=256, tile_height=256,
+                   pyramid=tile, compression=compression, Q=90)
+    return tifftools.read_tiff(str(path))
+
+
+def tileData(path, ifd):
+    offsets = ifd['tags'][tifftools.Tag.TileOffsets.value]['data']
+    counts = ifd['tags'][tifftools.Tag.TileByteCounts.value]['data']
+    with open(path, 'rb') as fptr:
+        data = []
+        for offset, count in zip(offsets, counts):
+            fptr.seek(offset)
+            data.append(fptr.read(count))
+    return data
+
+
+# A rectangle in full resolution coordinates
+WsiRedactBox = (300, 200, 600, 500)
+
+
+def test_redact_wsi_tiles(tmp_path):
+    sourcePath = str(tmp_path / 'source.tiff')
+    tiffinfo = tiledImage(sourcePath)
+    sourceIfds = copy.deepcopy(tiffinfo['ifds'])
+    assert len(sourceIfds) == 3
+    left, top, right, bottom = WsiRedactBox
+    geojson = {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [[
+            [left, top], [right, top], [right, bottom], [left, bottom], [left, top]]]}}]}
+    tileSource = mock.Mock()
+    tileSource._getLargeImagePath.return_value = sourcePath
+    ifds = process.redact_format_aperio_philips_redact_wsi(
+        tileSource, tiffinfo['ifds'], geojson, str(tmp_path))
+    assert os.path.exists(tmp_path / '_wsi_tiles.bin')
+    outputPath = str(tmp_path / 'output.tiff')
+    process.write_redacted_tiff(tiffinfo, ifds, outputPath, {'area': {'_wsi': {
+        'geojson': geojson}}})
+    # The work file is closed and removed once the output is written
+    assert not os.path.exists(tmp_path / '_wsi_tiles.bin')
+    assert all(fptr is None for fptr in ifds[0]['path_or_fobj']._fptrs)
+
+    outinfo = tifftools.read_tiff(outputPath)
+    for idx, (sourceIfd, outIfd) in enumerate(zip(sourceIfds, outinfo['ifds'])):
+        scale = 2 ** idx
+        image = pyvips.Image.tiffload(outputPath, page=idx)
+        region = np.ndarray(
+            buffer=image.crop(
+                left // scale + 2, top // scale + 2,
+                (right - left) // scale - 4, (bottom - top) // scale - 4).write_to_memory(),
+            dtype=np.uint8, shape=[(bottom - top) // scale - 4, (right - left) // scale - 4, 3])
+        assert region.max() < 16
+        # Tiles that don't touch the redacted area are copied unchanged
+        tilesAcross = (outIfd['tags'][tifftools.Tag.ImageWidth.value]['data'][0] + 255) // 256
+        sourceTiles = tileData(sourcePath, sourceIfd)
+        outTiles = tileData(outputPath, outIfd)
+        unchanged = 0
+        for tidx, (sourceTile, outTile) in enumerate(zip(sourceTiles, outTiles)):
+            tx, ty = (tidx % tilesAcross) * 256 * scale, (tidx // tilesAcross) * 256 * scale
+            if (tx > right + scale or tx + 256 * scale < left - scale or
+                    ty > bottom + scale or ty + 256 * scale < top - scale):
+                assert outTile == sourceTile
+                unchanged += 1
+            else:
+                assert outTile != sourceTile
+        assert unchanged == [8, 2, 0][idx]
+
+
+@pytest.mark.parametrize(('compression', 'tile'), [('lzw', True), ('jpeg', False)])
+def test_redact_wsi_tiles_fallback(tmp_path, compression, tile):
+    sourcePath = str(tmp_path / 'source.tiff')
+    tiffinfo = tiledImage(sourcePath, compression, tile)
+    geojson = {'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [[
+            [300, 200], [600, 200], [600, 500], [300, 200]]]}}]}
+    assert process.redact_format_aperio_philips_redact_wsi_tiles(
+        None, tiffinfo['ifds'], geojson, str(tmp_path)) is None
+    tileSource = mock.Mock()
+    with mock.patch.object(
+            process, 'read_ts_as_vips', side_effect=Exception('whole image')) as readTs:
+        with pytest.raises(Exception, match='whole image'):
+            process.redact_format_aperio_philips_redact_wsi(
+                tileSource, tiffinfo['ifds'], geojson, str(tmp_path))
+    readTs.assert_called_once_with(tileSource)
+    assert not os.path.exists(tmp_path / '_wsi_tiles.bin')
+
+
+def dicomInstance(path, transferSyntax, imageType='VOLUME', frames=3, trailing=False):
+    fileMeta = pydicom.FileMetaDataset()
+    fileMeta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.77.1.6'
+    fileMeta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    fileMeta.TransferSyntaxUID = transferSyntax
+    ds = pydicom.Dataset()
+    ds.file_meta = fileMeta
+    ds.SOPClassUID = fileMeta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = '1.2.3'
+    ds.SeriesInstanceUID = '1.2.3.4'
+    ds.SeriesNumber = 3
+    ds.PatientName = 'Secret^Person'
+    ds.PatientID = 'SecretID'
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', imageType, 'NONE']
+    ds.Rows = ds.Columns = 32
+    ds.SamplesPerPixel = 3
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.NumberOfFrames = frames
+    rng = np.random.default_rng(5)
+    if transferSyntax == pydicom.uid.JPEGBaseline8Bit:
+        ds.PhotometricInterpretation = 'YBR_FULL_422'
+        encoded = []
+        for _ in range(frames):
+            jpeg = io.BytesIO()
+            PIL.Image.fromarray(rng.integers(0, 255, (32, 32, 3), dtype=np.uint8)).save(
+                jpeg, 'JPEG')
+            encoded.append(jpeg.getvalue())
+        ds.PixelData = pydicom.encaps.encapsulate(encoded)
+    else:
+        ds.PhotometricInterpretation = 'RGB'
+        ds.PlanarConfiguration = 0
+        ds.PixelData = rng.integers(0, 255, (frames, 32, 32, 3), dtype=np.uint8).tobytes()
+    if trailing:
+        ds.add_new(0xFFFCFFFC, 'OB', b'\0' * 8)
+    ds.save_as(path, enforce_file_format=True)
+    return ds
+
+
+@pytest.mark.parametrize(('transferSyntax', 'trailing', 'streamed'), [
+    (pydicom.uid.JPEGBaseline8Bit, False, True),
+    (pydicom.uid.ExplicitVRLittleEndian, False, True),
+    (pydicom.uid.ImplicitVRLittleEndian, False, True),
+    (pydicom.uid.ExplicitVRBigEndian, False, True),
+    (pydicom.uid.JPEGBaseline8Bit, True, False),
+    (pydicom.uid.DeflatedExplicitVRLittleEndian, False, False),
+])
+def test_redact_dicom_instance(tmp_path, transferSyntax, trailing, streamed):
+    sourcePath = str(tmp_path / 'source.dcm')
+    source = dicomInstance(sourcePath, transferSyntax, trailing=trailing)
+    with open(sourcePath, 'rb') as fptr:
+        ds = pydicom.dcmread(fptr, stop_before_pixels=True)
+        pixelEnd = process.dicom_pixel_data_end(fptr, ds)
+    assert (pixelEnd is not None) == streamed
+    if streamed:
+        assert pixelEnd == os.path.getsize(sourcePath)
+    destDir = tmp_path / 'dest'
+    destDir.mkdir()
+    with mock.patch.object(
+            process, 'copy_byte_range', wraps=process.copy_byte_range) as copyByteRange:
+        destPath, kind, seriesNum = process.redact_dicom_instance(
+            sourcePath, str(destDir), {'images': {}},
+            {'PatientName': 'Redacted', 'PatientID': ''}, 'DSA Redacted')
+    assert copyByteRange.called == streamed
+    assert kind is None
+    assert seriesNum == 3
+    with open(destPath, 'rb') as fptr:
+        output = fptr.read()
+    assert b'Secret' not in output
+    result = pydicom.dcmread(destPath)
+    assert result.PatientName == 'Redacted'
+    assert 'PatientID' not in result
+    assert result.ModifiedImageDescription == 'DSA Redacted'
+    assert result.SOPInstanceUID == source.SOPInstanceUID
+    assert result.PixelData == source.PixelData
+
+
+@pytest.mark.parametrize(('imageType', 'kind'), [('LABEL', 'label'), ('OVERVIEW', 'macro')])
+def test_redact_dicom_instance_associated(tmp_path, imageType, kind):
+    sourcePath = str(tmp_path / 'source.dcm')
+    dicomInstance(sourcePath, pydicom.uid.JPEGBaseline8Bit, imageType=imageType, frames=1)
+    destPath, resultKind, _ = process.redact_dicom_instance(
+        sourcePath, str(tmp_path), {'images': {}}, {}, 'DSA Redacted')
+    assert resultKind == kind
+    assert 'ModifiedImageDescription' not in pydicom.dcmread(destPath)
+    assert process.redact_dicom_instance(
+        sourcePath, str(tmp_path), {'images': {kind: {}}}, {}, 'DSA Redacted') is None
+
+
+@pytest.mark.parametrize('redactImages', [{}, {'label': {}, 'macro': {}}])
+def test_redact_format_dicom(tmp_path, redactImages):
+    sourceDir = tmp_path / 'source'
+    sourceDir.mkdir()
+    paths = [str(sourceDir / f'{imageType}.dcm') for imageType in ('VOLUME', 'LABEL', 'OVERVIEW')]
+    volume = dicomInstance(paths[0], pydicom.uid.JPEGBaseline8Bit)
+    dicomInstance(paths[1], pydicom.uid.JPEGBaseline8Bit, imageType='LABEL', frames=1)
+    dicomInstance(paths[2], pydicom.uid.JPEGBaseline8Bit, imageType='OVERVIEW', frames=1)
+    destDir = tmp_path / 'dest'
+    destDir.mkdir()
+    redactList = {'metadata': {}, 'images': redactImages}
+    with mock.patch.object(process, 'Item') as item, mock.patch.object(
+            process, 'File') as file, mock.patch.object(
+            process, 'get_deid_field', return_value='DSA Redacted'):
+        item.return_value.childFiles.return_value = paths
+        file.return_value.getLocalFilePath.side_effect = lambda path: path
+        destfiles, mimetype = process.redact_format_dicom(
+            {}, str(destDir), redactList, 'title',
+            PIL.Image.new('RGB', (40, 30), (255, 0, 0)),
+            PIL.Image.new('RGB', (60, 30), (0, 255, 0)))
+    assert mimetype == 'application/dicom'
+    assert len(destfiles) == 3
+    assert sorted(os.listdir(destDir)) == sorted(os.path.basename(path) for path in destfiles)
+    results = [pydicom.dcmread(path) for path in destfiles]
+    assert len({ds.SOPInstanceUID for ds in results}) == 3
+    assert results[0].SOPInstanceUID == volume.SOPInstanceUID
+    assert results[0].PixelData == volume.PixelData
+    images = {ds.ImageType[2]: ds for ds in results[1:]}
+    assert (images['LABEL'].Columns, images['LABEL'].Rows) == (40, 30)
+    assert (images['OVERVIEW'].Columns, images['OVERVIEW'].Rows) == (60, 30)
+    assert all(ds.StudyInstanceUID == volume.StudyInstanceUID for ds in images.values())
+
+
+def noiseImage(width, height, seed):
+    return PIL.Image.fromarray(
+        np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8))
+
+
+def isyntaxFile(path, images):
+    scanned = ''.join(
+        '<DataObject ObjectType="DPScannedImage">\n'
+        '<Attribute Name="PIM_DP_IMAGE_TYPE" Group="0x301D" Element="0x1004" '
+        f'PMSVR="IString">{key}</Attribute>\n'
+        '<Attribute Name="PIM_DP_IMAGE_DATA" Group="0x301D" Element="0x1005" '
+        f'PMSVR="IString">{process.imageToBase64(image, quality)}</Attribute>\n'
+        '</DataObject>\n'
+        for key, (image, quality) in images.items())
+    header = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<DataObject ObjectType="DPUfsImport">\n'
+        '<Attribute Name="DICOM_SOFTWARE_VERSIONS" Group="0x0018" Element="0x1020" '
+        'PMSVR="IStringArray">&quot;1.0&quot;</Attribute>\n'
+        '<Attribute Name="PIIM_DP_SCANNER_OPERATOR_ID" Group="0x101D" Element="0x1009" '
+        'PMSVR="IString">operator</Attribute>\n'
+        '<Attribute Name="PIM_DP_UFS_BARCODE" Group="0x301D" Element="0x1002" '
+        'PMSVR="IString">YmFyY29kZQ==</Attribute>\n'
+        '<Attribute Name="PIM_DP_SCANNED_IMAGES" Group="0x301D" Element="0x1003" '
+        f'PMSVR="IDataObjectArray">\n<Array>\n{scanned}</Array>\n</Attribute>\n'
+        '</DataObject>\n').encode()
+    with open(path, 'wb') as fptr:
+        fptr.write(header + b'\r\n\x04' + os.urandom(100000))
+    return header
+
+
+def isyntaxStepDown(old, xmllen, labelImage, macroImage):
+    # The search used before the jpeg quality was found by bisection
+    from wsi_deid import __version__
+
+    redactList = {'images': {}, 'metadata': {
+        'internal;isyntax;scanner_operator_id':
+            process.generate_system_redaction_list_entry('title'),
+        'internal;isyntax;barcode':
+            process.generate_system_redaction_list_entry('title|DSA Redacted'),
+        'internal;isyntax;software_versions': process.generate_system_redaction_list_entry(
+            '"1.0" "DSA Redaction %s"' % __version__),
+    }}
+    for prune in range(4):
+        for quality in process.IsyntaxImageQualities:
+            tree = process.redact_format_isyntax_metadata(old, redactList, {}, prune < 3)
+            placeholders = process.redact_format_isyntax_images(
+                tree, redactList, labelImage, macroImage, prune=prune)
+            result = b'<?xml version="1.0" encoding="UTF-8"?>\n' + lxmlElementTree.tostring(
+                tree, encoding='UTF-8', method='xml', pretty_print=False)
+            for placeholder, image in placeholders.items():
+                result = result.replace(
+                    placeholder, process.imageToBase64(image, quality).encode())
+            for stripping in range(4 if quality <= process.IsyntaxStripQuality else 3):
+                if len(process.isyntax_strip_xml(result, stripping)) <= xmllen:
+                    return quality, prune
+    return None
+
+
+@pytest.mark.parametrize(('original', 'macro', 'prune'), [
+    ({'LABELIMAGE': 90}, False, 0),
+    ({'LABELIMAGE': 50}, False, 0),
+    ({'LABELIMAGE': 60, 'MACROIMAGE': 30}, True, 0),
+    ({'LABELIMAGE': 20, 'MACROIMAGE': 5}, True, 1),
+])
+def test_redact_format_isyntax(tmp_path, original, macro, prune):
+    labelImage = noiseImage(160, 160, 1)
+    macroImage = noiseImage(320, 120, 2) if macro else None
+    sourcePath = str(tmp_path / 'source.isyntax')
+    old = isyntaxFile(sourcePath, {
+        key: (labelImage if key == 'LABELIMAGE' else noiseImage(320, 120, 2), quality)
+        for key, quality in original.items()})
+    expected = isyntaxStepDown(old, len(old), labelImage, macroImage)
+    assert expected is not None
+    assert expected[1] == prune
+    if len(original) == 1 and original['LABELIMAGE'] == 50:
+        assert process.IsyntaxImageQualities[-1] < expected[0] < process.IsyntaxImageQualities[0]
+    tileSource = mock.Mock(_xmllen=len(old), _getLargeImagePath=lambda: sourcePath)
+    tileSource.getInternalMetadata.return_value = {'isyntax': {'software_versions': '"1.0"'}}
+    with mock.patch.object(process, 'ImageItem') as imageItem, mock.patch.object(
+            process, 'get_deid_field', return_value='DSA Redacted'):
+        imageItem.return_value.tileSource.return_value = tileSource
+        outputPath, mimetype = process.redact_format_isyntax(
+            {}, str(tmp_path), {'metadata': {}, 'images': {}}, 'title', labelImage, macroImage)
+    assert mimetype == 'image/isyntax'
+    source = open(sourcePath, 'rb').read()
+    output = open(outputPath, 'rb').read()
+    # The header is exactly as long as the original and the rest of the file
+    # is unchanged
+    assert len(output) == len(source)
+    assert output[len(old):] == source[len(old):]
+    tree = lxmlElementTree.fromstring(output[:len(old)])
+    assert tree.find('./Attribute[@Name="PIIM_DP_SCANNER_OPERATOR_ID"]').text == 'title'
+    images = {
+        entry.find('./Attribute[@Name="PIM_DP_IMAGE_TYPE"]').text:
+            entry.find('./Attribute[@Name="PIM_DP_IMAGE_DATA"]').text
+        for entry in tree.findall('./Attribute[@Name="PIM_DP_SCANNED_IMAGES"]/Array/DataObject')}
+    assert images.pop('LABELIMAGE') == process.imageToBase64(labelImage, expected[0])
+    if macro and not prune:
+        assert images.pop('MACROIMAGE') == process.imageToBase64(macroImage, expected[0])
+    assert not images
+
+
+def test_redact_format_isyntax_too_long(tmp_path):
+    sourcePath = str(tmp_path / 'source.isyntax')
+    old = isyntaxFile(sourcePath, {})
+    tileSource = mock.Mock(_xmllen=len(old), _getLargeImagePath=lambda: sourcePath)
+    tileSource.getInternalMetadata.return_value = {'isyntax': {}}
+    with mock.patch.object(process, 'ImageItem') as imageItem, mock.patch.object(
+            process, 'get_deid_field', return_value='DSA Redacted'):
+        imageItem.return_value.tileSource.return_value = tileSource
+        with pytest.raises(Exception, match='Generated XML is too long'):
+            process.redact_format_isyntax(
+                {}, str(tmp_path), {'metadata': {}, 'images': {}}, 'title',
+                noiseImage(160, 160, 1), None)
+    assert os.listdir(tmp_path) == ['source.isyntax']
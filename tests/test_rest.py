@@ -0,0 +1,178 @@
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.utility.progress import noProgress
+
+from wsi_deid import jobs, rest
+
+
+@pytest.mark.parametrize(('settings', 'cpus', 'available', 'count', 'workers'), [
+    ({}, 8, 64, 100, 8),
+    ({}, 8, 64, 3, 3),
+    ({}, None, 64, 100, 1),
+    ({'redact_concurrency': 2}, 8, 64, 100, 2),
+    ({'redact_memory_per_worker': 16}, 8, 64, 100, 4),
+    ({'redact_concurrency': 2, 'redact_memory_per_worker': 16}, 8, 64, 100, 2),
+    ({'redact_memory_per_worker': 16}, 8, 8, 100, 1),
+    ({'redact_memory_per_worker': 0}, 8, 1, 100, 8),
+])
+def test_redact_worker_count(settings, cpus, available, count, workers):
+    with mock.patch.object(
+            rest.config, 'getConfig', side_effect=lambda key, default=None: settings.get(
+                key, default)), mock.patch.object(
+            rest.os, 'cpu_count', return_value=cpus), mock.patch.object(
+            rest.psutil, 'virtual_memory',
+            return_value=types.SimpleNamespace(available=available * 1024 ** 3)):
+        assert rest.redact_worker_count(count) == workers
+
+
+@pytest.mark.parametrize('fail', [None, 0, 2, 5])
+def test_redact_items_ahead(fail):
+    items = [{'name': 'item%d' % idx, 'idx': idx} for idx in range(6)]
+    tempdirs = {}
+    running = set()
+    lock = threading.Lock()
+
+    def redact(item, tempdir):
+        with lock:
+            running.add(item['idx'])
+        tempdirs[item['idx']] = tempdir
+        # Later items finish first
+        time.sleep(0.01 * (len(items) - item['idx']))
+        with lock:
+            running.discard(item['idx'])
+        if item['idx'] == fail:
+            msg = 'Failed %s' % item['name']
+            raise Exception(msg)
+        path = os.path.join(tempdir, item['name'])
+        open(path, 'w').close()
+        return [path], {'idx': item['idx']}
+
+    results = []
+    with mock.patch.object(rest, 'redact_item_files', side_effect=redact), mock.patch.object(
+            rest, 'redact_worker_count', return_value=3):
+        redactions = rest.redact_items_ahead(items)
+        if fail is None:
+            for filepaths, info in redactions:
+                assert os.path.exists(filepaths[0])
+                results.append(info['idx'])
+        else:
+            with pytest.raises(Exception, match='Failed item%d' % fail):
+                for filepaths, info in redactions:
+                    assert os.path.exists(filepaths[0])
+                    results.append(info['idx'])
+    assert results == list(range(len(items) if fail is None else fail))
+    # Nothing is still redacting and all work files are removed
+    assert not running
+    assert all(not os.path.exists(tempdir) for tempdir in tempdirs.values())
+    # Items are only redacted a few ahead of a failure
+    if fail is not None:
+        assert max(tempdirs) < fail + 3
+
+
+def batchItems(admin, count=4):
+    folder = Folder().createFolder(admin, 'Batch', parentType='user', creator=admin)
+    return [Item().createItem('item%d' % idx, creator=admin, folder=folder)
+            for idx in range(count)]
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_batch_process_job(server, admin):
+    from girder_jobs.models.job import Job
+
+    items = batchItems(admin)
+    with mock.patch.object(Job, 'scheduleJob') as scheduleJob:
+        resp = server.request(
+            path='/wsi_deid/action/list/finish', method='PUT', user=admin,
+            params={'ids': json.dumps([str(item['_id']) for item in items])})
+    assert resp.json['action'] == 'finish'
+    assert resp.json['count'] == 4
+    scheduleJob.assert_called_once()
+    job = Job().load(resp.json['jobId'], force=True)
+    assert job['type'] == 'wsi_deid.batch_process'
+    assert job['args'] == ['finish', [str(item['_id']) for item in items]]
+    assert job['kwargs'] == {'resume': False}
+    assert job['wsiDeidOwner'] == jobs.batch_process_owner()
+    assert not jobs.batch_process_job_stale(job)
+
+    resp = server.request(
+        path='/wsi_deid/action/list/finish', method='PUT', user=admin,
+        params={'ids': json.dumps([])})
+    assert resp.json == {'action': 'finish', 'count': 0}
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_batch_process_job_done(server, admin):
+    from girder_jobs.models.job import Job, JobStatus
+
+    items = batchItems(admin)
+    with mock.patch.object(Job, 'scheduleJob'):
+        job = rest.batch_process_job('finish', items, admin)
+    actionfunc = mock.Mock(side_effect=[None, None, Exception('Failed item2'), None])
+    with mock.patch.object(rest, 'action_for_item', side_effect=lambda item, user, action: (
+            actionfunc, (item, ), 'approve', 'approving')):
+        with pytest.raises(Exception, match='Failed item2'):
+            rest.item_list_action('finish', items, admin, noProgress, job)
+    assert actionfunc.call_count == 3
+    assert not rest.ItemActionList
+    job = Job().load(job['_id'], force=True)
+    assert job['kwargs']['done'] == [str(item['_id']) for item in items[:2]]
+
+    # Running the job again skips the finished items and, when resuming,
+    # items that are already in the destination folder
+    Job().collection.update_one({'_id': job['_id']}, {'$set': {'kwargs.resume': True}})
+    job = Job().load(job['_id'], force=True)
+    with mock.patch.object(rest, 'item_list_action') as itemListAction, mock.patch.object(
+            jobs, 'batch_process_item_done',
+            side_effect=lambda item, action: item['name'] == 'item2'):
+        jobs.start_batch_process_job(job)
+    assert [item['_id'] for item in itemListAction.call_args[0][1]] == [items[3]['_id']]
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert job['status'] == JobStatus.SUCCESS
+    assert any('Skipping item2' in line for line in job['log'])
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_resume_batch_process_jobs(server, admin):
+    from girder_jobs.models.job import Job, JobStatus
+
+    items = batchItems(admin)
+    now = datetime.datetime.utcnow()
+    stale = now - datetime.timedelta(seconds=jobs.BatchJobStaleTime * 2)
+    owners = {
+        'deadLocal': ({'host': socket.gethostname(), 'pid': os.getpid(), 'started': 0}, now),
+        'live': (jobs.batch_process_owner(), now),
+        'liveRemote': ({'host': 'elsewhere', 'pid': 1, 'started': 0}, now),
+        'deadRemote': ({'host': 'elsewhere', 'pid': 1, 'started': 0}, stale),
+    }
+    batch = {}
+    with mock.patch.object(Job, 'scheduleJob'):
+        for key, (owner, heartbeat) in owners.items():
+            job = rest.batch_process_job('finish', items, admin)
+            Job().collection.update_one({'_id': job['_id']}, {'$set': {
+                'status': JobStatus.RUNNING,
+                'kwargs.done': [str(items[0]['_id'])],
+                'wsiDeidOwner': owner,
+                'wsiDeidHeartbeat': heartbeat,
+            }})
+            batch[key] = job['_id']
+        jobs.resume_batch_process_jobs()
+        # Resuming again doesn't start more jobs
+        jobs.resume_batch_process_jobs()
+    for key, jobId in batch.items():
+        job = Job().load(jobId, force=True)
+        assert job['status'] == (JobStatus.ERROR if key.startswith('dead') else JobStatus.RUNNING)
+    resumed = list(Job().find({'type': 'wsi_deid.batch_process', 'kwargs.resume': True}))
+    assert len(resumed) == 2
+    for job in resumed:
+        assert job['args'] == ['finish', [str(item['_id']) for item in items[1:]]]
+        assert job['wsiDeidOwner'] == jobs.batch_process_owner()
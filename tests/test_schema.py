@@ -1,11 +1,17 @@
 # flake8: noqa 501
 # Disable flake8 line-length check (E501)
 
+import io
+import json
 import os
+from unittest import mock
 
+import jsonschema
+import pandas as pd
 import pytest
 
-from wsi_deid.import_export import getSchemaValidator, readExcelData, validateDataRow
+from wsi_deid.import_export import (compileSchemaCheck, getSchemaValidator, readExcelData,
+                                    validateDataRow)
 
 from .utilities import resetConfig  # noqa
 
@@ -77,3 +83,194 @@ def test_schema(tmp_path, csv, errorlist, resetConfig, db):  # noqa
         rowAsDict.pop('Index')
         errors = validateDataRow(validator, rowAsDict, header_row_number + 2 + row_num, df)
         assert errors == errorlist[row_num]
+
+
+csvHeader = """TokenID,Proc_Seq,Proc_Type,Spec_Site,Slide_ID,ImageID,InputFileName
+0579XY112001,01,Biopsy,C717-Brain stem,01,0579XY112001_01_01,01-A.svs
+0579XY112001,01,Biopsy,C717-Brain stem,02,0579XY112001_01_02,02.svs"""
+
+
+@pytest.mark.parametrize(('prefix', 'headerRow'), [
+    ('', 0),
+    ('Manifest\n', 1),
+    # Blank lines are not counted, as when pandas reads the header
+    ('\n\nManifest,2020\n\n', 1),
+    ('a,b,c,d,e,f,g,h,i\n', 1),
+    # Reading these with pandas at each possible header row raised a
+    # ParserError, since the second row has more fields than the first
+    ('Manifest\nBatch,7\n', 2),
+    ('\n\nJunk\nmore junk,x\n', 2),
+])
+def test_read_excel_data_header_row(tmp_path, prefix, headerRow, resetConfig, db):  # noqa
+    dest = tmp_path / 'test.csv'
+    open(dest, 'w').write(prefix + csvHeader)
+    df, header_row_number = readExcelData(str(dest))
+    assert header_row_number == headerRow
+    assert list(df.columns) == csvHeader.split('\n')[0].split(',')
+    assert list(df['Slide_ID']) == ['01', '02']
+    # The header row number can be used to read the file with pandas
+    assert pd.read_csv(dest, header=header_row_number, dtype=str).equals(df)
+    with open(dest, 'rb') as fptr:
+        fromFptr, header_row_number = readExcelData(fptr)
+    assert header_row_number == headerRow
+    assert fromFptr.equals(df)
+
+
+def test_read_excel_data_xls_numeric_header(resetConfig, db):  # noqa
+    dest = os.path.join(os.path.dirname(__file__), 'data', 'numeric_header.xls')
+    df, header_row_number = readExcelData(dest)
+    # A title, a blank row, and a row with a number precede the header
+    assert header_row_number == 3
+    # Numeric header cells are numeric column names, as pandas reads them
+    assert list(df.columns) == [
+        'TokenID', 'Proc_Seq', 'Proc_Type', 'Spec_Site', 'Slide_ID', 'ImageID',
+        'InputFileName', 2020]
+    assert pd.read_excel(dest, header=header_row_number, dtype=str).equals(df)
+    assert list(df[2020]) == ['5', '6.5']
+    assert list(df['ImageID']) == ['0579XY112001_01_01', '0579XY112001_01_02']
+
+
+@pytest.mark.parametrize(('trailer', 'status', 'count'), [
+    ('', 'parsed', 5),
+    ('0579XY112001,03,Biopsy,C717-Brain stem,03,0579XY112001_03_03,03-A.svs,extra,extra\n', 'badformat', 0),
+])
+def test_read_excel_files_bad_trailing_line(tmp_path, trailer, status, count, resetConfig, db):  # noqa
+    import wsi_deid.import_export
+
+    wsi_deid.import_export.SCHEMA_FILE_PATH = os.path.join(
+        os.path.dirname(wsi_deid.import_export.SCHEMA_FILE_PATH), 'importManifestSchema.test.json')
+    dest = tmp_path / 'test.csv'
+    open(dest, 'w').write(csv6 + '\n' + trailer)
+    # Parse in small chunks so that the bad line is not in the first chunk
+    with mock.patch.object(wsi_deid.import_export, 'ManifestChunkSize', 2):
+        manifest, report = wsi_deid.import_export.readExcelFiles([str(dest)], mock.Mock())
+    assert report[0]['status'] == status
+    assert report[0].get('count', 0) == count
+    assert len(manifest) == (1 if count else 0)
+
+
+csv7 = """TokenID,Proc_Seq,Proc_Type,Spec_Site,Slide_ID,ImageID,InputFileName
+0579XY112001,01,Biopsy,C71.7,01,0579XY112001_01_01,01-A.svs
+0579XY112001,01,Biopsy,C71.7,02,0579XY112001_01_02,
+0579XY112001,01,Biopsy,C71.8,03,0579XY112001_01_03,
+0579XY112001,01,Autopsy,,04,0579XY112001_01_04,04-A.svs
+X579XY112001,01,Resection,,05,0579XY112001_01_05,05-A.svs
+0579XY112001,01,Resection,,06,0579,06-A.svs
+0579XY112001,01,Resection,,07,0579XY112001_01_07,a-very-long-name.svs
+,01,Resection,,08,0579XY112001_01_08,08-A.svs
+0579XY112001,01,Resection,,09,0579XY112001_01_09,09-A.svs"""
+
+customSchema = {
+    'type': 'object',
+    'required': ['TokenID'],
+    'properties': {
+        'TokenID': {'type': 'string', 'pattern': '^[0-9]{4}'},
+        'Proc_Type': {'enum': ['Biopsy', 'Resection']},
+        'ImageID': {'pattern': '_[0-9]{2}$', 'minLength': 8},
+        'InputFileName': {'maxLength': 12},
+    },
+    'oneOf': [
+        {'required': ['InputFileName']},
+        {'required': ['Spec_Site'], 'properties': {'Spec_Site': {'const': 'C71.7'}}},
+    ],
+}
+
+
+def schemaFile(name):
+    import wsi_deid.import_export
+
+    path = os.path.join(os.path.dirname(wsi_deid.import_export.SCHEMA_FILE_PATH), name)
+    return json.load(open(path))
+
+
+def dataFile(name):
+    return open(os.path.join(os.path.dirname(__file__), 'data', name)).read()
+
+
+@pytest.mark.parametrize('schema', [
+    schemaFile('importManifestSchema.json'),
+    schemaFile('importManifestSchema.test.json'),
+    schemaFile('importManifestSchema.example.json'),
+    schemaFile('importManifestSchema.example.nofile.json'),
+    customSchema,
+])
+@pytest.mark.parametrize('csv', [
+    csv1, csv2, csv3, csv4, csv6, csv7,
+    dataFile('deidUpload.csv'),
+    dataFile('default_schema_deidUpload.csv'),
+])
+def test_compiled_schema_check(schema, csv):
+    check = compileSchemaCheck(schema)
+    assert check is not None
+    validator = jsonschema.Draft6Validator(schema)
+    df = pd.read_csv(io.StringIO(csv), dtype=str)
+    rows = list(df.itertuples())
+    valid = check(df, dict(zip(rows[0]._fields[1:], df.columns)))
+    for row in rows:
+        rowAsDict = {k: v for k, v in row._asdict().items() if pd.notnull(v)}
+        rowAsDict.pop('Index')
+        assert bool(valid.at[row.Index]) == validator.is_valid(rowAsDict)
+
+
+@pytest.mark.plugin('wsi_deid')
+def test_schema_cache_invalidation(server, admin, fsAssetstore, resetConfig):  # noqa
+    from girder.models.file import File
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+    from girder.models.setting import Setting
+    from girder.models.upload import Upload
+
+    from wsi_deid import import_export
+    from wsi_deid.constants import PluginSettings
+
+    def schemaData(field):
+        return json.dumps({'type': 'object', 'properties': {field: {'type': 'string'}}}).encode()
+
+    folder = Folder().createFolder(admin, 'Schema', parentType='user', creator=admin)
+    other = Folder().createFolder(admin, 'Other', parentType='user', creator=admin)
+    default = import_export.getSchema()
+    Setting().set(PluginSettings.WSI_DEID_SCHEMA_FOLDER, str(folder['_id']))
+    assert import_export.getSchema() == default
+    # Uploading a schema file
+    data = schemaData('TokenID')
+    file = Upload().uploadFromFile(
+        io.BytesIO(data), len(data), 'schema.json', parentType='folder', parent=folder,
+        user=admin)
+    assert list(import_export.getSchema()['properties']) == ['TokenID']
+    # Unrelated changes keep the cached schema
+    validator = import_export.getSchemaValidator()
+    item = Item().createItem('other', creator=admin, folder=other)
+    Item().setMetadata(item, {'key': 'value'})
+    data = schemaData('Other')
+    Upload().uploadFromFile(
+        io.BytesIO(data), len(data), 'other.json', parentType='item', parent=item, user=admin)
+    assert import_export.getSchemaValidator() is validator
+    # Editing the schema file
+    data = schemaData('ImageID')
+    upload = Upload().createUploadToFile(file, admin, len(data))
+    Upload().handleChunk(upload, io.BytesIO(data))
+    assert list(import_export.getSchema()['properties']) == ['ImageID']
+    # Adding a second schema file to the existing item doesn't use it, since
+    # items must have exactly one file
+    schemaItem = Item().load(file['itemId'], force=True)
+    data = schemaData('Slide_ID')
+    second = Upload().uploadFromFile(
+        io.BytesIO(data), len(data), 'second.json', parentType='item', parent=schemaItem,
+        user=admin)
+    assert import_export.getSchema() == default
+    # Removing the schema file
+    File().remove(second)
+    assert list(import_export.getSchema()['properties']) == ['ImageID']
+    File().remove(File().load(file['_id'], force=True))
+    assert import_export.getSchema() == default
+    # Moving an item in and out of the schema folder
+    item = Item().load(item['_id'], force=True)
+    Item().move(item, folder)
+    assert list(import_export.getSchema()['properties']) == ['Other']
+    Item().move(Item().load(item['_id'], force=True), other)
+    assert import_export.getSchema() == default
+    # Changing the setting
+    Item().move(Item().load(item['_id'], force=True), folder)
+    assert list(import_export.getSchema()['properties']) == ['Other']
+    Setting().set(PluginSettings.WSI_DEID_SCHEMA_FOLDER, str(other['_id']))
+    assert import_export.getSchema() == default
@@ -0,0 +1,152 @@
+import os
+import queue
+from unittest import mock
+
+import pytest
+from girder.models.setting import Setting
+
+from wsi_deid import import_export
+from wsi_deid.constants import PluginSettings
+
+from .sftp_server import SftpPassword, SftpUser, sftpHostKey, sftpServer  # noqa
+from .utilities import resetConfig  # noqa
+
+
+@pytest.fixture
+def sftpSettings(sftpServer, resetConfig, db):  # noqa
+    host, port, root = sftpServer
+    Setting().set(PluginSettings.WSI_DEID_REMOTE_HOST, host)
+    Setting().set(PluginSettings.WSI_DEID_REMOTE_PORT, port)
+    Setting().set(PluginSettings.WSI_DEID_REMOTE_USER, SftpUser)
+    Setting().set(PluginSettings.WSI_DEID_REMOTE_PASSWORD, SftpPassword)
+    transport = import_export.get_sftp_transport()
+    yield transport, root
+    transport.close()
+
+
+def test_sftp_listing(sftpSettings):
+    transport, root = sftpSettings
+    (root / 'dest' / 'existing').mkdir(parents=True)
+    (root / 'dest' / 'existing' / 'file.svs').write_bytes(b'data')
+    client = import_export.get_sftp_client(transport)
+    listing = import_export.SftpListingCache(client)
+    assert set(listing.listdir('/dest')) == {'existing'}
+    listing.makedir('/dest', 'existing')
+    listing.makedir('/dest', 'new')
+    assert os.path.isdir(root / 'dest' / 'new')
+    assert set(listing.listdir('/dest')) == {'existing', 'new'}
+    assert listing.listdir('/dest/new') == {}
+    assert listing.listdir('/dest/existing')['file.svs'].st_size == 4
+    # Listings are only read once
+    (root / 'dest' / 'existing' / 'other.svs').write_bytes(b'other')
+    assert set(listing.listdir('/dest/existing')) == {'file.svs'}
+    client.close()
+
+
+def test_sftp_check_item(sftpSettings, tmp_path):
+    transport, root = sftpSettings
+    (root / 'dest' / 'image').mkdir(parents=True)
+    (root / 'dest' / 'image' / 'same.svs').write_bytes(b'1234')
+    (root / 'dest' / 'image' / 'different.svs').write_bytes(b'12345')
+    localPath = tmp_path / 'local.svs'
+    localPath.write_bytes(b'abcd')
+    client = import_export.get_sftp_client(transport)
+    listing = import_export.SftpListingCache(client)
+    reports = []
+    with mock.patch.object(import_export, 'Job'), mock.patch.object(
+            import_export, 'getExportSourcePath', return_value=str(localPath)):
+        for name, result, status in [
+                ('same.svs', import_export.ExportResult.ALREADY_EXISTS_AT_DESTINATION, 'present'),
+                ('different.svs', import_export.ExportResult.ALREADY_EXISTS_AT_DESTINATION,
+                 'different'),
+                ('new.svs', None, None)]:
+            item = {'_id': name, 'meta': {}}
+            exportResult, transfer = import_export.sftp_check_item(
+                os.path.join('export', 'image', name), {'size': 4}, item, '/dest',
+                listing, {}, False, reports)
+            assert exportResult == result
+            assert reports[-1]['item'] is item
+            assert reports[-1].get('status') == status
+            assert (transfer is None) == (result is not None)
+    assert transfer['remote_path'] == '/dest/image/new.svs'
+    assert transfer['local_path'] == str(localPath)
+    client.close()
+
+
+def test_sftp_transfer(sftpSettings, tmp_path):
+    transport, root = sftpSettings
+    (root / 'dest' / 'image').mkdir(parents=True)
+    data = os.urandom(import_export.SftpChunkSize * 3 + 17)
+    localPath = tmp_path / 'local.svs'
+    localPath.write_bytes(data)
+    client = import_export.get_sftp_client(transport)
+    listing = import_export.SftpListingCache(client)
+    channels = queue.Queue()
+    with mock.patch.object(import_export, 'Job'), mock.patch.object(
+            import_export, 'getExportSourcePath', return_value=str(localPath)):
+        _, transfer = import_export.sftp_check_item(
+            os.path.join('export', 'image', 'new.svs'), {'size': len(data)},
+            {'_id': 'new', 'meta': {}}, '/dest', listing, {}, False, [])
+        transfer['future'] = mock.Mock()
+        transfer['future'].result.return_value = import_export.sftp_put_file(
+            transport, channels, transfer['local_path'], transfer['remote_path'])
+        records = []
+        result = import_export.sftp_finish_item(transfer, {}, None, records, listing)
+    assert result == import_export.ExportResult.EXPORTED_SUCCESSFULLY
+    assert (root / 'dest' / 'image' / 'new.svs').read_bytes() == data
+    assert os.listdir(root / 'dest' / 'image') == ['new.svs']
+    assert len(records) == 1
+    assert transfer['report']['status'] == 'finished'
+    # The listing includes the transferred file
+    assert listing.listdir('/dest/image')['new.svs'].st_size == len(data)
+    while not channels.empty():
+        channels.get().close()
+    client.close()
+
+
+def test_sftp_resume(sftpSettings, tmp_path):
+    transport, root = sftpSettings
+    (root / 'dest').mkdir()
+    data = os.urandom(import_export.SftpChunkSize * 3 + 17)
+    localPath = tmp_path / 'local.svs'
+    localPath.write_bytes(data)
+    channels = queue.Queue()
+    sftpSend = import_export.sftp_send
+    offsets = []
+
+    def interruptedSend(sftp_client, local_path, remote_path, offset=0, hasher=None):
+        offsets.append(offset)
+        if len(offsets) == 1:
+            with sftp_client.file(remote_path, 'wb') as fr:
+                fr.write(data[:import_export.SftpChunkSize])
+            msg = 'Interrupted'
+            raise Exception(msg)
+        return sftpSend(sftp_client, local_path, remote_path, offset, hasher)
+
+    with mock.patch.object(import_export, 'sftp_send', side_effect=interruptedSend):
+        import_export.sftp_put_file(transport, channels, str(localPath), '/dest/new.svs')
+    assert offsets == [0, import_export.SftpChunkSize]
+    assert (root / 'dest' / 'new.svs').read_bytes() == data
+    assert os.listdir(root / 'dest') == ['new.svs']
+
+    # A partial file from a different source is not resumed
+    offsets[:] = []
+    (root / 'dest' / '.other.svs.partial').write_bytes(data[:1000])
+    info = import_export.sftp_partial_info(str(localPath))
+    info['mtime'] -= 1
+    client = import_export.get_sftp_client(transport)
+    import_export.sftp_write_partial_info(client, '/dest/.other.svs.partial', info)
+    with mock.patch.object(import_export, 'sftp_send', side_effect=sftpSend) as send:
+        import_export.sftp_put_file(transport, channels, str(localPath), '/dest/other.svs')
+    assert send.call_args[0][3] == 0
+    assert (root / 'dest' / 'other.svs').read_bytes() == data
+    # Nor is one with no source information
+    (root / 'dest' / '.third.svs.partial').write_bytes(data[:1000])
+    with mock.patch.object(import_export, 'sftp_send', side_effect=sftpSend) as send:
+        import_export.sftp_put_file(transport, channels, str(localPath), '/dest/third.svs')
+    assert send.call_args[0][3] == 0
+    assert (root / 'dest' / 'third.svs').read_bytes() == data
+    assert sorted(os.listdir(root / 'dest')) == ['new.svs', 'other.svs', 'third.svs']
+    while not channels.empty():
+        channels.get().close()
+    client.close()
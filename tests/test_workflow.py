@@ -113,3 +113,31 @@ def test_workflow_with_default_schema(server, provisionDefaultSchemaServer, user
     assert len(list(Folder().fileList(unfiledFolder))) == 0
     rest.ingestData(user, False)
     assert len(list(Folder().fileList(unfiledFolder, user, data=False))) == 5
+
+
+@pytest.mark.plugin('wsi_deid')
+@pytest.mark.plugin('large_image')
+def test_ingest_manifest_metadata(server, provisionServer, user):  # noqa
+    from girder import events
+
+    import wsi_deid.import_export
+    from wsi_deid import rest
+    from wsi_deid.constants import PluginSettings
+
+    wsi_deid.import_export.SCHEMA_FILE_PATH = os.path.join(
+        os.path.dirname(wsi_deid.import_export.SCHEMA_FILE_PATH), 'importManifestSchema.test.json')
+    importFolderId = Setting().get(PluginSettings.HUI_INGEST_FOLDER)
+    importFolder = Folder().load(importFolderId, force=True, exc=True)
+    saved = []
+    with events.bound('model.item.save', 'test_ingest', lambda event: saved.append(
+            event.info['_id'])):
+        rest.ingestData(user, False)
+    files = list(Folder().fileList(importFolder, user, data=False))
+    assert len(files) == 4
+    for _, file in files:
+        item = Item().load(file['itemId'], force=True)
+        assert item['name'].startswith(item['meta']['deidUpload']['ImageID'] + '.')
+        assert 'metadata' in item['meta']['redactList']
+        assert item['updated'] > item['created']
+        assert item['_id'] in saved
+
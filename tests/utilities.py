@@ -39,6 +39,7 @@ def _provisionBase(configRecord=None):
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'devops', 'wsi_deid'))
     config = girder.utility.config.getConfig()
     config[wsi_deid.config.CONFIG_SECTION] = configRecord or {}
+    wsi_deid.config.resetConfigSnapshot()
     import provision  # noqa
     provision.provision()
     del sys.path[-1]
@@ -90,6 +91,7 @@ def resetConfig():
     # Use default wsi_deid config for tests
     config = girder.utility.config.getConfig()
     config[wsi_deid.config.CONFIG_SECTION] = {}
+    wsi_deid.config.resetConfigSnapshot()
 
 
 def _provisionDefaultSchemaServer(tmp_path):
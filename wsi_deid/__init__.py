@@ -4,6 +4,7 @@ import os
 import re
 import string
 
+import cherrypy
 import girder
 import PIL.Image
 import psutil
@@ -16,10 +17,10 @@ from girder.models.folder import Folder
 from girder.models.setting import Setting
 from girder.utility import setting_utilities
 
-from . import assetstore_import
-from .config import configSchemas
+from . import assetstore_import, jobs, ocr
+from .config import configSchemas, settingChangedEvent
 from .constants import PluginSettings
-from .import_export import SftpMode
+from .import_export import SftpMode, ensureExportIndices, schemaChangedEvent
 from .rest import WSIDeIDResource, addSystemEndpoints
 
 try:
@@ -94,7 +95,10 @@ def validateSettingSftpMode(doc):
     PluginSettings.WSI_DEID_BASE + 'edit_metadata',
     PluginSettings.WSI_DEID_BASE + 'show_metadata_in_lists',
     PluginSettings.WSI_DEID_BASE + 'reimport_if_moved',
+    PluginSettings.WSI_DEID_BASE + 'redact_tiff_in_place',
     PluginSettings.WSI_DEID_BASE + 'validate_image_id_field',
+    PluginSettings.WSI_DEID_BASE + 'ocr_adaptive_rotation',
+    PluginSettings.WSI_DEID_BASE + 'sftp_verify_hash',
 })
 def validateBoolean(doc):
     if doc.get('value', None) is not None:
@@ -113,6 +117,25 @@ def validateDecimalPercent(doc):
             raise ValidationException(msg)
 
 
+@setting_utilities.validator({
+    PluginSettings.WSI_DEID_BASE + 'redact_concurrency',
+    PluginSettings.WSI_DEID_BASE + 'redact_memory_per_worker',
+    PluginSettings.WSI_DEID_BASE + 'ocr_cache_days',
+    PluginSettings.WSI_DEID_BASE + 'ocr_concurrency',
+    PluginSettings.WSI_DEID_BASE + 'ocr_memory_per_worker',
+})
+def validateNonNegativeNumber(doc):
+    if doc.get('value', None) == '':
+        doc['value'] = None
+    if doc.get('value', None) is not None:
+        doc['value'] = float(doc['value'])
+        if doc['value'] == int(doc['value']):
+            doc['value'] = int(doc['value'])
+        if doc['value'] < 0:
+            msg = 'Value must not be negative'
+            raise ValidationException(msg)
+
+
 @setting_utilities.validator({
     PluginSettings.WSI_DEID_BASE + 'folder_name_field',
 })
@@ -242,10 +265,23 @@ class GirderPlugin(plugin.GirderPlugin):
         idx1 = ([('path', 1)], {})
         if idx1 not in File()._indices:
             File().ensureIndex(idx1)
+        ensureExportIndices()
         PIL.Image.ANTIALIAS = PIL.Image.LANCZOS
 
         events.bind('rest.post.assetstore/:id/import.after', 'wsi_deid',
                     assetstore_import.assetstoreImportEvent)
+        # File saves aren't bound, as they happen for every imported file;
+        # uploads, including new contents of a file, finalize the upload
+        for eventName in ('model.setting.save.after', 'model.setting.remove',
+                          'model.item.save.after', 'model.item.remove',
+                          'model.file.finalizeUpload.after', 'model.file.remove'):
+            events.bind(eventName, 'wsi_deid.schema', schemaChangedEvent)
+        for eventName in ('model.setting.save.after', 'model.setting.remove'):
+            events.bind(eventName, 'wsi_deid.config', settingChangedEvent)
+        for eventName in ('model.setting.save.after', 'model.setting.remove'):
+            events.bind(eventName, 'wsi_deid.ocr', ocr.settingChangedEvent)
+        jobs.resume_batch_process_jobs()
+        cherrypy.engine.subscribe('stop', ocr.reset_pool)
 
         try:
             import large_image_source_dicom
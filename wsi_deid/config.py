@@ -1,3 +1,7 @@
+import copy
+import threading
+import types
+
 import girder.utility.config
 
 from .constants import PluginSettings
@@ -157,6 +161,14 @@ defaultConfig = {
     ],
     'reimport_if_moved': False,
     'new_token_pattern': '####@@####',
+    'redact_concurrency': 0,
+    'redact_memory_per_worker': 4,
+    'redact_tiff_in_place': True,
+    'ocr_cache_days': 90,
+    'ocr_concurrency': 0,
+    'ocr_memory_per_worker': 2,
+    'ocr_adaptive_rotation': True,
+    'sftp_verify_hash': False,
 }
 
 
@@ -241,9 +253,25 @@ configSchemas = {
 }
 
 
-def getConfig(key=None, fallback=None):
-    configDict = girder.utility.config.getConfig().get(CONFIG_SECTION) or {}
-    configDict = configDict.copy()
+# The configuration snapshot is a tuple of the Girder config file section it
+# was read from, the settings generation, and a read-only mapping
+ConfigSnapshot = None
+ConfigGeneration = 0
+ConfigLock = threading.Lock()
+
+
+def readConfigParts(section):
+    """
+    Read the configuration from a section of the Girder config file and the
+    wsi_deid settings.  Settings take precedence.
+
+    :param section: the wsi_deid section of the Girder config file or None.
+    :returns: a dictionary of configuration values.  Keys that aren't
+        specified in either place are not present.
+    :returns: True if the settings were read, False if reading them failed.
+    """
+    configDict = (section or {}).copy()
+    complete = True
     try:
         from girder.models.setting import Setting
 
@@ -253,15 +281,93 @@ def getConfig(key=None, fallback=None):
                 if val is not None:
                     configDict[subkey] = val
             except Exception:
-                pass
+                complete = False
     except Exception:
-        pass
+        complete = False
+    return configDict, complete
+
+
+def readConfig():
+    """
+    Read the configuration from the wsi_deid section of the Girder config
+    file and the wsi_deid settings.  Settings take precedence.
+
+    :returns: a dictionary of configuration values.  Keys that aren't
+        specified in either place are not present.
+    """
+    return readConfigParts(girder.utility.config.getConfig().get(CONFIG_SECTION))[0]
+
+
+def getConfigSnapshot():
+    """
+    Get a read-only snapshot of the configuration.  This is cached until a
+    wsi_deid setting changes or the wsi_deid section of the Girder config is
+    replaced.  If the settings can't be read, the result isn't cached.
+
+    :returns: a read-only mapping of configuration values as returned from
+        readConfig.  Values must not be modified.
+    """
+    global ConfigSnapshot
+
+    section = girder.utility.config.getConfig().get(CONFIG_SECTION)
+    generation = ConfigGeneration
+    cached = ConfigSnapshot
+    if cached is not None and cached[0] is section and cached[1] == generation:
+        return cached[2]
+    configDict, complete = readConfigParts(section)
+    snapshot = types.MappingProxyType(copy.deepcopy(configDict))
+    if complete:
+        with ConfigLock:
+            # Don't keep the snapshot if a setting changed while reading it
+            if generation == ConfigGeneration:
+                ConfigSnapshot = (section, generation, snapshot)
+    return snapshot
+
+
+def resetConfigSnapshot():
+    """
+    Discard the configuration snapshot.  This is needed if the wsi_deid
+    section of the Girder config is modified in place or the settings are
+    changed without Girder events.
+    """
+    global ConfigSnapshot, ConfigGeneration
+
+    with ConfigLock:
+        ConfigGeneration += 1
+        ConfigSnapshot = None
+
+
+def settingChangedEvent(event):
+    """
+    Discard the configuration snapshot when a wsi_deid setting changes.
+
+    :param event: a Girder setting save or remove event.
+    """
+    if isinstance(event.info, dict) and str(event.info.get('key', '')).startswith(
+            CONFIG_SECTION + '.'):
+        resetConfigSnapshot()
+
+
+def getConfig(key=None, fallback=None):
+    """
+    Get a configuration value or all configuration values.  Lists and
+    dictionaries are copied, so callers may modify them without changing the
+    cached snapshot or the defaults.
+
+    :param key: the configuration key or None for all values.
+    :param fallback: the value to return if the key is not in the
+        configuration or the defaults.
+    :returns: the value or a dictionary of all values.
+    """
+    configDict = getConfigSnapshot()
     if key is None:
         config = defaultConfig.copy()
         config.update(configDict)
-        return config
+        return copy.deepcopy(config)
     if key in configDict:
-        return configDict[key]
-    if key in defaultConfig:
-        return defaultConfig[key]
-    return fallback
+        value = configDict[key]
+    elif key in defaultConfig:
+        value = defaultConfig[key]
+    else:
+        return fallback
+    return copy.deepcopy(value) if isinstance(value, (list, dict)) else value
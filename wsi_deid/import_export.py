@@ -1,9 +1,18 @@
+import codecs
+import collections
+import concurrent.futures
+import copy
+import csv
 import datetime
+import functools
+import hashlib
+import itertools
 import json
 import os
-import shutil
-import subprocess
+import queue
+import re
 import tempfile
+import threading
 import time
 
 import jsonschema
@@ -11,7 +20,9 @@ import magic
 import openpyxl
 import pandas as pd
 import paramiko
+import pymongo
 from girder import logger
+from girder.constants import AccessType
 from girder.models.assetstore import Assetstore
 from girder.models.file import File
 from girder.models.folder import Folder
@@ -20,6 +31,7 @@ from girder.models.setting import Setting
 from girder.models.upload import Upload
 from girder_jobs.models.job import Job, JobStatus
 from girder_large_image.models.image_item import ImageItem
+from pandas.io.parsers import TextParser
 
 from . import config, process
 from .constants import (ExportResult, PluginSettings, ProjectFolders, SftpMode,
@@ -32,20 +44,118 @@ SFTP_HISTORY_KEY = 'wsi_deidExportedSftp'
 SCHEMA_FILE_PATH = os.path.join(os.path.dirname(__file__), 'schema', 'importManifestSchema.json')
 
 
-def readExcelData(filepathOrFptr):
+def findCsvHeaderRow(filepathOrFptr, isHeader):
+    """
+    Find the header row of a csv file, reading only as much of the file as
+    needed.  Rows are numbered as the pandas header parameter numbers them,
+    skipping blank lines.
+
+    :param filepathOrFptr: path to the csv file or a file-like object.
+    :param isHeader: a function that takes a list of the values in a row and
+        returns True if the row is the header row.
+    :returns: the header row number or None if there is no header row.
+    """
+    ispath = not hasattr(filepathOrFptr, 'seek')
+    fptr = open(filepathOrFptr, 'rb') if ispath else filepathOrFptr
+    try:
+        fptr.seek(0)
+        rowNumber = 0
+        for row in csv.reader(codecs.getreader('utf-8-sig')(fptr, errors='replace')):
+            if not row or (len(row) == 1 and not row[0].strip()):
+                continue
+            if isHeader(row):
+                return rowNumber
+            rowNumber += 1
+    except csv.Error:
+        pass
+    finally:
+        if ispath:
+            fptr.close()
+        else:
+            fptr.seek(0)
+    return None
+
+
+def readExcelRows(filepathOrFptr, mimetype):
+    """
+    Iterate through the rows of the first sheet of an excel file.  Xlsx files
+    are read in openpyxl's read-only mode, so the whole file is not held in
+    memory.  Values are converted as pandas converts them.
+
+    :param filepathOrFptr: path to the excel file or a file-like object.
+    :param mimetype: the mimetype of the file.
+    :returns: an iterator of lists of cell values.
+    """
+    if 'openxmlformats' not in mimetype:
+        # Keep the cell types so that a numeric header becomes a numeric
+        # column name, as it does when pandas reads the header itself
+        yield from pd.read_excel(
+            filepathOrFptr, header=None, dtype=object).fillna('').values.tolist()
+        return
+    wb = openpyxl.load_workbook(filepathOrFptr, read_only=True, data_only=True, keep_links=False)
+    try:
+        for row in wb.worksheets[0].iter_rows(values_only=True):
+            yield [
+                '' if value is None else
+                int(value) if isinstance(value, float) and value.is_integer() else
+                value for value in row]
+    finally:
+        wb.close()
+
+
+def readExcelChunks(header, rows, chunkSize=None):
+    """
+    Convert excel rows to dataframes in the same manner as pandas.
+
+    :param header: the header row.
+    :param rows: an iterator of the rows after the header row.
+    :param chunkSize: if None, all rows are converted to a single dataframe.
+        Otherwise, the maximum number of rows in each dataframe.
+    :returns: an iterator of dataframes.
+    """
+    first = True
+    while first or chunkSize:
+        # Rows are only longer than the header if the sheet doesn't record its
+        # dimensions; those values have no column name.
+        chunk = [row[:len(header)] for row in itertools.islice(rows, chunkSize)]
+        if not chunk and not first:
+            return
+        yield TextParser([header] + chunk, header=0, dtype=str).read()
+        first = False
+
+
+def readExcelData(filepathOrFptr, chunkSize=None):
     """
     Read in the data from excel, while attempting to be forgiving about
-    the exact location of the header row.
+    the exact location of the header row.  Excel files are read row by row
+    until the header row is found, and the remaining rows are parsed from
+    there.  Csv files are read until the header row is found and then parsed
+    once.
 
     :param filepath: path to the excel file.
-    :returns: a pandas dataframe of the excel data rows.
+    :param chunkSize: if None, return a single dataframe.  Otherwise, return
+        an iterator of dataframes, each with up to this many rows, so that
+        large files can be processed without holding them in memory.
+    :returns: a pandas dataframe of the excel data rows or an iterator of
+        dataframes.
     :returns: the header row number.
     """
     folderNameField = config.getConfig('folder_name_field', 'TokenID')
     imageNameField = config.getConfig('image_name_field', 'ImageID')
     validateImageIDField = config.getConfig('validate_image_id_field', True)
-    potential_header = 0
-    reader = pd.read_csv
+
+    def isHeader(values):
+        columns = {value.strip() for value in values if isinstance(value, str)}
+        # When the columns include TokenID, ImageID, this is the Header row.
+        # Only one of the fields is required if we aren't validating them
+        # together.
+        return folderNameField in columns and (
+            imageNameField in columns or not validateImageIDField)
+
+    def stripColumns(df):
+        df.rename(columns=lambda x: x.strip() if isinstance(x, str) else x, inplace=True)
+        return df
+
     ispath = not hasattr(filepathOrFptr, 'seek')
     if ispath:
         filepath = filepathOrFptr
@@ -55,30 +165,47 @@ def readExcelData(filepathOrFptr):
         mimetype = magic.from_buffer(fptr.read(16384), mime=True)
         fptr.seek(0)
     if 'excel' in mimetype or 'openxmlformats' in mimetype:
-        reader = pd.read_excel
-    df = reader(filepathOrFptr, header=potential_header, dtype=str)
-    df.rename(columns=lambda x: x.strip() if isinstance(x, str) else x, inplace=True)
-    rows = df.shape[0]
-    while potential_header < rows:
-        # When the columns include TokenID, ImageID, this is the Header row.
-        if folderNameField in df.columns and imageNameField in df.columns:
-            return df, potential_header
-        # only one of the fields is required if we aren't validating them
-        # together
-        if not validateImageIDField and folderNameField in df.columns:
-            return df, potential_header
-        potential_header += 1
-        if not ispath:
-            fptr.seek(0)
-        df = reader(filepathOrFptr, header=potential_header, dtype=str)
-        df.rename(columns=lambda x: x.strip() if isinstance(x, str) else x, inplace=True)
+        rows = readExcelRows(filepathOrFptr, mimetype)
+        potential_header = 0
+        for header in rows:
+            if isHeader(header):
+                chunks = readExcelChunks(header, rows, chunkSize)
+                if chunkSize:
+                    return (stripColumns(df) for df in chunks), potential_header
+                return stripColumns(next(chunks)), potential_header
+            potential_header += 1
+    else:
+        potential_header = findCsvHeaderRow(filepathOrFptr, isHeader)
+        if potential_header is not None:
+            reader = pd.read_csv(
+                filepathOrFptr, header=potential_header, dtype=str, chunksize=chunkSize,
+                iterator=True)
+            if chunkSize:
+                return (stripColumns(df) for df in reader), potential_header
+            with reader:
+                return stripColumns(reader.read()), potential_header
     err = (f'Was expecting columns named {folderNameField} and {imageNameField}.'
            if validateImageIDField else
            f'Was expecting a column named {folderNameField}.')
     raise ValueError(f'Excel file {filepath if ispath else "-"} lacks a header row.  ' + err)
 
 
-def validateDataRow(validator, row, rowNumber, df):
+def getManifestFields():
+    """
+    Get the settings that determine how manifest rows are identified and
+    validated.
+
+    :returns: the folder name field, the image name field, and whether the
+        image name field is validated.
+    """
+    return (
+        config.getConfig('folder_name_field', 'TokenID'),
+        config.getConfig('image_name_field', 'ImageID'),
+        config.getConfig('validate_image_id_field', True),
+    )
+
+
+def validateDataRow(validator, row, rowNumber, df, fields=None):
     """
     Validate a row from a dataframe with a jsonschema validator.
 
@@ -88,13 +215,10 @@ def validateDataRow(validator, row, rowNumber, df):
     :param rowNumber: the 1-based row number within the file for error
         reporting.
     :param df: the pandas dataframe.  Used to determine column number.
+    :param fields: if not None, the results of getManifestFields.
     :returns: None for no errors, otherwise a list of error messages.
     """
-    folderNameField = config.getConfig('folder_name_field', 'TokenID')
-    imageNameField = config.getConfig('image_name_field', 'ImageID')
-    validateImageIDField = config.getConfig('validate_image_id_field', True)
-    if validator.is_valid(row):
-        return
+    folderNameField, imageNameField, validateImageIDField = fields or getManifestFields()
     errors = []
     for error in validator.iter_errors(row):
         try:
@@ -106,6 +230,8 @@ def validateDataRow(validator, row, rowNumber, df):
             errorMsg = f'Invalid row {rowNumber} ({error.message})'
             columnNumber = None
         errors.append(errorMsg)
+    if not errors:
+        return
     if validateImageIDField and row[imageNameField] != '%s_%s_%s' % (
             row[folderNameField], row['Proc_Seq'], row['Slide_ID']):
         errors.append(
@@ -113,35 +239,104 @@ def validateDataRow(validator, row, rowNumber, df):
     return errors
 
 
-def getSchema():
+def loadSchema(schemaFolderId):
     """
-    Return a jsonschema.
+    Load and merge the jsonschemas in the schema folder.
 
+    :param schemaFolderId: the id of the schema folder or None.
     :returns: an object that can be passed to the jsonschema validator.
+    :returns: a set of the ids of the items in the schema folder.
     """
-    schemaFolderId = Setting().get(PluginSettings.WSI_DEID_SCHEMA_FOLDER)
     mergedSchema = {'$schema': 'http://json-schema.org/draft-07/schema', 'oneOf': []}
-
+    itemIds = set()
     if schemaFolderId:
         schemaFolder = Folder().load(schemaFolderId, force=True)
         if schemaFolder:
             max_files = 1000
             for item in Folder().childItems(schemaFolder, limit=max_files):
-                if len(list(Item().childFiles(item, limit=2))) == 1:
-                    if len(list(Item().childFiles(item, limit=2))) == 1:
-                        file = next(Item().childFiles(item, limit=1))
-                        if file['size'] < 2e+6:
-                            try:
-                                currentObject = json.load(File().open(file))
-                                if 'properties' in currentObject:
-                                    mergedSchema['oneOf'].append(currentObject)
-                            except Exception:
-                                pass
+                itemIds.add(item['_id'])
+                files = list(Item().childFiles(item, limit=2))
+                if len(files) == 1 and files[0]['size'] < 2e+6:
+                    try:
+                        currentObject = json.load(File().open(files[0]))
+                        if 'properties' in currentObject:
+                            mergedSchema['oneOf'].append(currentObject)
+                    except Exception:
+                        pass
     if not len(mergedSchema['oneOf']):
-        return json.load(open(SCHEMA_FILE_PATH))
+        return json.load(open(SCHEMA_FILE_PATH)), itemIds
     if len(mergedSchema['oneOf']) == 1:
-        return mergedSchema['oneOf'][0]
-    return mergedSchema
+        return mergedSchema['oneOf'][0], itemIds
+    return mergedSchema, itemIds
+
+
+SchemaCache = {}
+SchemaCacheLock = threading.Lock()
+
+
+def getCompiledSchema():
+    """
+    Get the merged jsonschema, a jsonschema validator, and the compiled
+    column-wise check of the schema.  These are cached until the schema
+    folder setting or the items or files in the schema folder change.
+
+    :returns: a dictionary with schema, validator, and check.  The values
+        are shared and must not be modified.
+    """
+    schemaFolderId = Setting().get(PluginSettings.WSI_DEID_SCHEMA_FOLDER)
+    key = (str(schemaFolderId) if schemaFolderId else None, SCHEMA_FILE_PATH)
+    with SchemaCacheLock:
+        if SchemaCache.get('key') != key:
+            schema, itemIds = loadSchema(schemaFolderId)
+            SchemaCache.clear()
+            SchemaCache.update({
+                'key': key,
+                'itemIds': itemIds,
+                'schema': schema,
+                'validator': jsonschema.Draft6Validator(schema),
+                'check': compileSchemaCheck(schema),
+            })
+        return {name: SchemaCache[name] for name in ('schema', 'validator', 'check')}
+
+
+def schemaChangedEvent(event):
+    """
+    Discard the cached schema when the schema folder setting changes, when an
+    item in the schema folder is added, changed, moved, or removed, or when a
+    file is uploaded to or removed from an item in the schema folder.
+
+    :param event: a Girder setting save or remove, item save or remove, file
+        upload, or file remove event.
+    """
+    doc = event.info
+    if not isinstance(doc, dict):
+        return
+    if event.name.startswith('model.setting.'):
+        if doc.get('key') != PluginSettings.WSI_DEID_SCHEMA_FOLDER:
+            return
+    else:
+        # The cache can be replaced by another thread, so use a consistent view
+        with SchemaCacheLock:
+            if not SchemaCache:
+                return
+            key, itemIds = SchemaCache['key'], SchemaCache['itemIds']
+        if event.name.startswith('model.item.'):
+            if str(doc.get('folderId')) != key[0] and doc.get('_id') not in itemIds:
+                return
+        # Upload events have the file and the upload; remove events the file
+        elif doc.get('file', doc).get('itemId') not in itemIds:
+            return
+    with SchemaCacheLock:
+        SchemaCache.clear()
+
+
+def getSchema():
+    """
+    Return a jsonschema.
+
+    :returns: an object that can be passed to the jsonschema validator.
+    """
+    return copy.deepcopy(getCompiledSchema()['schema'])
 
 
 def getSchemaValidator():
@@ -150,7 +345,272 @@ def getSchemaValidator():
 
     :returns: a validator.
     """
-    return jsonschema.Draft6Validator(getSchema())
+    return getCompiledSchema()['validator']
+
+
+def addManifestEntry(manifest, row, rowAsDict, name, errors, filepath, timestamp,
+                     folderNameField, imageNameField):
+    """
+    Add a manifest row to the manifest.  If an image is listed more than
+    once, the entry from the newest file without errors wins.
+
+    :param manifest: the manifest dictionary to modify.
+    :param row: a named tuple of the row from the manifest dataframe.
+    :param rowAsDict: a dictionary of the row's values.
+    :param name: the image file name listed in the row or None.
+    :param errors: None or a list of validation errors.
+    :param filepath: the path of the manifest.
+    :param timestamp: the time of the manifest.
+    :param folderNameField: the name of the folder name column.
+    :param imageNameField: the name of the image name column.
+    """
+    if not name:
+        if not errors:
+            # If name is none and there are no errors, then we know
+            # that ScannedFileName and InputFile name are not required,
+            # and we still want this row in the manifest to run OCR and
+            # try to match the row to an image in the future
+            manifest['unfiled'] = manifest.get('unfiled', {})
+            imageName = getattr(row, imageNameField, None)
+            if not imageName and getattr(row, folderNameField, None):
+                imageName = TokenOnlyPrefix + getattr(row, folderNameField, None)
+            unlistedEntry = manifest['unfiled'].get(imageName, None)
+            if unlistedEntry is None or unlistedEntry['timestamp'] < timestamp:
+                manifest['unfiled'][imageName] = {
+                    'timestamp': timestamp,
+                    folderNameField: getattr(row, folderNameField, None),
+                    imageNameField: getattr(row, imageNameField, None),
+                    'excel': filepath,
+                    'fields': rowAsDict,
+                    'errors': errors,
+                }
+    elif name not in manifest or (timestamp > manifest[name]['timestamp'] and not errors):
+        manifest[name] = {
+            'timestamp': timestamp,
+            imageNameField: getattr(row, imageNameField, None),
+            folderNameField: getattr(row, folderNameField, None),
+            'name': name,
+            'excel': filepath,
+            'fields': rowAsDict,
+            'errors': errors,
+        }
+
+
+# The number of manifest rows that are parsed at a time
+ManifestChunkSize = 1000
+
+
+def readManifestRows(filepathOrFptr, properties):
+    """
+    Iterate through the data rows of a manifest.  The manifest is parsed in
+    chunks, so that large manifests are not held in memory.
+
+    :param filepathOrFptr: path to the excel or csv file or a file-like
+        object.
+    :param properties: the set of properties in the schema.
+    :returns: an iterator of (row number, row, row dictionary, dataframe),
+        where the row number is the 1-based row within the file, the row is
+        a named tuple from the dataframe, the row dictionary has the row's
+        values excluding empty values and the Index, and the dataframe is the
+        chunk of the manifest with the row.  Rows without values are skipped.
+    """
+    chunks, header_row_number = readExcelData(filepathOrFptr, ManifestChunkSize)
+    rowNumber = header_row_number + 2
+    for df in chunks:
+        for key in ['ScannedFileName', 'InputFileName']:
+            if key in properties and key in df:
+                df[key] = df[key].fillna('')
+        for row in df.itertuples():
+            rowAsDict = dict(row._asdict())
+            # Make sure we don't have any NaNs.  They don't serialize.  Also
+            # remove None values.
+            rowAsDict = {k: v for k, v in rowAsDict.items()
+                         if pd.notnull(v) and v is not None}
+            rowAsDict.pop('Index')
+            if any(val for val in rowAsDict.values()):
+                yield rowNumber, row, rowAsDict, df
+            rowNumber += 1
+
+
+# Schema keywords that don't affect validation
+SchemaAnnotations = {'$schema', '$id', '$comment', 'title', 'description', 'default', 'examples'}
+# Schema keywords that combine subschemas, with a function of the number of
+# valid subschemas and the number of subschemas
+SchemaCombinations = {
+    'oneOf': lambda count, total: count == 1,
+    'anyOf': lambda count, total: count >= 1,
+    'allOf': lambda count, total: count == total,
+}
+
+
+def compileValueCheck(schema):
+    """
+    Compile the schema of a manifest property into a column-wise check.
+    Manifest values are always strings.
+
+    :param schema: the jsonschema of the property.
+    :returns: None if the schema uses keywords that aren't compiled.
+        Otherwise, a function that takes a pandas series of string values and
+        returns a boolean series that is True where the values are valid.
+    """
+    checks = []
+    for key, value in schema.items():
+        if key in SchemaAnnotations:
+            continue
+        if key == 'type':
+            isString = 'string' in (value if isinstance(value, list) else [value])
+            checks.append(lambda series, isString=isString: isString)
+        elif key == 'pattern':
+            # jsonschema matches patterns with re.search
+            checks.append(lambda series, search=re.compile(value).search: (
+                series.map(search).notnull()))
+        elif key == 'enum':
+            checks.append(lambda series, value=value: series.isin(value))
+        elif key == 'const':
+            checks.append(lambda series, value=value: series == value)
+        elif key == 'minLength':
+            checks.append(lambda series, value=value: series.str.len() >= value)
+        elif key == 'maxLength':
+            checks.append(lambda series, value=value: series.str.len() <= value)
+        else:
+            return None
+
+    def check(series):
+        valid = pd.Series(True, index=series.index)
+        for func in checks:
+            valid &= func(series)
+        return valid
+
+    return check
+
+
+def compileSchemaCheck(schema):
+    """
+    Compile a manifest jsonschema into a column-wise check of a dataframe of
+    manifest rows.  Only the keywords used by object schemas of string
+    properties are compiled.  Every row that passes the check is valid
+    according to the schema; rows that fail it may still be valid.
+
+    :param schema: the jsonschema, as returned from getSchema.
+    :returns: None if the schema uses keywords that aren't compiled.
+        Otherwise, a function that takes a dataframe and a dictionary of the
+        keys used in row dictionaries to dataframe column names, and returns a
+        boolean series that is True for rows that are valid.
+    """
+    if not isinstance(schema, dict):
+        return None
+    properties = schema.get('properties', {})
+    required = []
+    additionalProperties = True
+    combinations = []
+    for key, value in schema.items():
+        if key in SchemaAnnotations or key == 'properties' or (key == 'type' and value == 'object'):
+            continue
+        if key == 'required':
+            required = value
+        elif key == 'additionalProperties' and isinstance(value, bool):
+            additionalProperties = value
+        elif key in SchemaCombinations and value:
+            subchecks = [compileSchemaCheck(subschema) for subschema in value]
+            if None in subchecks:
+                return None
+            combinations.append((key, subchecks))
+        else:
+            return None
+    valueChecks = {}
+    for name, propertySchema in properties.items():
+        valueChecks[name] = compileValueCheck(propertySchema)
+        if valueChecks[name] is None:
+            return None
+    return functools.partial(
+        checkManifestRows, properties=properties, required=required,
+        additionalProperties=additionalProperties, valueChecks=valueChecks,
+        combinations=combinations)
+
+
+def checkManifestRows(df, fields, properties, required, additionalProperties, valueChecks,
+                      combinations):
+    """
+    Check a dataframe of manifest rows with a compiled schema.  See
+    compileSchemaCheck.
+
+    :param df: the dataframe.
+    :param fields: a dictionary of the keys used in row dictionaries to
+        dataframe column names.
+    :param properties: the properties of the schema.
+    :param required: a list of required properties.
+    :param additionalProperties: False if only the schema's properties may
+        have values.
+    :param valueChecks: a dictionary of properties to compiled value checks.
+    :param combinations: a list of (keyword, compiled subschema checks) for
+        oneOf, anyOf, and allOf keywords.
+    :returns: a boolean series that is True for rows that are valid.
+    """
+    valid = pd.Series(True, index=df.index)
+    for name in required:
+        valid &= df[fields[name]].notnull() if name in fields else False
+    if not additionalProperties:
+        for name, column in fields.items():
+            if name not in properties:
+                valid &= df[column].isnull()
+    for name, valueCheck in valueChecks.items():
+        if name in fields:
+            series = df[fields[name]]
+            valid &= series.isnull() | valueCheck(series.fillna(''))
+    for key, subchecks in combinations:
+        count = sum(subcheck(df, fields).astype(int) for subcheck in subchecks)
+        valid &= SchemaCombinations[key](count, len(subchecks))
+    return valid
+
+
+class ManifestValidator:
+    """
+    Validate manifest rows.  The schema is compiled once into column-wise
+    checks that are applied to each chunk of a manifest.  Rows that fail
+    these checks, or all rows if the schema can't be compiled, are validated
+    with jsonschema to get error messages.
+    """
+
+    def __init__(self, schema=None):
+        """
+        Prepare to validate manifest rows.
+
+        :param schema: the jsonschema.  If None, use the cached schema from
+            getCompiledSchema.
+        """
+        if schema is None:
+            compiled = getCompiledSchema()
+            self.schema, self.validator, self.check = (
+                compiled['schema'], compiled['validator'], compiled['check'])
+        else:
+            self.schema = schema
+            self.validator = jsonschema.Draft6Validator(schema)
+            self.check = compileSchemaCheck(schema)
+        self.fields = getManifestFields()
+        self.df = None
+        self.valid = None
+
+    def validate(self, row, rowAsDict, rowNumber, df):
+        """
+        Validate a manifest row.
+
+        :param row: the named tuple of the row from the dataframe.
+        :param rowAsDict: a dictionary of row information from the dataframe
+            excluding the Index and empty values.
+        :param rowNumber: the 1-based row number within the file for error
+            reporting.
+        :param df: the pandas dataframe with the row.
+        :returns: None for no errors, otherwise a list of error messages.
+        """
+        if self.check is not None:
+            if df is not self.df:
+                # The row's fields are the keys of the row dictionary for each
+                # column
+                self.valid = self.check(df, dict(zip(row._fields[1:], df.columns)))
+                self.df = df
+            if self.valid.at[row.Index]:
+                return None
+        return validateDataRow(self.validator, rowAsDict, rowNumber, df, self.fields)
 
 
 def readExcelFiles(filelist, ctx):  # noqa
@@ -164,11 +624,10 @@ def readExcelFiles(filelist, ctx):  # noqa
         contains an ImageID, TokenID, name (the scanned file name), excel (the
         path from the excel file), and timestamp (the mtime of the excel file).
     """
-    folderNameField = config.getConfig('folder_name_field', 'TokenID')
-    imageNameField = config.getConfig('image_name_field', 'ImageID')
     manifest = {}
     report = []
-    validator = getSchemaValidator()
+    validator = ManifestValidator()
+    folderNameField, imageNameField, _ = validator.fields
     if 'oneOf' in validator.schema:
         properties = set()
         for subschema in validator.schema['oneOf']:
@@ -192,12 +651,25 @@ def readExcelFiles(filelist, ctx):  # noqa
         else:
             timestamp = os.path.getmtime(filepath)
         ctx.update(message='Reading %s' % os.path.basename(filepath))
+        count = 0
+        totalErrors = []
+        # Entries are only added to the manifest once the whole file has been
+        # read, so a file that can't be parsed contributes nothing
+        entries = []
         try:
-            df, header_row_number = readExcelData(filepathOrFptr)
-            for key in ['ScannedFileName', 'InputFileName']:
-                if key in properties and key in df:
-                    df[key] = df[key].fillna('')
-            df = df.dropna(how='all', axis='columns')
+            for rowNumber, row, rowAsDict, df in readManifestRows(filepathOrFptr, properties):
+                errors = validator.validate(row, rowAsDict, rowNumber, df)
+                name = None
+                for key in {'ScannedFileName', 'InputFileName'}:
+                    name = rowAsDict.pop(key, name)
+                if errors:
+                    for error in errors:
+                        message = 'Error in %s: %s' % (os.path.basename(filepath), error)
+                        ctx.update(message=message)
+                        logger.info(message)
+                    totalErrors.append({'name': name, 'errors': errors})
+                count += 1
+                entries.append((row, rowAsDict, name, errors))
         except Exception as exc:
             if isinstance(exc, ValueError):
                 logger.info(f'Exception: {exc}')
@@ -217,60 +689,10 @@ def readExcelFiles(filelist, ctx):  # noqa
             ctx.update(message=message)
             logger.info(message)
             continue
-        count = 0
-        totalErrors = []
-        for row_num, row in enumerate(df.itertuples()):
-            rowAsDict = dict(row._asdict())
-            # Make sure we don't have any NaNs.  They don't serialize.  Also
-            # remove None values.
-            rowAsDict = {k: v for k, v in rowAsDict.items()
-                         if pd.notnull(v) and v is not None}
-            rowAsDict.pop('Index')
-            if all(not val for val in rowAsDict.values()):
-                continue
-            errors = validateDataRow(validator, rowAsDict, header_row_number + 2 + row_num, df)
-            name = None
-            for key in {'ScannedFileName', 'InputFileName'}:
-                name = rowAsDict.pop(key, name)
-            if errors:
-                for error in errors:
-                    message = 'Error in %s: %s' % (os.path.basename(filepath), error)
-                    ctx.update(message=message)
-                    logger.info(message)
-                totalErrors.append({'name': name, 'errors': errors})
-            count += 1
-            if not name:
-                if not errors:
-                    # If name is none and there are no errors, then we know
-                    # that ScannedFileName and InputFile name are not required,
-                    # and we still want this row in the manifest to run OCR and
-                    # try to match the row to an image in the future
-                    manifest['unfiled'] = manifest.get('unfiled', {})
-                    imageName = getattr(row, imageNameField, None)
-                    if not imageName and getattr(row, folderNameField, None):
-                        imageName = TokenOnlyPrefix + getattr(row, folderNameField, None)
-                    unlistedEntry = manifest['unfiled'].get(imageName, None)
-                    if unlistedEntry is None or unlistedEntry['timestamp'] < timestamp:
-                        manifest['unfiled'][imageName] = {
-                            'timestamp': timestamp,
-                            folderNameField: getattr(row, folderNameField, None),
-                            imageNameField: getattr(row, imageNameField, None),
-                            'excel': filepath,
-                            'fields': rowAsDict,
-                            'errors': errors,
-                        }
-                else:
-                    pass
-            elif name not in manifest or (timestamp > manifest[name]['timestamp'] and not errors):
-                manifest[name] = {
-                    'timestamp': timestamp,
-                    imageNameField: getattr(row, imageNameField, None),
-                    folderNameField: getattr(row, folderNameField, None),
-                    'name': name,
-                    'excel': filepath,
-                    'fields': rowAsDict,
-                    'errors': errors,
-                }
+        for row, rowAsDict, name, errors in entries:
+            addManifestEntry(
+                manifest, row, rowAsDict, name, errors, filepath, timestamp,
+                folderNameField, imageNameField)
         report.append({
             'path': filepath,
             'status': 'parsed',
@@ -337,27 +759,41 @@ def getExisting(imagePath, ctx):
     return None
 
 
-def ingestOneItem(importFolder, imagePath, record, ctx, user, newItems):
+# The number of manifest records whose redaction lists are computed at once
+# and whose metadata is then written in a single bulk operation
+IngestBatchSize = 32
+
+
+def ingestCreateItem(importFolder, imagePath, record, ctx, user, folders=None):
     """
-    Ingest a single image.
+    Create the item and file for a single image listed in a manifest, or
+    determine that it shouldn't be imported.
 
     :param importFolder: the folder to store the image.
     :param imagePath: the path of the image file.
     :param record: a dictionary of information from the excel file.
     :param ctx: a progress context.
     :param user: the user triggering this.
-    :param newItems: a list which should be appended with newly added items
+    :param folders: if not None, a dictionary used to cache the parent
+        folders by name.
+    :returns: the import status and the new item or None if no item was
+        created.
     """
     folderNameField = config.getConfig('folder_name_field', 'TokenID')
     imageNameField = config.getConfig('image_name_field', 'ImageID')
     status = 'added'
     status = getExisting(imagePath, ctx) or status
     if status == 'present':
-        return status
-    parentFolder = Folder().findOne({
-        'name': record[folderNameField], 'parentId': importFolder['_id']})
+        return status, None
+    folders = folders if folders is not None else {}
+    parentFolder = folders.get(record[folderNameField])
     if not parentFolder:
-        parentFolder = Folder().createFolder(importFolder, record[folderNameField], creator=user)
+        parentFolder = Folder().findOne({
+            'name': record[folderNameField], 'parentId': importFolder['_id']})
+        if not parentFolder:
+            parentFolder = Folder().createFolder(
+                importFolder, record[folderNameField], creator=user)
+        folders[record[folderNameField]] = parentFolder
     if not isinstance(imagePath, dict):
         # TODO: (a) use the getTargetAssetstore method from Upload(), (b)
         # ensure that the assetstore is a filesystem assestore.
@@ -369,7 +805,7 @@ def ingestOneItem(importFolder, imagePath, record, ctx, user, newItems):
             name = (record[imageNameField] or '') + '.dcm'
         mimeType = 'image/tiff'
         if Item().findOne({'name': {'$regex': '^%s\\.' % record[imageNameField]}}):
-            return 'duplicate'
+            return 'duplicate', None
         item = Item().createItem(name=name, creator=user, folder=parentFolder)
         stat = os.stat(imagePath)
         file = File().createFile(
@@ -382,23 +818,95 @@ def ingestOneItem(importFolder, imagePath, record, ctx, user, newItems):
         file = File().save(file)
     else:
         # Move an existing item to the parent folder
-        item = Item().move(item, parentFolder)
+        item = Item().move(imagePath, parentFolder)
         # TODO: add metadata marking that this was added
     # Reload the item as it will have changed
     item = Item().load(item['_id'], force=True)
     if isinstance(record['fields'], dict):
-        item = Item().setMetadata(item, {'deidUpload': record['fields']})
-    try:
-        redactList = process.get_standard_redactions(item, record[imageNameField])
-    except Exception:
-        logger.exception('Failed to import %s' % name)
-        Item().remove(item)
-        ctx.update(message='Failed to import %s' % name)
-        return 'failed'
-    item = Item().setMetadata(item, {'redactList': redactList})
-    newItems.append(item['_id'])
-    ctx.update(message='Imported %s' % name)
-    return status
+        item.setdefault('meta', {})['deidUpload'] = record['fields']
+    return status, item
+
+
+def ingestFinishItems(pending, ctx, newItems):
+    """
+    Collect the redaction lists of newly created items and store them and
+    the manifest fields on the items.  Items whose redaction lists could not
+    be computed are removed.
+
+    :param pending: a list of (report entry, item, manifest record, future)
+        tuples, where the future's result is the item's redaction list.  The
+        status of a report entry is changed to 'failed' if the item is
+        removed.
+    :param ctx: a progress context.
+    :param newItems: a list which should be appended with newly added items.
+    """
+    for entry, item, record, future in pending:
+        try:
+            redactList = future.result()
+        except Exception:
+            logger.exception('Failed to import %s' % item['name'])
+            Item().remove(item)
+            ctx.update(message='Failed to import %s' % item['name'])
+            entry['status'] = 'failed'
+            continue
+        metadata = {'redactList': redactList}
+        if isinstance(record['fields'], dict):
+            metadata['deidUpload'] = record['fields']
+        # setMetadata validates the metadata keys, sets the updated time, and
+        # triggers the item save events
+        Item().setMetadata(item, metadata)
+        newItems.append(item['_id'])
+        ctx.update(message='Imported %s' % item['name'])
+
+
+def ingestRecords(importFolder, records, ctx, user, newItems):
+    """
+    Ingest the images listed in manifest records.  Items are created in
+    order, the redaction lists of several items, which require reading each
+    image, are computed concurrently, and the metadata of each batch of items
+    is written as the batch finishes.
+
+    :param importFolder: the folder to store the images.
+    :param records: a list of (report entry, image path, manifest record)
+        tuples.  The status of each report entry is set.
+    :param ctx: a progress context.
+    :param user: the user triggering this.
+    :param newItems: a list which should be appended with newly added items.
+    """
+    imageNameField = config.getConfig('image_name_field', 'ImageID')
+    folders = {}
+    pending = []
+    workers = min(IngestBatchSize, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, imagePath, record in records:
+            entry['status'], item = ingestCreateItem(
+                importFolder, imagePath, record, ctx, user, folders)
+            if item is None:
+                continue
+            pending.append((entry, item, record, executor.submit(
+                process.get_standard_redactions, item, record[imageNameField])))
+            # Keep one batch in progress while the previous one is finished
+            if len(pending) >= IngestBatchSize * 2:
+                ingestFinishItems(pending[:IngestBatchSize], ctx, newItems)
+                pending = pending[IngestBatchSize:]
+        ingestFinishItems(pending, ctx, newItems)
+
+
+def ingestOneItem(importFolder, imagePath, record, ctx, user, newItems):
+    """
+    Ingest a single image.
+
+    :param importFolder: the folder to store the image.
+    :param imagePath: the path of the image file.
+    :param record: a dictionary of information from the excel file.
+    :param ctx: a progress context.
+    :param user: the user triggering this.
+    :param newItems: a list which should be appended with newly added items
+    :returns: the import status.
+    """
+    entry = {}
+    ingestRecords(importFolder, [(entry, imagePath, record)], ctx, user, newItems)
+    return entry['status']
 
 
 def ingestImageToUnfiled(imagePath, unfiledFolder, ctx, user, unfiledItems, uploadInfo):
@@ -465,6 +973,64 @@ def directIngestFindFiles(importPath):
     return excelFiles, imageFiles
 
 
+class ImageFileIndex:
+    """
+    An index of the image files found for import by path and by base name.
+    Each file can only be matched once.  Files are either paths or Girder
+    items, in which case the item name is used as the base name.
+    """
+
+    def __init__(self, imageFiles):
+        """
+        Index a list of image files.
+
+        :param imageFiles: a list of image paths or Girder items.
+        """
+        self.imageFiles = imageFiles
+        self.used = set()
+        self.byPath = {}
+        self.byName = {}
+        for idx, imageFile in enumerate(imageFiles):
+            if isinstance(imageFile, dict):
+                name = imageFile['name']
+            else:
+                self.byPath.setdefault(imageFile, idx)
+                name = os.path.basename(imageFile)
+            self.byName.setdefault(name, collections.deque()).append(idx)
+
+    def match(self, imagePath, name):
+        """
+        Find and use an image file.  If an unused file has the specified
+        path, it is used.  Otherwise, the first unused file with the
+        specified base name is used.
+
+        :param imagePath: the expected path of the file or None.
+        :param name: the base name of the file.
+        :returns: the matched path or item or None if no file matches.
+        """
+        idx = self.byPath.get(imagePath)
+        if idx is None or idx in self.used:
+            idx = None
+            candidates = self.byName.get(name, ())
+            while candidates and candidates[0] in self.used:
+                candidates.popleft()
+            if candidates:
+                idx = candidates.popleft()
+        if idx is None:
+            return None
+        self.used.add(idx)
+        return self.imageFiles[idx]
+
+    def unmatched(self):
+        """
+        Get the image files that haven't been matched.
+
+        :returns: a list of image paths or items in their original order.
+        """
+        return [imageFile for idx, imageFile in enumerate(self.imageFiles)
+                if idx not in self.used]
+
+
 def ingestData(ctx, user=None, walkData=None):  # noqa
     """
     Scan the import folder for image and excel files.  For each excel file,
@@ -504,30 +1070,26 @@ def ingestData(ctx, user=None, walkData=None):  # noqa
     missingImages = []
     report = []
     newItems = []
+    toIngest = []
+    imageIndex = ImageFileIndex(imageFiles)
     for record in manifest.values():
         try:
             imagePath = os.path.join(os.path.dirname(record['excel']), record['name'])
         except TypeError:
             imagePath = None
-        if imagePath not in imageFiles:
-            imagePath = None
-            for testPath in imageFiles:
-                if os.path.basename(testPath) == record['name']:
-                    imagePath = testPath
-                    break
+        imagePath = imageIndex.match(imagePath, record['name'])
         if imagePath is None and not record.get('errors'):
             missingImages.append(record)
             status = 'missing'
             report.append({'record': record, 'status': status, 'path': record['name']})
             continue
-        if imagePath is not None:
-            imageFiles.remove(imagePath)
-        if record.get('errors'):
-            status = 'badentry'
-        else:
-            status = ingestOneItem(importFolder, imagePath, record, ctx, user, newItems)
-        report.append({'record': record, 'status': status, 'path': imagePath})
+        entry = {'record': record, 'status': 'badentry', 'path': imagePath}
+        if not record.get('errors'):
+            toIngest.append((entry, imagePath, record))
+        report.append(entry)
+    ingestRecords(importFolder, toIngest, ctx, user, newItems)
     # imageFiles are images that have no manifest record
+    imageFiles = imageIndex.unmatched()
     unfiledFolder = None
     unfiledFolderId = Setting().get(PluginSettings.WSI_DEID_UNFILED_FOLDER)
     if unfiledFolderId:
@@ -728,7 +1290,6 @@ def exportItems(ctx, user=None, all=False, onlyReport=False):
     exportFolder = Folder().load(exportFolderId, force=True, exc=True)
     report = []
     summary = {}
-    totalByteCount = 0
     if sftp_enabled and not onlyReport:
         job_title = f'Remote export: {user["login"]}, {datetime.datetime.now()}'
         sftp_job = Job().createLocalJob(
@@ -742,16 +1303,37 @@ def exportItems(ctx, user=None, all=False, onlyReport=False):
         )
         Job().scheduleJob(job=sftp_job)
     if export_enabled or onlyReport:
-        for mode in (('measure', 'copy') if not onlyReport else ('measure',)):
-            byteCount = 0
-            for filepath, file in Folder().fileList(exportFolder, user, data=False):
-                byteCount += exportItemsNext(
-                    mode, ctx, byteCount, totalByteCount, filepath, file,
-                    exportPath, user, report, onlyReport=onlyReport)
-            totalByteCount = byteCount
-        logger.info('Exported files')
-        exportNoteRejected(report, user, all, EXPORT_HISTORY_KEY)
-        logger.info('Exported note others')
+        toCopy = []
+        candidates = exportCandidates(exportFolder, user, exportPath or '', all)
+        if not all:
+            # Previously exported items aren't exported again, but are
+            # reported if they are still in the export path
+            candidates += [
+                entry for entry in exportCandidates(
+                    exportFolder, user, exportPath or '', previous=True)
+                if os.path.exists(entry['destPath'])]
+        for entry in candidates:
+            item, destPath = entry['item'], entry['destPath']
+            if os.path.exists(destPath):
+                if os.path.getsize(destPath) == entry['file']['size']:
+                    report.append({'item': item, 'status': 'present'})
+                else:
+                    report.append({'item': item, 'status': 'different'})
+            elif onlyReport:
+                report.append({'item': item, 'status': 'ready'})
+            else:
+                entry['report'] = {'item': item}
+                report.append(entry['report'])
+                toCopy.append(entry)
+        exportRecords = []
+        try:
+            if len(toCopy):
+                exportCopyFiles(ctx, toCopy, user, exportRecords)
+            logger.info('Exported files')
+            exportNoteRejected(report, user, all, EXPORT_HISTORY_KEY, exportRecords=exportRecords)
+            logger.info('Exported note others')
+        finally:
+            saveExportRecords(exportRecords)
         file = exportReport(ctx, exportPath, report, user, onlyReport=onlyReport)
         logger.info('Exported generated report')
         summary = reportSummary(report, file=file)
@@ -763,9 +1345,20 @@ def exportItems(ctx, user=None, all=False, onlyReport=False):
     return summary
 
 
+# The number of SFTP channels used to transfer files at once
+SftpChannels = 4
+# The SSH flow control window used for SFTP transfers.  A large window lets
+# pipelined writes keep a high latency connection busy.
+SftpWindowSize = 64 * 1024 ** 2
+# The size of the chunks read from local files during SFTP transfers
+SftpChunkSize = 1024 ** 2
+
+
 def sftp_items(job):
     """
-    Export items to a remote server via SFTP.
+    Export items to a remote server via SFTP.  Each remote directory is only
+    listed once, and several files are transferred at once over separate
+    channels of one SSH connection.
 
     :param job: A girder job object containing information about how to run the SFTP export
     """
@@ -794,7 +1387,8 @@ def sftp_items(job):
     )
 
     try:
-        sftp_client = get_sftp_client()
+        transport = get_sftp_transport()
+        sftp_client = get_sftp_client(transport)
     except Exception as exc:
         logger.exception(f'Job {job["_id"]} failed.')
         connection_failed_message = (
@@ -803,32 +1397,16 @@ def sftp_items(job):
         Job().updateJob(job, log=connection_failed_message, status=JobStatus.ERROR, notify=True)
         return
     Job().updateJob(job, log='Successfully established a connection with the remote host.\n\n')
-    previous_exported_count = 0
+    channels = queue.Queue()
+    export_records = []
     try:
-        for filepath, file in Folder().fileList(export_folder, user, data=False):
-            try:
-                export_result = sftp_one_item(
-                    filepath,
-                    file,
-                    sftp_destination,
-                    sftp_client,
-                    job,
-                    export_all,
-                    user,
-                    sftp_report,
-                )
-                if export_result == ExportResult.PREVIOUSLY_EXPORTED:
-                    previous_exported_count += 1
-            except Exception:
-                Job().updateJob(
-                    job,
-                    log=f'There was an error transferring {filepath} to the remote destination.\n',
-                    status=JobStatus.ERROR,
-                )
-                # reraise exception to stop looping through files
-                raise
+        previous_exported_count = sftp_transfer_files(
+            job, export_folder, user, export_all, sftp_destination, sftp_client,
+            transport, channels, sftp_report, export_records)
         # create and export the report
-        exportNoteRejected(sftp_report, user, export_all, SFTP_HISTORY_KEY)
+        exportNoteRejected(
+            sftp_report, user, export_all, SFTP_HISTORY_KEY, exportRecords=export_records)
+        saveExportRecords(export_records)
         sftpReport(
             job,
             Setting().get(PluginSettings.WSI_DEID_EXPORT_PATH),
@@ -844,31 +1422,431 @@ def sftp_items(job):
         # log the exception
         logger.exception(f'Job {job["_id"]} failed.')
         # mark the job failed with details about the exception
-        Job.updateJob(
+        Job().updateJob(
             job,
             log=f'Job failed with the following exception: {str(exc)}.',
             status=JobStatus.ERROR,
         )
     finally:
+        saveExportRecords(export_records)
+        while not channels.empty():
+            channels.get().close()
         sftp_client.close()
+        transport.close()
+
 
+def sftp_transfer_files(job, export_folder, user, export_all, destination, sftp_client,
+                        transport, channels, reports, export_records):
+    """
+    Send the files in a folder to a remote server via SFTP.
 
-def get_sftp_client():
-    """Create an instance of paramiko.SFTPClient based on girder config."""
+    :param job: a Girder job. Used to log messages.
+    :param export_folder: the folder to export.
+    :param user: the user who triggered the transfer
+    :param export_all: whether or not to export all items or newly approved items
+    :param destination: the remote folder for the files to be sent to
+    :param sftp_client: a paramiko.SFTPClient used to list remote directories
+    :param transport: the connected paramiko.Transport of the client
+    :param channels: a queue used to pool SFTP channels used for transfers
+    :param reports: array of export info to compile into a report spreadsheet
+    :param export_records: a list to collect the database updates that mark
+        items as exported; see appendExportRecord.
+    :returns: the number of files that were previously exported.
+    """
+    previous_exported_count = 0
+    if not export_all:
+        # Previously exported items aren't listed below; count their files
+        previous_exported_count = sum(1 for _ in exportFileList(
+            export_folder, user, export_all, SFTP_HISTORY_KEY, previous=True))
+    listing = SftpListingCache(sftp_client)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SftpChannels) as executor:
+        pending = []
+        for filepath, file, item in exportFileList(
+                export_folder, user, export_all, SFTP_HISTORY_KEY):
+            try:
+                export_result, transfer = sftp_check_item(
+                    filepath, file, item, destination, listing, job, export_all, reports)
+            except Exception:
+                sftp_transfer_failed(job, filepath)
+                raise
+            if export_result == ExportResult.PREVIOUSLY_EXPORTED:
+                previous_exported_count += 1
+            if transfer:
+                transfer['future'] = executor.submit(
+                    sftp_put_file, transport, channels,
+                    transfer['local_path'], transfer['remote_path'])
+                pending.append(transfer)
+                # Don't get too far ahead of the finished transfers
+                if len(pending) > SftpChannels * 2:
+                    sftp_finish_item(pending.pop(0), job, user, export_records, listing)
+        while pending:
+            sftp_finish_item(pending.pop(0), job, user, export_records, listing)
+    return previous_exported_count
+
+
+def get_sftp_transport():
+    """
+    Create a connected paramiko.Transport based on girder config.  SFTP
+    channels opened on this transport use a large flow control window.
+    """
     host = Setting().get(PluginSettings.WSI_DEID_REMOTE_HOST)
     port = Setting().get(PluginSettings.WSI_DEID_REMOTE_PORT)
     user = Setting().get(PluginSettings.WSI_DEID_REMOTE_USER)
     password = Setting().get(PluginSettings.WSI_DEID_REMOTE_PASSWORD)
 
-    transport = paramiko.Transport((host, port))
+    transport = paramiko.Transport((host, port), default_window_size=SftpWindowSize)
     transport.connect(username=user, password=password)
-    sftp_client = paramiko.SFTPClient.from_transport(transport)
+    return transport
+
+
+def get_sftp_client(transport=None):
+    """
+    Create an instance of paramiko.SFTPClient based on girder config.
+
+    :param transport: if not None, open a new SFTP channel on this connected
+        paramiko.Transport rather than making a new connection.
+    """
+    if transport is None:
+        transport = get_sftp_transport()
+    sftp_client = paramiko.SFTPClient.from_transport(transport, window_size=SftpWindowSize)
     if sftp_client is None:
         msg = 'There was an error connecting to the remote server.'
         raise Exception(msg)
     return sftp_client
 
 
+class SftpListingCache:
+    """
+    A cache of remote directory listings so that each remote directory is
+    only listed once.  Each listing is a dictionary of file names to
+    paramiko.SFTPAttributes.
+    """
+
+    def __init__(self, sftp_client):
+        self.sftp_client = sftp_client
+        self.listings = {}
+
+    def listdir(self, path):
+        """
+        Get the listing of a remote directory.
+
+        :param path: the remote directory.
+        :returns: a dictionary of names to attributes.
+        """
+        if path not in self.listings:
+            self.listings[path] = {
+                entry.filename: entry for entry in self.sftp_client.listdir_attr(path)}
+        return self.listings[path]
+
+    def makedir(self, parent, name):
+        """
+        Make sure a remote directory exists.
+
+        :param parent: the parent remote directory.
+        :param name: the name of the directory within the parent.
+        """
+        if name not in self.listdir(parent):
+            path = os.path.join(parent, name)
+            self.sftp_client.mkdir(path)
+            self.listings[parent][name] = paramiko.SFTPAttributes()
+            self.listings[path] = {}
+
+    def add(self, path, attr):
+        """
+        Record a file that was written to a remote directory.
+
+        :param path: the remote path of the file.
+        :param attr: the paramiko.SFTPAttributes of the file.
+        """
+        parent, name = os.path.split(path)
+        if parent in self.listings:
+            self.listings[parent][name] = attr
+
+
+def sftp_transfer_failed(job, filepath):
+    Job().updateJob(
+        job,
+        log=f'There was an error transferring {filepath} to the remote destination.\n',
+        status=JobStatus.ERROR,
+    )
+
+
+def sftp_check_item(filepath, file, item, destination, listing, job, export_all, reports):
+    """
+    Determine if a file should be sent to a remote server via SFTP.
+
+    :param filepath: the file path of this item
+    :param file: the file document of this item
+    :param item: the item of the file
+    :param destination: the remote folder for the file to be sent to
+    :param listing: an SftpListingCache for the remote server
+    :param job: a Girder job. Used to log messages.
+    :param export_all: whether or not to export all items or newly approved items
+    :param reports: array of export info to compile into a report spreadsheet
+    :return: a member of enum ExportResult or None if the file should be
+        transferred, and, if the file should be transferred, a dictionary
+        with the item, file, local_path, remote_path, file_name, filepath, and
+        a report record that is added to the reports.
+    """
+    file_path_segments = filepath.split(os.path.sep)
+    image_dir = file_path_segments[-2]
+    file_name = file_path_segments[-1]
+    full_remote_path = os.path.join(destination, image_dir, file_name)
+    tile_source_path = getExportSourcePath(item, file)
+    if not tile_source_path:
+        Job().updateJob(job, log=f'Unable to locate tile source for {file_name}.\n')
+        return ExportResult.EXPORT_FAILED, None
+    if skipExport(item, export_all, SFTP_HISTORY_KEY):
+        return ExportResult.PREVIOUSLY_EXPORTED, None
+
+    listing.makedir(destination, image_dir)
+    existing_files = listing.listdir(os.path.join(destination, image_dir))
+    if file_name in existing_files:
+        if existing_files[file_name].st_size == file['size']:
+            reports.append({'item': item, 'status': 'present'})
+        else:
+            reports.append({'item': item, 'status': 'different'})
+        Job().updateJob(
+            job,
+            log=f'A file with the name {file_name} already exists at the remote destination.\n',
+        )
+        return ExportResult.ALREADY_EXISTS_AT_DESTINATION, None
+    report = {'item': item}
+    reports.append(report)
+    return None, {
+        'item': item,
+        'file': file,
+        'filepath': filepath,
+        'file_name': file_name,
+        'local_path': tile_source_path,
+        'remote_path': full_remote_path,
+        'report': report,
+    }
+
+
+def sftp_send(sftp_client, local_path, remote_path, offset=0, hasher=None):
+    """
+    Write a local file to a remote file using pipelined writes, starting at
+    an offset.
+
+    :param sftp_client: a paramiko.SFTPClient.
+    :param local_path: the path of the local file.
+    :param remote_path: the path of the remote file.  If offset is not 0,
+        this must exist and be at least offset bytes long.
+    :param offset: the position to start writing.
+    :param hasher: if not None, a hashlib object that is updated with the
+        whole contents of the local file, including the part before the
+        offset.
+    """
+    with open(local_path, 'rb') as fptr:
+        if hasher:
+            remaining = offset
+            while remaining:
+                data = fptr.read(min(SftpChunkSize, remaining))
+                hasher.update(data)
+                remaining -= len(data)
+        fptr.seek(offset)
+        with sftp_client.file(remote_path, 'r+b' if offset else 'wb') as fr:
+            fr.seek(offset)
+            fr.set_pipelined(True)
+            while True:
+                data = fptr.read(SftpChunkSize)
+                if not data:
+                    break
+                if hasher:
+                    hasher.update(data)
+                fr.write(data)
+
+
+def sftp_verify_hash(sftp_client, remote_path, hasher):
+    """
+    Compare the hash of a remote file with the hash of what was sent.  This
+    requires a server that supports the check-file extension; if the server
+    doesn't support it, the file is not checked.
+
+    :param sftp_client: a paramiko.SFTPClient.
+    :param remote_path: the path of the remote file.
+    :param hasher: a hashlib sha256 object of the local file.
+    :returns: False if the hash doesn't match.
+    """
+    try:
+        with sftp_client.file(remote_path, 'rb') as fr:
+            remote_hash = fr.check('sha256')
+    except OSError:
+        logger.info('Remote server cannot compute file hashes; not checking %s', remote_path)
+        return True
+    return remote_hash == hasher.digest()
+
+
+def sftp_partial_info(local_path):
+    """
+    Describe the source of a partially transferred file so that a later
+    transfer only resumes it if the source is unchanged.
+
+    :param local_path: the path of the local file.
+    :returns: a dictionary with the size and modification time of the file.
+    """
+    stat = os.stat(local_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def sftp_write_partial_info(sftp_client, remote_path, info):
+    """
+    Store the description of the source of a partial remote file next to it.
+
+    :param sftp_client: a paramiko.SFTPClient.
+    :param remote_path: the path of the partial remote file.
+    :param info: the dictionary from sftp_partial_info.
+    """
+    with sftp_client.file(remote_path + '.info', 'wb') as fr:
+        fr.write(json.dumps(info).encode())
+
+
+def sftp_remove_partial_info(sftp_client, remote_path):
+    """
+    Remove the description of the source of a partial remote file.
+
+    :param sftp_client: a paramiko.SFTPClient.
+    :param remote_path: the path of the partial remote file.
+    """
+    try:
+        sftp_client.remove(remote_path + '.info')
+    except OSError:
+        pass
+
+
+def sftp_resume_offset(sftp_client, remote_path, info):
+    """
+    Determine where to resume writing a partially transferred file.
+
+    :param sftp_client: a paramiko.SFTPClient.
+    :param remote_path: the path of the partial remote file.
+    :param info: the dictionary from sftp_partial_info for the local file.
+    :returns: the size of the partial file if it exists, was written from a
+        local file of the same size and modification time, and is not larger
+        than the local file, otherwise 0.
+    """
+    try:
+        offset = sftp_client.stat(remote_path).st_size or 0
+        if not offset:
+            return 0
+        with sftp_client.file(remote_path + '.info', 'rb') as fr:
+            partialInfo = json.loads(fr.read())
+    except (OSError, ValueError):
+        return 0
+    if partialInfo != info:
+        logger.info('Source of %s has changed; not resuming the transfer', remote_path)
+        return 0
+    return offset if offset <= info['size'] else 0
+
+
+# The number of times a transfer is attempted before giving up.  Each
+# attempt resumes where the previous one stopped.
+SftpAttempts = 3
+
+
+def sftp_put_file(transport, channels, local_path, remote_path):
+    """
+    Send a file to a remote server via SFTP using pipelined writes.  The file
+    is written to a hidden temporary name in the remote directory and renamed
+    when complete.  If a temporary file is left from an earlier transfer of
+    the same local file, only the missing bytes are sent.  The size and
+    modification time of the local file are stored next to the temporary
+    file to determine this.  If the sftp_verify_hash setting is True, a hash
+    computed while sending the file is compared to the remote file's hash
+    before it is renamed.
+
+    :param transport: a connected paramiko.Transport.
+    :param channels: a queue of idle paramiko.SFTPClient channels on the
+        transport.  If it is empty, a new channel is opened.  The channel is
+        returned to the queue when done.
+    :param local_path: the path of the local file.
+    :param remote_path: the path of the remote file.
+    :returns: the paramiko.SFTPAttributes of the remote file.
+    """
+    remote_dir, remote_name = os.path.split(remote_path)
+    temp_path = os.path.join(remote_dir, '.%s.partial' % remote_name)
+    info = sftp_partial_info(local_path)
+    size = info['size']
+    verify = config.getConfig('sftp_verify_hash')
+    try:
+        sftp_client = channels.get_nowait()
+    except queue.Empty:
+        sftp_client = get_sftp_client(transport)
+    try:
+        for attempt in range(SftpAttempts):
+            hasher = hashlib.sha256() if verify else None
+            offset = sftp_resume_offset(sftp_client, temp_path, info)
+            if offset:
+                logger.info('Resuming transfer of %s at %d of %d bytes', remote_path, offset, size)
+            else:
+                sftp_write_partial_info(sftp_client, temp_path, info)
+            try:
+                sftp_send(sftp_client, local_path, temp_path, offset, hasher)
+                break
+            except Exception:
+                if attempt + 1 == SftpAttempts or not transport.is_active():
+                    raise
+                logger.exception('Transfer of %s failed; retrying', remote_path)
+                sftp_client.close()
+                sftp_client = get_sftp_client(transport)
+        stat = sftp_client.stat(temp_path)
+        if stat.st_size != size or (hasher and not sftp_verify_hash(
+                sftp_client, temp_path, hasher)):
+            sftp_client.remove(temp_path)
+            sftp_remove_partial_info(sftp_client, temp_path)
+            msg = f'The transferred file {remote_path} does not match the local file.'
+            raise Exception(msg)
+        try:
+            sftp_client.posix_rename(temp_path, remote_path)
+        except OSError:
+            sftp_client.rename(temp_path, remote_path)
+        sftp_remove_partial_info(sftp_client, temp_path)
+    except Exception:
+        sftp_client.close()
+        raise
+    channels.put(sftp_client)
+    return stat
+
+
+def sftp_finish_item(transfer, job, user, export_records, listing):
+    """
+    Wait for a file transfer to finish and record that the item was
+    exported.
+
+    :param transfer: a dictionary returned from sftp_check_item with a future
+        for the transfer.
+    :param job: a Girder job. Used to log messages.
+    :param user: the user who triggered the transfer
+    :param export_records: a list to collect the database update that marks
+        the item as exported; see appendExportRecord.
+    :param listing: the SftpListingCache for the remote server.  The
+        transferred file is added to it.
+    :return: ExportResult.EXPORTED_SUCCESSFULLY.
+    """
+    file_name = transfer['file_name']
+    try:
+        transferred_file_stat = transfer['future'].result()
+        if transferred_file_stat.st_size != transfer['file']['size']:
+            msg = f'There was an error transferring file {file_name} to remote destination.'
+            raise Exception(msg)
+    except Exception:
+        sftp_transfer_failed(job, transfer['filepath'])
+        raise
+    listing.add(transfer['remote_path'], transferred_file_stat)
+    Job().updateJob(
+        job,
+        log=f'File {file_name} successfully transferred to the remote destination.\n',
+    )
+    new_export_record = appendExportRecord(
+        transfer['item'], user, SFTP_HISTORY_KEY, exportRecords=export_records)
+    transfer['report'].update({
+        'status': 'finished',
+        'time': new_export_record['time'],
+    })
+    return ExportResult.EXPORTED_SUCCESSFULLY
+
+
 def getSourcePath(item):
     """
     Get the large image path for a Girder File.
@@ -894,7 +1872,90 @@ def skipExport(item, all, metadataProperty):
     return not all and item.get('meta', {}).get(metadataProperty)
 
 
-def appendExportRecord(item, user, metadataProperty, status=None):
+def ensureExportIndices():
+    """
+    Ensure that the item indices used to find items that haven't been
+    exported exist.
+    """
+    for metadataProperty in (EXPORT_HISTORY_KEY, SFTP_HISTORY_KEY):
+        idx = ([('folderId', 1), ('meta.' + metadataProperty, 1)], {})
+        if idx not in Item()._indices:
+            Item().ensureIndex(idx)
+
+
+def exportFolderPaths(folder, user):
+    """
+    Get the paths of a folder and all of its descendant folders that a user
+    can read.  Each level of the folder tree is found with one query.
+
+    :param folder: the top folder.
+    :param user: the user triggering this.
+    :returns: a dictionary with folder ids as keys and paths starting with the
+        name of the top folder as values.
+    """
+    paths = {folder['_id']: folder['name']}
+    level = [folder['_id']]
+    while level:
+        children = Folder().findWithPermissions(
+            {'parentId': {'$in': level}, 'parentCollection': 'folder'},
+            fields=['name', 'parentId'], user=user, level=AccessType.READ)
+        level = []
+        for child in children:
+            paths[child['_id']] = os.path.join(paths[child['parentId']], child['name'])
+            level.append(child['_id'])
+    return paths
+
+
+def exportItemList(folder, user, all, metadataProperty, folderPaths=None, previous=False):
+    """
+    List the items within a folder that should be exported.  Unless all items
+    are exported, only items without an export record are found; this uses
+    the indices from ensureExportIndices.
+
+    :param folder: the top folder.
+    :param user: the user triggering this.
+    :param all: True to list all items.  False to only list items that have
+        not been previously exported.
+    :param metadataProperty: the metadata property that holds export history.
+    :param folderPaths: if not None, the result of exportFolderPaths for the
+        folder.
+    :param previous: if True, list the items that have been previously
+        exported instead.  all is ignored.
+    :returns: a list of items.
+    """
+    if folderPaths is None:
+        folderPaths = exportFolderPaths(folder, user)
+    query = {'folderId': {'$in': list(folderPaths)}}
+    if previous:
+        query['meta.' + metadataProperty] = {'$nin': [None, []]}
+    elif not all:
+        query['meta.' + metadataProperty] = {'$in': [None, []]}
+    # Eagerly evaluate this list, as the cursor can time out on long exports
+    return list(Item().find(query))
+
+
+def exportFileList(folder, user, all, metadataProperty, previous=False):
+    """
+    List the files of the items within a folder that should be exported.
+
+    :param folder: the top folder.
+    :param user: the user triggering this.
+    :param all: True to list all items.  False to only list items that have
+        not been previously exported.
+    :param metadataProperty: the metadata property that holds export history.
+    :param previous: if True, list the files of items that have been
+        previously exported instead.  all is ignored.
+    :returns: an iterator of (path, file, item), where the path is the same
+        as that from Folder().fileList.
+    """
+    folderPaths = exportFolderPaths(folder, user)
+    for item in exportItemList(folder, user, all, metadataProperty, folderPaths, previous):
+        for filepath, file in Item().fileList(
+                item, user, path=folderPaths[item['folderId']], data=False):
+            yield filepath, file, item
+
+
+def appendExportRecord(item, user, metadataProperty, status=None, exportRecords=None):
     """
     Append information about the current export to an item's exported record. Return the most
     recent export record.
@@ -902,6 +1963,11 @@ def appendExportRecord(item, user, metadataProperty, status=None):
     :param item: the Girder item to add export history to
     :param user: the user performing this export
     :metadataProperty: the Girder item property that holds export history
+    :param status: an optional status to add to the record.
+    :param exportRecords: if None, the item is saved.  Otherwise, this is a
+        list that the database update is appended to and the item is only
+        modified in memory.  Call saveExportRecords with the list to store
+        the records.
     """
     from . import __version__
     exportedRecord = item.get('meta', {}).get(metadataProperty, [])
@@ -913,133 +1979,283 @@ def appendExportRecord(item, user, metadataProperty, status=None):
     if status:
         newExportRecord['status'] = status
     exportedRecord.append(newExportRecord)
-    item = Item().setMetadata(item, {metadataProperty: exportedRecord})
+    if exportRecords is None:
+        item = Item().setMetadata(item, {metadataProperty: exportedRecord})
+        return newExportRecord
+    item.setdefault('meta', {})[metadataProperty] = exportedRecord
+    item['updated'] = datetime.datetime.utcnow()
+    exportRecords.append(pymongo.UpdateOne({'_id': item['_id']}, {'$set': {
+        'meta.' + metadataProperty: exportedRecord,
+        'updated': item['updated'],
+    }}))
     return newExportRecord
 
 
-def sftp_one_item(filepath, file, destination, sftp_client, job, export_all, user, reports):
+def saveExportRecords(exportRecords):
     """
-    Send a file to a remote server via SFTP.
+    Store export records collected by appendExportRecord with a single bulk
+    write.
 
-    :param filepath: the file path of this item
-    :param file: the file document of this item
-    :param destination: the remote folder for the file to be sent to
-    :param sftp_client: an instance of paramiko.SFTPClient
-    :param job: a Girder job. Used to log messages.
-    :param export_all: whether or not to export all items or newly approved items
-    :param user: the user who triggered the transfer
-    :param reports: array of export info to compile into a report spreadsheet
-    :return: a member of enum ExportResult
+    :param exportRecords: a list of database updates.  This is emptied.
     """
-    file_path_segments = filepath.split(os.path.sep)
-    image_dir = file_path_segments[-2]
-    file_name = file_path_segments[-1]
-    full_remote_path = os.path.join(destination, image_dir, file_name)
-    item = Item().load(file['itemId'], force=True, exc=False)
-    tile_source_path = getSourcePath(item)
-    if not tile_source_path:
-        Job().updateJob(job, log=f'Unable to locate tile source for {file_name}.\n')
-        return ExportResult.EXPORT_FAILED
-    if skipExport(item, export_all, SFTP_HISTORY_KEY):
-        return ExportResult.PREVIOUSLY_EXPORTED
+    if exportRecords:
+        Item().collection.bulk_write(exportRecords, ordered=False)
+        del exportRecords[:]
 
-    remote_dirs = sftp_client.listdir(destination)
-    if image_dir not in remote_dirs:
-        sftp_client.mkdir(os.path.join(destination, image_dir))
 
-    existing_files = sftp_client.listdir(os.path.join(destination, image_dir))
-    if file_name in existing_files:
-        existing_file_stat = sftp_client.stat(full_remote_path)
-        if existing_file_stat.st_size == file['size']:
-            reports.append({'item': item, 'status': 'present'})
-        else:
-            reports.append({'item': item, 'status': 'different'})
-        Job().updateJob(
-            job,
-            log=f'A file with the name {file_name} already exists at the remote destination.\n',
-        )
-        return ExportResult.ALREADY_EXISTS_AT_DESTINATION
-    else:
-        transferred_file_stat = sftp_client.put(tile_source_path, full_remote_path)
-        if transferred_file_stat.st_size == file['size']:
-            Job().updateJob(
-                job,
-                log=f'File {file_name} successfully transferred to the remote destination.\n',
-            )
-            new_export_record = appendExportRecord(item, user, SFTP_HISTORY_KEY)
-            reports.append({
-                'item': item,
-                'status': 'finished',
-                'time': new_export_record['time'],
-            })
-            return ExportResult.EXPORTED_SUCCESSFULLY
-        else:
-            msg = f'There was an error transferring file {file_name} to remote destination.'
-            raise Exception(msg)
+@functools.lru_cache(maxsize=10000)
+def _probeImageFile(itemId, fileId, size, mtime):
+    """
+    Open the large image file of an item.  Successful results are cached by
+    the file's id, size, and modification time; failures raise an exception
+    so they are not cached and the file is probed again next time.
+
+    :param itemId: the id of the item.
+    :param fileId: the id of the large image file.
+    :param size: the size of the file.
+    :param mtime: the modification time of the file, if known.
+    :returns: True.
+    """
+    item = Item().load(itemId, force=True)
+    ImageItem().tileSource(item)
+    return True
 
 
-def exportItemsNext(mode, ctx, byteCount, totalByteCount, filepath, file,
-                    exportPath, user, report, onlyReport=False):
+def probeImageFile(fileId):
     """
-    Export an item or report on its size.
+    Check if the large image file of an item can be opened.
 
-    :param mode: either 'measure' or 'copy'.
-    :param ctx: a progress context.
-    :param byteCount: the number of bytes copies so far.
-    :param totalByteCount: the total number of bytes needed to be copies.
-    :param filepath: the file path of this item.
-    :param file: the file document of this item.
-    :param exportPath: the destination for the export.
+    :param fileId: the id of the large image file.
+    :returns: True if the file can be opened as a large image.
+    """
+    try:
+        file = File().load(fileId, force=True)
+        return _probeImageFile(
+            str(file['itemId']), str(file['_id']), file.get('size'), file.get('mtime'))
+    except Exception:
+        return False
+
+
+def isImageItem(item):
+    """
+    Determine if an item is a large image without opening it if possible.
+    Items whose large image has been created list the tile source that read
+    it; otherwise the file is probed.
+
+    :param item: a Girder item.
+    :returns: True if the item is a large image.
+    """
+    largeImage = item.get('largeImage')
+    if not largeImage or not largeImage.get('fileId') or largeImage.get('expected'):
+        return False
+    if largeImage.get('sourceName'):
+        return True
+    return probeImageFile(str(largeImage['fileId']))
+
+
+def getExportSourcePath(item, file):
+    """
+    Get the local path of the image to export for a file.  When the file is
+    the item's large image file and is stored locally, this avoids opening a
+    tile source.
+
+    :param item: the girder item of the file.
+    :param file: the girder file document.
+    :returns: the path of the image or None if it can't be exported.
+    """
+    if not item or 'largeImage' not in item:
+        return None
+    if str(item['largeImage'].get('fileId')) == str(file['_id']):
+        try:
+            path = File().getLocalFilePath(file)
+            if path and os.path.isfile(path):
+                return path
+        except Exception:
+            pass
+    return getSourcePath(item)
+
+
+def exportCandidates(exportFolder, user, exportPath, all=True, previous=False):
+    """
+    List the files that could be exported.
+
+    :param exportFolder: the folder to export.
     :param user: the user triggering this.
-    :param report: a collected report list.
-    :param onlyReport: True to only generate the report, not to actually do the
-        export.
-    :returns: the number of bytes that are copied.  If mode is measure, no
-        copying is actually done.
+    :param exportPath: the destination for the export.
+    :param all: True to list all items.  False to only list items that have
+        not been previously exported.
+    :param previous: if True, list the files of items that have been
+        previously exported instead.  all is ignored.
+    :returns: a list of dictionaries with filepath (the path relative to the
+        export folder), file, item, sourcePath, and destPath.
     """
-    item = Item().load(file['itemId'], force=True, exc=False)
-    sourcePath = getSourcePath(item)
-    if not sourcePath or skipExport(item, all, EXPORT_HISTORY_KEY):
-        return 0
-    filepath = filepath.split(os.path.sep, 1)[1]
-    if mode == 'copy':
-        ctx.update(message='Exporting %s' % filepath, total=totalByteCount, current=byteCount)
-    destPath = os.path.join(exportPath, filepath)
-    destFolder = os.path.dirname(destPath)
-    if os.path.exists(destPath):
-        if mode == 'copy' or onlyReport:
-            if os.path.getsize(destPath) == file['size']:
-                report.append({'item': item, 'status': 'present'})
+    candidates = []
+    for filepath, file, item in exportFileList(
+            exportFolder, user, all, EXPORT_HISTORY_KEY, previous):
+        sourcePath = getExportSourcePath(item, file)
+        if not sourcePath:
+            continue
+        filepath = filepath.split(os.path.sep, 1)[1]
+        candidates.append({
+            'filepath': filepath,
+            'file': file,
+            'item': item,
+            'sourcePath': sourcePath,
+            'destPath': os.path.join(exportPath, filepath),
+        })
+    return candidates
+
+
+# Linux ioctl to make a copy-on-write clone of a file
+FICLONE = 0x40049409
+# The size of each chunk copied so that progress can be reported
+CopyChunkSize = 64 * 1024 ** 2
+
+
+def copyFileReflink(fsrc, fdst):
+    """
+    Try to make the destination a copy-on-write clone of the source.
+
+    :param fsrc: the open source file.
+    :param fdst: the open destination file.
+    :returns: True if the file was cloned.
+    """
+    try:
+        import fcntl
+
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except Exception:
+        return False
+    return True
+
+
+def copyFileKernel(fsrc, fdst, size, progress):
+    """
+    Copy a file within the kernel using copy_file_range or, if that isn't
+    supported between the source and destination, sendfile.
+
+    :param fsrc: the open source file.
+    :param fdst: the open destination file.
+    :param size: the size of the source file.
+    :param progress: a function that is called with the number of bytes
+        copied in each chunk.
+    :returns: the number of bytes copied.  This is less than size if neither
+        method could copy the whole file.
+    """
+    copied = 0
+    for method in ('copy_file_range', 'sendfile'):
+        if copied >= size or not hasattr(os, method):
+            continue
+        try:
+            # sendfile writes at the destination's file position
+            os.lseek(fdst.fileno(), copied, os.SEEK_SET)
+            while copied < size:
+                count = min(CopyChunkSize, size - copied)
+                if method == 'copy_file_range':
+                    count = os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), count, copied, copied)
+                else:
+                    count = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, count)
+                if not count:
+                    break
+                copied += count
+                progress(count)
+        except OSError:
+            pass
+    return copied
+
+
+def copyFile(sourcePath, destPath, progress=None):
+    """
+    Copy a file, preserving its timestamps.  If possible, the copy is a
+    reflink (copy-on-write clone) of the source.  Otherwise, the data is
+    copied in the kernel if supported, falling back to a user-space copy.  If
+    the copy fails, the partial destination is removed.
+
+    :param sourcePath: the path of the source file.
+    :param destPath: the path of the destination file.
+    :param progress: if not None, a function that is called with the number
+        of bytes copied since it was last called.
+    """
+    progress = progress or (lambda count: None)
+    try:
+        with open(sourcePath, 'rb') as fsrc, open(destPath, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            if copyFileReflink(fsrc, fdst):
+                copied = size
+                progress(size)
             else:
-                report.append({'item': item, 'status': 'different'})
-        return 0
-    else:
-        if mode == 'copy':
-            os.makedirs(destFolder, exist_ok=True)
-            # When run in a docker in Windows, cp is around twice as fast as
-            # shutil.copy2 for Python < 3.8.  For Python >=3.8, shutil.copy2 is
-            # even slower (by about a factor of 3 from shutil in Python < 3.8),
-            # seemingly because the internal call to posix.sendfile is terrible
-            # in a linux docker under Windows.
-            try:
-                subprocess.check_call(['cp', '--preserve=timestamps', sourcePath, destPath])
-            except Exception:
-                shutil.copy2(sourcePath, destPath)
-            newExportRecord = appendExportRecord(item, user, EXPORT_HISTORY_KEY)
-            report.append({
-                'item': item,
+                copied = copyFileKernel(fsrc, fdst, size, progress)
+            if copied < size:
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                fdst.truncate()
+                while True:
+                    data = fsrc.read(CopyChunkSize)
+                    if not data:
+                        break
+                    fdst.write(data)
+                    progress(len(data))
+        stat = os.stat(sourcePath)
+        os.utime(destPath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    except BaseException:
+        if os.path.exists(destPath):
+            os.unlink(destPath)
+        raise
+
+
+# The maximum number of files copied at once during local export
+ExportWorkers = 4
+
+
+def exportCopyFiles(ctx, toCopy, user, exportRecords):
+    """
+    Copy files to the export path, several at once, reporting progress in
+    bytes.  Each copied item is marked as exported.
+
+    :param ctx: a progress context.
+    :param toCopy: a list of export candidates as returned from
+        exportCandidates, each with a 'report' dictionary that is updated
+        when the file is copied.
+    :param user: the user triggering this.
+    :param exportRecords: a list to collect the database updates that mark
+        items as exported; see appendExportRecord.
+    """
+    # The export copies the source path, which can differ in size from the
+    # girder file, such as when the file is not stored locally
+    totalByteCount = sum(os.path.getsize(entry['sourcePath']) for entry in toCopy)
+    byteCount = [0]
+    lock = threading.Lock()
+
+    def progress(count):
+        with lock:
+            byteCount[0] += count
+
+    def copyOne(entry):
+        os.makedirs(os.path.dirname(entry['destPath']), exist_ok=True)
+        copyFile(entry['sourcePath'], entry['destPath'], progress)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=ExportWorkers) as executor:
+        futures = [executor.submit(copyOne, entry) for entry in toCopy]
+        for entry, future in zip(toCopy, futures):
+            while True:
+                ctx.update(message='Exporting %s' % entry['filepath'],
+                           total=totalByteCount, current=byteCount[0])
+                try:
+                    future.result(timeout=1)
+                    break
+                except concurrent.futures.TimeoutError:
+                    pass
+            newExportRecord = appendExportRecord(
+                entry['item'], user, EXPORT_HISTORY_KEY, exportRecords=exportRecords)
+            entry['report'].update({
                 'status': 'finished',
                 'time': newExportRecord['time'],
             })
-        elif onlyReport:
-            report.append({
-                'item': item,
-                'status': 'ready',
-            })
-        return file['size']
+    ctx.update(total=totalByteCount, current=byteCount[0])
 
 
-def exportNoteRejected(report, user, all, metadataProperty, allFiles=True):
+def exportNoteRejected(report, user, all, metadataProperty, allFiles=True, exportRecords=None):
     """
     Note items that are rejected or quarantined, collecting them for a report.
 
@@ -1049,7 +2265,13 @@ def exportNoteRejected(report, user, all, metadataProperty, allFiles=True):
         not been previously exported.
     :param allFiles: True to report on all files in all folders.  False to only
         report rejected and quarantined items.
+    :param exportRecords: if None, the export records are stored when done.
+        Otherwise, a list to collect the database updates; see
+        appendExportRecord.
     """
+    storeRecords = exportRecords is None
+    if storeRecords:
+        exportRecords = []
     shortList = [
         ('rejected', PluginSettings.HUI_REJECTED_FOLDER),
         ('quarantined', PluginSettings.HUI_QUARANTINE_FOLDER),
@@ -1061,20 +2283,18 @@ def exportNoteRejected(report, user, all, metadataProperty, allFiles=True):
     for status, settingkey in (shortList if not allFiles else longList):
         folderId = Setting().get(settingkey)
         folder = Folder().load(folderId, force=True, exc=True)
-        for _, file in Folder().fileList(folder, user, data=False):
-            item = Item().load(file['itemId'], force=True, exc=True)
-            try:
-                ImageItem().tileSource(item)
-            except Exception:
-                continue
-            if skipExport(item, all, metadataProperty):
+        for item in exportItemList(folder, user, all, metadataProperty):
+            if not isImageItem(item):
                 continue
-            newExportRecord = appendExportRecord(item, user, metadataProperty, status=status)
+            newExportRecord = appendExportRecord(
+                item, user, metadataProperty, status=status, exportRecords=exportRecords)
             report.append({
                 'item': item,
                 'status': status,
                 'time': newExportRecord['time'],
             })
+    if storeRecords:
+        saveExportRecords(exportRecords)
 
 
 def buildExportDataSet(report):
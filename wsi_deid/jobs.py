@@ -1,15 +1,29 @@
-import concurrent.futures
-import os
+import datetime
+import socket
+import threading
 
+import psutil
 from girder import logger
+from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.user import User
 from girder.utility.progress import noProgress
 from girder_jobs.models.job import Job, JobStatus
 
-from . import config, matching_api
+from . import config, matching_api, ocr
 from .constants import TokenOnlyPrefix
-from .process import get_image_barcode, get_image_name, get_image_text, refile_image
+from .process import (get_image_barcode, get_image_name, get_image_text, get_images_text,
+                      refile_image)
+
+# The number of items whose label images are gathered for batched OCR
+OCRBatchItems = 8
+
+# Batch process jobs record which server process runs them and update a
+# heartbeat this often (in seconds).  When the plugin is loaded, a job is only
+# resumed if it was run by a process on this host that no longer exists or,
+# for jobs run on other hosts, if its heartbeat is older than the stale time.
+BatchJobHeartbeat = 60
+BatchJobStaleTime = 600
 
 
 def start_ocr_item_job(job):
@@ -61,6 +75,49 @@ def get_label_text_for_item(itemId, job):
         return ({}, {})
 
 
+def get_label_text_for_items(itemIds, job):
+    """
+    Find barcodes and label text for a list of items.  OCR is run on batches
+    of items at once, spread across the OCR worker processes.
+
+    :param itemIds: a list of girder item ids.
+    :param job: a girder job used for logging.
+    :returns: a list with one entry per item id.  Each entry is None if the
+        item doesn't exist or a tuple of the label text and barcodes.
+    """
+    results = [None] * len(itemIds)
+    # Gather enough items that each OCR worker process has work
+    batchItems = OCRBatchItems * ocr.pool_size()
+    for start in range(0, len(itemIds), batchItems):
+        batch = []
+        for idx in range(start, min(start + batchItems, len(itemIds))):
+            item = Item().load(itemIds[idx], force=True)
+            if item is None:
+                continue
+            Job().updateJob(job, log=f'Finding label text for file: {item["name"]}.\n')
+            try:
+                label_barcode = get_image_barcode(item)
+                if len(label_barcode) > 0:
+                    message = f'Found label barcode for file {item["name"]}: {label_barcode}.\n'
+                    Job().updateJob(job, log=message)
+            except Exception as e:
+                Job().updateJob(job, log=f'Failed to process file {item["name"]}; {e}\n')
+                results[idx] = ({}, {})
+                continue
+            batch.append((idx, item, label_barcode))
+        if not batch:
+            continue
+        label_texts = get_images_text([item for _, item, _ in batch])
+        for (idx, item, label_barcode), label_text in zip(batch, label_texts):
+            if len(label_text) > 0:
+                message = f'Found label text for file {item["name"]}: {label_text}.\n'
+            else:
+                message = f'Could not find label text for file {item["name"]}.\n'
+            Job().updateJob(job, log=message)
+            results[idx] = (label_text, label_barcode)
+    return results
+
+
 def start_ocr_batch_job(job):
     """
     Function to be run for girder jobs of type wsi_deid.batch_ocr. Jobs using this function
@@ -83,15 +140,189 @@ def start_ocr_batch_job(job):
         return
     itemIds = job_args
     try:
+        get_label_text_for_items(itemIds, job)
+        Job().updateJob(job, log='Finished batch job.\n', status=JobStatus.SUCCESS)
+    except Exception as e:
+        Job().updateJob(
+            job,
+            log=f'Batch job failed with the following exception: {str(e)}.\n',
+            status=JobStatus.ERROR,
+        )
+
+
+# The project folder an item is in after each batch action completes
+BatchProcessDestinations = {
+    'process': 'processed',
+    'reject': 'rejected',
+    'quarantine': 'quarantine',
+    'finish': 'finished',
+}
+
+
+def batch_process_item_done(item, action):
+    """
+    Check if an action has already been performed on an item based on the
+    project folder that the item is in.
+
+    :param item: a girder item.
+    :param action: the batch action.
+    :returns: True if the item is already in the action's destination folder.
+    """
+    from .import_export import isProjectFolder
+
+    if action not in BatchProcessDestinations:
+        return False
+    folder = Folder().load(item['folderId'], force=True)
+    return isProjectFolder(folder) == BatchProcessDestinations[action]
+
+
+def batch_process_owner():
+    """
+    Get a record that identifies the current server process.
+
+    :returns: a dictionary with the host name, the process id, and the time
+        the process was started.
+    """
+    proc = psutil.Process()
+    return {'host': socket.gethostname(), 'pid': proc.pid, 'started': proc.create_time()}
+
+
+def batch_process_job_claim(job):
+    """
+    Record that the current server process runs a batch process job.
+
+    :param job: the job document.
+    """
+    Job().collection.update_one({'_id': job['_id']}, {'$set': {
+        'wsiDeidOwner': batch_process_owner(),
+        'wsiDeidHeartbeat': datetime.datetime.utcnow(),
+    }})
+
+
+def batch_process_heartbeat(job, stop):
+    """
+    Periodically update the heartbeat of a batch process job.
+
+    :param job: the job document.
+    :param stop: a threading.Event that is set when the job is done.
+    """
+    while not stop.wait(BatchJobHeartbeat):
+        Job().collection.update_one(
+            {'_id': job['_id']}, {'$set': {'wsiDeidHeartbeat': datetime.datetime.utcnow()}})
+
+
+def batch_process_job_stale(job):
+    """
+    Check if a queued or running batch process job is no longer being run.
+
+    :param job: the job document.
+    :returns: True if the job's server process is gone.
+    """
+    owner = job.get('wsiDeidOwner') or {}
+    if owner.get('host') == socket.gethostname():
+        try:
+            return psutil.Process(owner['pid']).create_time() != owner['started']
+        except (KeyError, psutil.Error):
+            return True
+    last = job.get('wsiDeidHeartbeat') or job.get('updated')
+    return last is None or (
+        datetime.datetime.utcnow() - last).total_seconds() > BatchJobStaleTime
+
+
+def start_batch_process_job(job):
+    """
+    Function to be run for girder jobs of type wsi_deid.batch_process. Jobs using this function
+    should include an action and a list of girder item ids as arguments.  Items listed in the
+    job's 'done' keyword argument are skipped.  If the job has a 'resume' keyword argument,
+    items that have already been moved to the action's destination folder are also skipped.
+
+    :param job: A girder job
+    """
+    from .rest import item_list_action
+
+    Job().updateJob(
+        job,
+        log='Starting batch job to perform an action on items.\n',
+        status=JobStatus.RUNNING,
+    )
+    job_args = job.get('args', None)
+    if job_args is None or len(job_args) != 2:
+        Job().updateJob(
+            job,
+            log='Expected an action and a list of girder items as arguments.\n',
+            status=JobStatus.ERROR,
+        )
+        return
+    action, itemIds = job_args
+    resume = (job.get('kwargs') or {}).get('resume')
+    done = set((job.get('kwargs') or {}).get('done') or [])
+    batch_process_job_claim(job)
+    stop = threading.Event()
+    threading.Thread(target=batch_process_heartbeat, args=(job, stop), daemon=True).start()
+    try:
+        user = User().load(job['userId'], force=True) if job.get('userId') else None
+        items = []
         for itemId in itemIds:
-            get_label_text_for_item(itemId, job)
+            if str(itemId) in done:
+                continue
+            item = Item().load(itemId, force=True)
+            if item is None:
+                Job().updateJob(job, log=f'Item {itemId} no longer exists.\n')
+            elif resume and batch_process_item_done(item, action):
+                Job().updateJob(job, log=f'Skipping {item["name"]}; already finished.\n')
+            else:
+                items.append(item)
+        if len(items):
+            item_list_action(action, items, user, noProgress, job)
         Job().updateJob(job, log='Finished batch job.\n', status=JobStatus.SUCCESS)
     except Exception as e:
+        logger.exception('Job failed')
         Job().updateJob(
             job,
             log=f'Batch job failed with the following exception: {str(e)}.\n',
             status=JobStatus.ERROR,
         )
+    finally:
+        stop.set()
+
+
+def resume_batch_process_jobs():
+    """
+    Find batch process jobs that were interrupted by a server restart.  Mark
+    each as failed and start a new job to perform the action on the items that
+    were not yet finished.  Only jobs whose server process is gone are resumed
+    (see batch_process_job_stale); jobs that another server process is still
+    running are left alone.  Each job is claimed before it is resumed, so that
+    when several server processes start at once only one of them resumes it.
+    """
+    from .rest import batch_process_job
+
+    for job in list(Job().find({
+            'type': 'wsi_deid.batch_process',
+            'status': {'$in': [JobStatus.QUEUED, JobStatus.RUNNING]},
+            'wsiDeidResumed': {'$exists': False}})):
+        if not batch_process_job_stale(job):
+            continue
+        job = Job().collection.find_one_and_update(
+            {'_id': job['_id'], 'wsiDeidResumed': {'$exists': False}},
+            {'$set': {'wsiDeidResumed': True}})
+        if job is None:
+            continue
+        try:
+            action, itemIds = job['args']
+            done = set((job.get('kwargs') or {}).get('done') or [])
+            user = User().load(job['userId'], force=True) if job.get('userId') else None
+            items = [item for item in (
+                Item().load(itemId, force=True) for itemId in itemIds
+                if str(itemId) not in done) if item is not None]
+            newJob = batch_process_job(action, items, user, resume=True) if items else None
+            Job().updateJob(
+                job,
+                log='Interrupted by a server restart; %s.\n' % (
+                    'resuming as job %s' % newJob['_id'] if newJob else 'no items remain'),
+                status=JobStatus.ERROR)
+        except Exception:
+            logger.exception('Failed to resume batch job %s', job['_id'])
 
 
 def find_best_match(matches, multipleAllowed):
@@ -238,22 +469,11 @@ def associate_unfiled_images(job):  # noqa
         rowToImageMatches = {}
         for key in list(uploadInfo):
             rowToImageMatches[key] = []
-        # Without concurrent.futures, this is:
-        # for itemId in itemIds:
-        #     label_text = get_label_text_for_item(itemId, job)
-        label_text_list = []
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=max(1, os.cpu_count() // 2)) as executor:
-            futures = []
-            for itemId in itemIds:
-                futures.append(executor.submit(get_label_text_for_item, itemId, job))
-            for future in futures:
-                label_text_list.append(future.result())
+        label_text_list = get_label_text_for_items(itemIds, job)
         for idx, itemId in enumerate(itemIds):
             if label_text_list[idx] is None:
                 continue
             label_text, barcode_text = label_text_list[idx]
-            # And, without concurrent futures, the code resumes here
             # TODO: do something with the barcode for matching
             item = Item().load(itemId, force=True)
             imageToRowMatches = []
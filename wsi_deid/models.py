@@ -0,0 +1,62 @@
+import datetime
+
+from girder.models.model_base import Model
+
+from . import config
+
+
+class OCRCache(Model):
+    """
+    This model stores the results of OCR and barcode reading on associated
+    images.  Each record has a key that is a hash of the decoded image pixels
+    and the settings used to read it, the kind of result ('ocr' or
+    'barcode'), the result, and a time at which the record expires.  Records
+    expire when they have not been used for the number of days in the
+    ocr_cache_days setting.
+    """
+
+    def initialize(self):
+        self.name = 'wsi_deid_ocr_cache'
+        self.ensureIndex(('key', {'unique': True}))
+        self.ensureIndex(('expires', {'expireAfterSeconds': 0}))
+
+    def validate(self, doc):
+        return doc
+
+    def _expires(self):
+        days = float(config.getConfig('ocr_cache_days') or 0)
+        if days <= 0:
+            return None
+        return datetime.datetime.utcnow() + datetime.timedelta(days=days)
+
+    def getResult(self, key):
+        """
+        Get a cached result and extend its expiration.
+
+        :param key: the hash key of the image and settings.
+        :returns: the cached result or None if there is no cached result.
+        """
+        expires = self._expires()
+        if expires is None:
+            return None
+        doc = self.collection.find_one_and_update(
+            {'key': key}, {'$set': {'expires': expires}})
+        return doc['result'] if doc else None
+
+    def setResult(self, key, kind, result):
+        """
+        Store a result in the cache.
+
+        :param key: the hash key of the image and settings.
+        :param kind: the kind of result.
+        :param result: the result to store.  This must be a list, dictionary,
+            or other value that can be stored without modification.
+        """
+        expires = self._expires()
+        if expires is None:
+            return
+        self.collection.update_one({'key': key}, {'$set': {
+            'kind': kind,
+            'result': result,
+            'expires': expires,
+        }}, upsert=True)
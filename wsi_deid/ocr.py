@@ -0,0 +1,187 @@
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import os
+import threading
+
+import psutil
+from girder import logger
+
+from . import config
+from .constants import PluginSettings
+
+OCRPool = None
+OCRPoolSize = 0
+OCRPoolLock = threading.Lock()
+
+
+def cuda_available():
+    """
+    Check if torch can use a CUDA device.
+
+    :returns: True if easyocr will run on a GPU.
+    """
+    try:
+        import torch
+
+        return bool(torch.cuda.is_available())
+    except Exception:
+        return False
+
+
+def ocr_worker_count():
+    """
+    Determine how many OCR worker processes to use.  This is limited by the
+    ocr_concurrency setting (0 to use the number of CPUs) and by the available
+    memory based on the ocr_memory_per_worker setting (in GB).  When a CUDA
+    device is available, each worker would load the model onto the same GPU,
+    so unless ocr_concurrency is set, a single worker is used.
+
+    :returns: the number of worker processes.
+    """
+    workers = int(config.getConfig('ocr_concurrency') or 0)
+    if not workers and cuda_available():
+        workers = 1
+    workers = workers or os.cpu_count() or 1
+    memoryPerWorker = float(config.getConfig('ocr_memory_per_worker') or 0)
+    if memoryPerWorker > 0:
+        workers = min(workers, int(
+            psutil.virtual_memory().available / (memoryPerWorker * 1024 ** 3)))
+    return max(1, workers)
+
+
+def _worker_init(threads):
+    """
+    Initialize an OCR worker process by creating its easyocr reader.
+
+    :param threads: the number of threads torch should use in this process.
+    """
+    from .process import get_reader
+
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except Exception:
+        pass
+    get_reader()
+
+
+def _worker_readtext(arrays, params, batch_size=None):
+    """
+    Run OCR in a worker process.  If called in the main process, this uses
+    the main process's reader.
+
+    :param arrays: a list of numpy image arrays.
+    :param params: a dictionary of parameters for the easyocr reader.
+    :param batch_size: if None, each image is read individually.  Otherwise,
+        the images must be the same size and are read as batches of this
+        size.
+    :returns: a list of easyocr results, one per image.
+    """
+    from .process import get_reader
+
+    reader = get_reader()
+    if batch_size is None:
+        return [reader.readtext(array, **params) for array in arrays]
+    return reader.readtext_batched(arrays, **params, batch_size=batch_size)
+
+
+def get_pool():
+    """
+    Get the pool of OCR worker processes, starting it if necessary.  The pool
+    is started when OCR is first requested rather than when the server
+    starts, so server processes that never run OCR don't start it.  Each
+    worker has its own easyocr reader.  Workers are started with the spawn
+    method so that they don't inherit the server's threads and database
+    connections.  The reader is created in the current process first so that
+    the easyocr model is downloaded once rather than by every worker at the
+    same time.
+
+    :returns: a concurrent.futures.ProcessPoolExecutor.
+    """
+    global OCRPool, OCRPoolSize
+
+    from .process import get_reader
+
+    with OCRPoolLock:
+        if OCRPool is None:
+            get_reader()
+            OCRPoolSize = ocr_worker_count()
+            threads = max(1, (os.cpu_count() or 1) // OCRPoolSize)
+            OCRPool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=OCRPoolSize,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_worker_init,
+                initargs=(threads, ))
+            logger.info('Started OCR pool with %d workers', OCRPoolSize)
+        return OCRPool
+
+
+def pool_size():
+    """
+    Get the number of OCR worker processes.
+
+    :returns: the number of workers in the pool, starting it if necessary.
+    """
+    get_pool()
+    return OCRPoolSize
+
+
+def reset_pool():
+    """
+    Discard the pool of OCR workers.  A new pool will be started when it is
+    next needed.
+    """
+    global OCRPool
+
+    with OCRPoolLock:
+        pool, OCRPool = OCRPool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def settingChangedEvent(event):
+    """
+    Discard the pool of OCR workers when a setting that determines its size
+    changes.  A new pool is started when OCR is next requested.
+
+    :param event: a Girder setting save or remove event.
+    """
+    if isinstance(event.info, dict) and event.info.get('key') in {
+            PluginSettings.WSI_DEID_BASE + 'ocr_concurrency',
+            PluginSettings.WSI_DEID_BASE + 'ocr_memory_per_worker'}:
+        reset_pool()
+
+
+def readtext(arrays, params, batch_size=None):
+    """
+    Submit OCR work to the pool of OCR workers.
+
+    :param arrays: a list of numpy image arrays.
+    :param params: a dictionary of parameters for the easyocr reader.
+    :param batch_size: if None, each image is read individually.  Otherwise,
+        the images must be the same size and are read as batches of this
+        size.
+    :returns: a function that takes no arguments and returns a list of
+        easyocr results, one per image.  This waits for the work to finish.
+        If the pool has stopped, the work is done in the current process.
+    """
+    try:
+        future = get_pool().submit(_worker_readtext, arrays, params, batch_size)
+    except Exception:
+        logger.exception('Failed to submit work to the OCR pool')
+        reset_pool()
+        future = None
+
+    def result():
+        if future is not None:
+            try:
+                return future.result()
+            except (concurrent.futures.process.BrokenProcessPool,
+                    concurrent.futures.CancelledError):
+                logger.warning('OCR pool stopped; running OCR in the server process')
+                reset_pool()
+        return _worker_readtext(arrays, params, batch_size)
+
+    return result
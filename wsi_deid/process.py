@@ -1,10 +1,14 @@
 import base64
+import concurrent.futures
 import copy
 import datetime
+import hashlib
 import io
+import json
 import math
 import os
 import re
+import struct
 import subprocess
 import threading
 import time
@@ -27,8 +31,9 @@ from girder.models.setting import Setting
 from girder_large_image.models.image_item import ImageItem
 from large_image.tilesource import dictToEtree
 from lxml import etree as lxmlElementTree
+from tifftools.constants import get_or_create_tag
 
-from . import config
+from . import config, ocr
 from .constants import PluginSettings, TokenOnlyPrefix
 
 OCRLock = threading.Lock()
@@ -700,6 +705,191 @@ def polygons_to_svg(polygons, width, height, cropAllowed=True, offsetx=0, offset
     return svg
 
 
+# The size of the blocks of zeros used to overwrite unused parts of a tiff
+ZeroChunkSize = 1024 ** 2
+
+
+def tiff_pack_tag(bom, bigtiff, tag, taginfo, data):
+    """
+    Encode the value of a tiff tag the same way tifftools.write_tiff does.
+
+    :param bom: either '<' or '>' for the endian of the file.
+    :param bigtiff: True if this is a bigtiff.
+    :param tag: the tifftools tag.
+    :param taginfo: the tag record with the datatype.
+    :param data: the data to encode.
+    :returns: the datatype, count, and encoded data of the tag.
+    """
+    datatype = tifftools.Datatype[taginfo['datatype']]
+    if tag.isOffsetData():
+        datatype = tifftools.Datatype.LONG8 if bigtiff else tifftools.Datatype.LONG
+    if not bigtiff and datatype in {tifftools.Datatype.LONG8, tifftools.Datatype.SLONG8}:
+        if datatype == tifftools.Datatype.LONG8 and all(val < 2 ** 32 for val in data):
+            datatype = tifftools.Datatype.LONG
+        elif datatype == tifftools.Datatype.SLONG8 and all(abs(val) < 2 ** 31 for val in data):
+            datatype = tifftools.Datatype.SLONG
+        else:
+            msg = 'There are datatypes that require bigtiff format.'
+            raise tifftools.MustBeBigTiffError(msg)
+    if datatype.pack:
+        count = len(data) // len(datatype.pack)
+        data = struct.pack(bom + datatype.pack * count, *data)
+    elif datatype == tifftools.Datatype.ASCII:
+        data = (data if isinstance(data, bytes) else data.encode()) + b'\x00'
+        count = len(data)
+    else:
+        count = len(data)
+    return datatype, count, data
+
+
+def tiff_in_place_append_pos(dest, bigtiff):
+    """
+    Move to the word-aligned end of a tiff file that is being appended to.
+
+    :param dest: the tiff file open for writing.
+    :param bigtiff: True if this is a bigtiff.
+    :returns: the offset in the file.
+    """
+    pos = dest.seek(0, os.SEEK_END)
+    if pos % 2:
+        dest.write(b'\x00')
+        pos += 1
+    if not bigtiff and pos >= 2 ** 32:
+        msg = 'The file is large enough it must be in bigtiff format.'
+        raise tifftools.MustBeBigTiffError(msg)
+    return pos
+
+
+def write_tiff_in_place_ifds(dest, bom, bigtiff, ifds, sourcePath, keptRanges):
+    """
+    Append a chain of ifds and their tag data to the end of a tiff file.
+    Image data of ifds from the source file is referenced where it is; image
+    data from other files is appended.
+
+    :param dest: the tiff file open for writing.
+    :param bom: either '<' or '>' for the endian of the file.
+    :param bigtiff: True if this is a bigtiff.
+    :param ifds: the list of ifds in the chain.
+    :param sourcePath: the path of the source file that dest is a copy of.
+    :param keptRanges: a list that is extended with (offset, length) tuples
+        of source image data that is used.
+    :returns: the offset of the first ifd in the chain.
+    """
+    ptrpack = 'Q' if bigtiff else 'L'
+    tagdatalen = 8 if bigtiff else 4
+    firstifd = nextifdPtr = None
+    for ifd in ifds:
+        tags = {int(tag): taginfo for tag, taginfo in ifd['tags'].items()}
+        entries = []
+        for tagval, taginfo in sorted(tags.items()):
+            tag = get_or_create_tag(tagval, tifftools.Tag, **(
+                {'datatype': tifftools.Datatype[taginfo['datatype']]}
+                if taginfo.get('datatype') else {}))
+            data = taginfo.get('data')
+            if tag.isIFD() or taginfo.get('datatype') in {
+                    tifftools.Datatype.IFD, tifftools.Datatype.IFD8}:
+                data = [write_tiff_in_place_ifds(
+                    dest, bom, bigtiff, subifds if isinstance(subifds, list) else [subifds],
+                    sourcePath, keptRanges) for subifds in taginfo['ifds']]
+                taginfo = {'datatype': (
+                    tifftools.Datatype.IFD8 if bigtiff else tifftools.Datatype.IFD)}
+            elif tag.isOffsetData():
+                bytecounts = (
+                    tags[int(tifftools.Tag[tag.bytecounts])]['data']
+                    if isinstance(tag.bytecounts, str) else [tag.bytecounts] * len(data))
+                if ifd.get('path_or_fobj') == sourcePath:
+                    keptRanges.extend(
+                        (offset, length) for offset, length in zip(data, bytecounts) if offset)
+                else:
+                    dest.seek(0, os.SEEK_END)
+                    with tifftools.path_or_fobj.OpenPathOrFobj(ifd['path_or_fobj'], 'rb') as src:
+                        data = tifftools.tifftools.write_tag_data(
+                            dest, src, data, bytecounts, ifd['size'])
+            datatype, count, data = tiff_pack_tag(bom, bigtiff, tag, taginfo, data)
+            if len(data) > tagdatalen:
+                pos = tiff_in_place_append_pos(dest, bigtiff)
+                dest.write(data)
+                data = struct.pack(bom + ptrpack, pos)
+            entries.append(struct.pack(bom + 'HH' + ptrpack, tagval, datatype, count) +
+                           data + b'\x00' * (tagdatalen - len(data)))
+        ifdpos = tiff_in_place_append_pos(dest, bigtiff)
+        ifdrecord = struct.pack(bom + ('Q' if bigtiff else 'H'), len(entries)) + b''.join(entries)
+        dest.write(ifdrecord)
+        dest.write(struct.pack(bom + ptrpack, 0))
+        if nextifdPtr is None:
+            firstifd = ifdpos
+        else:
+            dest.seek(nextifdPtr)
+            dest.write(struct.pack(bom + ptrpack, ifdpos))
+        nextifdPtr = ifdpos + len(ifdrecord)
+    return firstifd
+
+
+def write_tiff_in_place(tiffinfo, ifds, outputPath):
+    """
+    Write a tiff file by cloning the source file and appending the ifds and
+    their tag data.  The copy is a reflink of the source when the file system
+    supports it.  Image data that is used from the source file is left where
+    it is; image data from other files, such as new label and macro images, is
+    appended.  Everything else in the copy, including the original ifds, tag
+    data, and the image data of removed images, is overwritten with zeros, so
+    the time this takes depends on the amount of metadata rather than the
+    size of the image.
+
+    :param tiffinfo: the tifftools info record of the source file.
+    :param ifds: the ifds of the output file.
+    :param outputPath: the path of the output file.
+    """
+    from .import_export import copyFile
+
+    sourcePath = tiffinfo['path_or_fobj']
+    bom = tiffinfo['endianPack']
+    bigtiff = tiffinfo['bigtiff']
+    headerlen = 16 if bigtiff else 8
+    keptRanges = []
+    copyFile(sourcePath, outputPath)
+    with open(outputPath, 'r+b') as dest:
+        firstifd = write_tiff_in_place_ifds(dest, bom, bigtiff, ifds, sourcePath, keptRanges)
+        dest.seek(headerlen - (8 if bigtiff else 4))
+        dest.write(struct.pack(bom + ('Q' if bigtiff else 'L'), firstifd))
+        pos = headerlen
+        zeros = b'\x00' * ZeroChunkSize
+        for offset, length in sorted(keptRanges) + [(tiffinfo['size'], 0)]:
+            offset = min(offset, tiffinfo['size'])
+            while pos < offset:
+                dest.seek(pos)
+                dest.write(zeros[:min(ZeroChunkSize, offset - pos)])
+                pos = dest.tell()
+            pos = max(pos, offset + length)
+
+
+def write_redacted_tiff(tiffinfo, ifds, outputPath, redactList):
+    """
+    Write a redacted tiff file.  Unless the whole slide image has area
+    redactions or the redact_tiff_in_place setting is False, the file is
+    written by patching a copy of the source file; otherwise, all of the
+    file is rewritten.  Spliced tile files used by the ifds are closed once
+    the file is written.
+
+    :param tiffinfo: the tifftools info record of the source file.
+    :param ifds: the ifds of the output file.
+    :param outputPath: the path of the output file.
+    :param redactList: the list of redactions (see get_redact_list).
+    """
+    try:
+        if (not redactList.get('area', {}).get('_wsi', {}).get('geojson') and
+                config.getConfig('redact_tiff_in_place') is not False):
+            try:
+                write_tiff_in_place(tiffinfo, ifds, outputPath)
+                return
+            except tifftools.MustBeBigTiffError:
+                logger.info('Rewriting %s as a bigtiff', outputPath)
+                os.unlink(outputPath)
+        tifftools.write_tiff(ifds, outputPath)
+    finally:
+        close_spliced_files(ifds)
+
+
 def redact_format_aperio(item, tempdir, redactList, title, labelImage, macroImage):
     """
     Redact aperio files.
@@ -785,7 +975,7 @@ def redact_format_aperio(item, tempdir, redactList, title, labelImage, macroImag
     redact_tiff_tags(ifds, redactList, title)
     add_deid_metadata(item, ifds)
     outputPath = os.path.join(tempdir, 'aperio.svs')
-    tifftools.write_tiff(ifds, outputPath)
+    write_redacted_tiff(tiffinfo, ifds, outputPath, redactList)
     logger.info('Redacted aperio file %s as %s', sourcePath, outputPath)
     return outputPath, 'image/tiff'
 
@@ -882,9 +1072,300 @@ def redact_wsi_geojson(geojson, width, height, origImage):
     return redactedImage
 
 
+class SplicedTileFile:
+    """
+    A read-only seekable file-like object that presents a source file followed
+    by a file of appended data as a single stream.  tifftools can then copy
+    untouched tile data from the source and replaced tile data from the
+    appended file without either being copied first.  The appended file is a
+    work file; it is deleted when this is closed.
+    """
+
+    def __init__(self, path, appendPath):
+        self.name = path
+        self._paths = [path, appendPath]
+        self._sizes = [os.path.getsize(path), os.path.getsize(appendPath)]
+        self._fptrs = [None, None]
+        self._pos = 0
+        self.size = sum(self._sizes)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self._pos = pos
+        return self._pos
+
+    def truncate(self, size=None):
+        msg = 'Spliced tile files are read-only.'
+        raise io.UnsupportedOperation(msg)
+
+    def read(self, length=-1):
+        if length is None or length < 0:
+            length = self.size - self._pos
+        chunks = []
+        while length > 0 and self._pos < self.size:
+            part = 0 if self._pos < self._sizes[0] else 1
+            start = self._pos - (self._sizes[0] if part else 0)
+            if self._fptrs[part] is None:
+                self._fptrs[part] = open(self._paths[part], 'rb')  # noqa
+            self._fptrs[part].seek(start)
+            data = self._fptrs[part].read(min(length, self._sizes[part] - start))
+            if not data:
+                break
+            chunks.append(data)
+            self._pos += len(data)
+            length -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        for idx, fptr in enumerate(self._fptrs):
+            if fptr is not None:
+                fptr.close()
+                self._fptrs[idx] = None
+        if os.path.exists(self._paths[1]):
+            os.unlink(self._paths[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+def close_spliced_files(ifds):
+    """
+    Close any spliced tile files referenced by a list of ifds.
+
+    :param ifds: a list of ifds.
+    """
+    for ifd in ifds:
+        if isinstance(ifd.get('path_or_fobj'), SplicedTileFile):
+            ifd['path_or_fobj'].close()
+
+
+def wsi_jpeg_tile_levels(ifds):
+    """
+    Find the directories of a tiff file that are pyramid levels of the wsi and
+    check that they can be redacted a tile at a time.
+
+    :param ifds: ifds of the source file.  The first ifd is the full
+        resolution image.
+    :returns: a list of ifd indices or None if any level is not a tiled 8-bit
+        JPEG image.
+    """
+    baseTags = ifds[0]['tags']
+    if tifftools.Tag.TileWidth.value not in baseTags:
+        return None
+    baseW = baseTags[tifftools.Tag.ImageWidth.value]['data'][0]
+    baseH = baseTags[tifftools.Tag.ImageHeight.value]['data'][0]
+    levels = []
+    for idx, ifd in enumerate(ifds):
+        tags = ifd['tags']
+        if tifftools.Tag.TileWidth.value not in tags:
+            continue
+        w = tags[tifftools.Tag.ImageWidth.value]['data'][0]
+        h = tags[tifftools.Tag.ImageHeight.value]['data'][0]
+        tileSize = max(tags[tifftools.Tag.TileWidth.value]['data'][0],
+                       tags[tifftools.Tag.TileLength.value]['data'][0])
+        # Skip tiled images that are not proportional to the base image
+        if abs(w * baseH - h * baseW) > tileSize * max(baseW, baseH):
+            continue
+        photometric = tags.get(tifftools.Tag.Photometric.value, {}).get('data', [None])[0]
+        samples = tags.get(tifftools.Tag.SamplesPerPixel.value, {}).get('data', [1])[0]
+        if (tags.get(tifftools.Tag.Compression.value, {}).get('data', [None])[0] !=
+                tifftools.constants.Compression.JPEG.value or
+                tifftools.Tag.SubIFD.value in tags or
+                any(bits != 8 for bits in tags.get(
+                    tifftools.Tag.BitsPerSample.value, {}).get('data', [8])) or
+                tags.get(tifftools.Tag.PlanarConfig.value, {}).get('data', [1])[0] != 1 or
+                (photometric, samples) not in {
+                    (tifftools.constants.Photometric.MinIsBlack.value, 1),
+                    (tifftools.constants.Photometric.RGB.value, 3),
+                    (tifftools.constants.Photometric.YCbCr.value, 3)}):
+            return None
+        levels.append(idx)
+    return levels
+
+
+def redact_wsi_tile(image, polys, x, y, tileWidth, tileHeight, jpegOptions):
+    """
+    Redact a single tile of an image level.
+
+    :param image: a vips image of the level.
+    :param polys: a list of polygons in the level's coordinates.
+    :param x: the left coordinate of the tile.
+    :param y: the top coordinate of the tile.
+    :param tileWidth: the width of the tile.
+    :param tileHeight: the height of the tile.
+    :param jpegOptions: a dictionary of options to pass to PIL when saving
+        the tile as a JPEG.
+    :returns: the compressed tile data or None if no part of the tile is
+        redacted.
+    """
+    polygonSvg = polygons_to_svg(
+        [[[[pt[0] - x, pt[1] - y] for pt in loop] for loop in poly] for poly in polys],
+        tileWidth, tileHeight, cropAllowed=False)
+    alpha = pyvips.Image.svgload_buffer(polygonSvg.encode())[3]
+    if not alpha.max():
+        return None
+    region = image.crop(x, y, min(tileWidth, image.width - x), min(tileHeight, image.height - y))
+    if region.width != tileWidth or region.height != tileHeight:
+        region = region.embed(0, 0, tileWidth, tileHeight)
+    region = (region * (255 - alpha) / 255).cast(pyvips.BandFormat.UCHAR)
+    data = np.ndarray(
+        buffer=region.write_to_memory(), dtype=np.uint8,
+        shape=[region.height, region.width, region.bands])
+    tileImage = PIL.Image.fromarray(data[:, :, 0] if region.bands == 1 else data)
+    output = io.BytesIO()
+    tileImage.save(output, 'JPEG', **jpegOptions)
+    return output.getvalue()
+
+
+def redact_wsi_level_tiles(sourcePath, ifd, idx, polys, scale, tileFptr, appendOffset):
+    """
+    Redact the tiles of one pyramid level that intersect a set of polygons.
+    Redacted tiles are written to a file; the tile offsets and byte counts of
+    the level are adjusted to reference that file as if it were appended to
+    the source file.
+
+    :param sourcePath: the path of the source tiff file.
+    :param ifd: the ifd of the level.
+    :param idx: the index of the ifd in the source file.
+    :param polys: a list of polygons in full resolution coordinates.
+    :param scale: a tuple of the x and y scale of this level relative to the
+        full resolution image.
+    :param tileFptr: an open file to write redacted tiles to.
+    :param appendOffset: the offset in the combined stream where the tile
+        file starts.
+    :returns: a tuple of (offsets, bytecounts, count), where offsets and
+        bytecounts are the new tile data lists and count is the number of
+        tiles that were replaced.
+    """
+    tags = ifd['tags']
+    width = tags[tifftools.Tag.ImageWidth.value]['data'][0]
+    height = tags[tifftools.Tag.ImageHeight.value]['data'][0]
+    tileWidth = tags[tifftools.Tag.TileWidth.value]['data'][0]
+    tileHeight = tags[tifftools.Tag.TileLength.value]['data'][0]
+    tilesAcross = (width + tileWidth - 1) // tileWidth
+    tilesDown = (height + tileHeight - 1) // tileHeight
+    offsets = list(tags[tifftools.Tag.TileOffsets.value]['data'])
+    bytecounts = list(tags[tifftools.Tag.TileByteCounts.value]['data'])
+    if len(offsets) != tilesAcross * tilesDown:
+        msg = 'Unexpected number of tiles in directory %d' % idx
+        raise Exception(msg)
+    jpegOptions = {'quality': 95}
+    if tifftools.Tag.JPEGTables.value in tags:
+        jpegOptions['quality'] = tifftools.constants.EstimateJpegQuality(
+            tags[tifftools.Tag.JPEGTables.value]['data'])
+    photometric = tags[tifftools.Tag.Photometric.value]['data'][0]
+    if photometric == tifftools.constants.Photometric.RGB.value:
+        jpegOptions.update({'keep_rgb': True, 'subsampling': 0})
+    elif photometric == tifftools.constants.Photometric.YCbCr.value:
+        jpegOptions['subsampling'] = {(1, 1): 0, (2, 1): 1}.get(tuple(tags.get(
+            tifftools.Tag.YCbCrSubsampling.value, {}).get('data', [2, 2])), 2)
+    levelPolys = [[[[pt[0] * scale[0], pt[1] * scale[1]] for pt in loop]
+                   for loop in poly] for poly in polys]
+    tiles = set()
+    for poly in levelPolys:
+        xs = [pt[0] for loop in poly for pt in loop]
+        ys = [pt[1] for loop in poly for pt in loop]
+        for ty in range(max(0, int(min(ys) - 1) // tileHeight),
+                        min(tilesDown, int(max(ys) + 1) // tileHeight + 1)):
+            for tx in range(max(0, int(min(xs) - 1) // tileWidth),
+                            min(tilesAcross, int(max(xs) + 1) // tileWidth + 1)):
+                tiles.add((tx, ty))
+    image = pyvips.Image.tiffload(sourcePath, page=idx)
+    count = 0
+    for tx, ty in sorted(tiles, key=lambda t: (t[1], t[0])):
+        x, y = tx * tileWidth, ty * tileHeight
+        tilePolys = [poly for poly in levelPolys if
+                     min(pt[0] for loop in poly for pt in loop) <= x + tileWidth + 1 and
+                     max(pt[0] for loop in poly for pt in loop) >= x - 1 and
+                     min(pt[1] for loop in poly for pt in loop) <= y + tileHeight + 1 and
+                     max(pt[1] for loop in poly for pt in loop) >= y - 1]
+        data = redact_wsi_tile(image, tilePolys, x, y, tileWidth, tileHeight, jpegOptions)
+        if data is None:
+            continue
+        offsets[ty * tilesAcross + tx] = appendOffset + tileFptr.tell()
+        bytecounts[ty * tilesAcross + tx] = len(data)
+        tileFptr.write(data)
+        count += 1
+    return offsets, bytecounts, count
+
+
+def redact_format_aperio_philips_redact_wsi_tiles(tileSource, ifds, geojson, tempdir):
+    """
+    Given a geojson list of polygons, remove them from the wsi by re-encoding
+    only the tiles that intersect the polygons at each pyramid level.  The
+    compressed data of all other tiles is copied from the source unchanged.
+
+    :param tileSource: the large_image tile source.
+    :param ifds: ifds of output file.
+    :param geojson: geojson to redact.
+    :param tempdir: a directory for work files.
+    :returns ifds: a modified list of ifds or None if the wsi cannot be
+        redacted a tile at a time.
+    """
+    levels = wsi_jpeg_tile_levels(ifds)
+    if not levels:
+        return None
+    sourcePath = ifds[0]['path_or_fobj']
+    if not isinstance(sourcePath, (str, os.PathLike)):
+        return None
+    polys = geojson_to_polygons(geojson)
+    baseW = ifds[0]['tags'][tifftools.Tag.ImageWidth.value]['data'][0]
+    baseH = ifds[0]['tags'][tifftools.Tag.ImageHeight.value]['data'][0]
+    appendOffset = os.path.getsize(sourcePath)
+    tilePath = os.path.join(tempdir, '_wsi_tiles.bin')
+    replaced = {}
+    try:
+        with open(tilePath, 'wb') as tileFptr:
+            for idx in levels:
+                tags = ifds[idx]['tags']
+                scale = (tags[tifftools.Tag.ImageWidth.value]['data'][0] / baseW,
+                         tags[tifftools.Tag.ImageHeight.value]['data'][0] / baseH)
+                offsets, bytecounts, count = redact_wsi_level_tiles(
+                    sourcePath, ifds[idx], idx, polys, scale, tileFptr, appendOffset)
+                logger.info('Redacting wsi - replacing %d tiles in directory %d', count, idx)
+                if count:
+                    replaced[idx] = (offsets, bytecounts)
+    except Exception:
+        os.unlink(tilePath)
+        raise
+    if not replaced:
+        os.unlink(tilePath)
+        return list(ifds)
+    # This is closed when the redacted file is written (see
+    # write_redacted_tiff)
+    splicedFile = SplicedTileFile(sourcePath, tilePath)
+    newifds = []
+    for idx, ifd in enumerate(ifds):
+        if idx in replaced:
+            ifd = ifd.copy()
+            ifd['tags'] = ifd['tags'].copy()
+            for tag, data in zip(
+                    (tifftools.Tag.TileOffsets.value, tifftools.Tag.TileByteCounts.value),
+                    replaced[idx]):
+                ifd['tags'][tag] = dict(ifd['tags'][tag], data=data)
+            ifd['path_or_fobj'] = splicedFile
+            ifd['size'] = splicedFile.size
+        newifds.append(ifd)
+    return newifds
+
+
 def redact_format_aperio_philips_redact_wsi(tileSource, ifds, geojson, tempdir):
     """
-    Given a geojson list of polygons, remove them from the wsi.
+    Given a geojson list of polygons, remove them from the wsi.  When the wsi
+    is stored as tiled JPEG, only the tiles that intersect the polygons are
+    re-encoded; otherwise the whole image is redacted and re-encoded.
 
     :param tileSource: the large_image tile source.
     :param ifds: ifds of output file.
@@ -892,6 +1373,9 @@ def redact_format_aperio_philips_redact_wsi(tileSource, ifds, geojson, tempdir):
     :returns ifds: a modified list of ifds.
     """
     logger.info('Redacting wsi %s', tileSource._getLargeImagePath())
+    newifds = redact_format_aperio_philips_redact_wsi_tiles(tileSource, ifds, geojson, tempdir)
+    if newifds is not None:
+        return newifds
     width = ifds[0]['tags'][tifftools.Tag.ImageWidth.value]['data'][0]
     height = ifds[0]['tags'][tifftools.Tag.ImageHeight.value]['data'][0]
     logger.info('Redacting wsi - loading source')
@@ -1264,7 +1748,7 @@ def redact_format_ometiff(item, tempdir, redactList, title, labelImage, macroIma
 
     add_deid_metadata(item, ifds)
     outputPath = os.path.join(tempdir, 'ometiff.ome.tiff')
-    tifftools.write_tiff(ifds, outputPath)
+    write_redacted_tiff(tiffinfo, ifds, outputPath, redactList)
     logger.info('Redacted ometiff file %s as %s', sourcePath, outputPath)
     return outputPath, 'image/tiff'
 
@@ -1279,7 +1763,7 @@ def write_dicom_image(pilImage, imgpath, anypath, imgtype, seriesNum):
         os.unlink(imgpath)
     else:
         uid = '2.25.' + str(uuid.uuid4().int)
-        imgpath = os.path.join(os.path.dirname(anypath), f'{refds.SOPInstanceUID}.dcm')
+        imgpath = os.path.join(os.path.dirname(anypath), f'{uid}.dcm')
     file_meta = pydicom.FileMetaDataset()
     file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.77.1.6'
     file_meta.MediaStorageSOPInstanceUID = uid
@@ -1357,6 +1841,150 @@ def write_dicom_image(pilImage, imgpath, anypath, imgtype, seriesNum):
     return imgpath
 
 
+# The maximum number of dicom instance files of one item that are redacted at
+# the same time
+DicomRedactWorkers = 4
+# Explicit VRs whose data elements have a 32-bit length
+DicomLongVRs = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN',
+                b'UR', b'UT', b'UV'}
+
+
+def copy_byte_range(fsrc, fdst, offset, length):
+    """
+    Copy part of a file to the current position of another file.  The data
+    is copied within the kernel if possible, otherwise in large chunks.
+
+    :param fsrc: the open source file.
+    :param fdst: the open destination file.
+    :param offset: the offset in the source file to copy from.
+    :param length: the number of bytes to copy.
+    """
+    from .import_export import CopyChunkSize
+
+    fdst.flush()
+    start = fdst.tell()
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), min(CopyChunkSize, length - copied),
+                    offset + copied, start + copied)
+                if not count:
+                    break
+                copied += count
+        except OSError:
+            pass
+    fsrc.seek(offset + copied)
+    fdst.seek(start + copied)
+    while copied < length:
+        data = fsrc.read(min(CopyChunkSize, length - copied))
+        if not data:
+            msg = 'Unexpected end of file'
+            raise Exception(msg)
+        fdst.write(data)
+        copied += len(data)
+
+
+def dicom_pixel_data_end(fptr, ds):
+    """
+    Find the end of the pixel data element of a dicom file.  The file must be
+    positioned at the start of the pixel data element, as it is after reading
+    the dataset with stop_before_pixels.
+
+    :param fptr: the open dicom file.
+    :param ds: the dataset read from the file.
+    :returns: the offset of the end of the pixel data element, or None if the
+        pixel data can't be copied as-is because the dataset is deflated or
+        there are data elements after the pixel data.
+    """
+    transferSyntax = getattr(ds.file_meta, 'TransferSyntaxUID', None)
+    if transferSyntax == pydicom.uid.DeflatedExplicitVRLittleEndian:
+        return None
+    implicit, little = ds.original_encoding
+    bom = '<' if little else '>'
+    pos = fptr.tell()
+    size = fptr.seek(0, os.SEEK_END)
+    if pos == size:
+        return pos
+    fptr.seek(pos)
+    header = fptr.read(8)
+    if implicit:
+        length = struct.unpack(bom + 'L', header[4:])[0]
+    elif header[4:6] in DicomLongVRs:
+        length = struct.unpack(bom + 'L', fptr.read(4))[0]
+    else:
+        length = struct.unpack(bom + 'H', header[6:])[0]
+    if length != 0xFFFFFFFF:
+        end = fptr.tell() + length
+    else:
+        # Encapsulated pixel data is a sequence of items ending with a
+        # sequence delimiter
+        while True:
+            group, element, length = struct.unpack(bom + 'HHL', fptr.read(8))
+            if (group, element) == (0xFFFE, 0xE0DD):
+                break
+            if (group, element) != (0xFFFE, 0xE000) or length == 0xFFFFFFFF:
+                msg = 'Unexpected item in dicom pixel data'
+                raise Exception(msg)
+            fptr.seek(length, os.SEEK_CUR)
+        end = fptr.tell()
+    return end if end == size else None
+
+
+def redact_dicom_instance(path, tempdir, redactList, redactDict, deidField):
+    """
+    Redact one dicom instance file.  Only the data elements before the pixel
+    data are read and rewritten; the pixel data is copied from the source
+    file unchanged, so the memory used doesn't depend on the size of the
+    image.
+
+    :param path: the path of the source dicom file.
+    :param tempdir: a directory for work files and the final result.
+    :param redactList: the list of redactions (see get_redact_list).
+    :param redactDict: a dictionary of dicom keywords and new values.  Data
+        elements with empty values are removed.
+    :param deidField: the value for the ModifiedImageDescription of the main
+        image.
+    :returns: None if the instance was removed, otherwise a tuple of the
+        redacted file path, the kind of associated image ('label', 'macro',
+        or None for the main image), and the series number.
+    """
+    with open(path, 'rb') as fptr:
+        ds = pydicom.dcmread(fptr, stop_before_pixels=True)
+        pixelPos = fptr.tell()
+        pixelEnd = dicom_pixel_data_end(fptr, ds)
+    destpath = os.path.join(tempdir, f'{ds.SOPInstanceUID}.dcm')
+    imgtype = getattr(ds, 'ImageType', None)
+    kind = None
+    if 'LABEL' in imgtype:
+        if 'label' in redactList['images']:
+            return None
+        kind = 'label'
+    elif 'OVERVIEW' in imgtype:
+        if 'macro' in redactList['images']:
+            return None
+        kind = 'macro'
+    if pixelEnd is None:
+        ds = pydicom.dcmread(path)
+    for element in ds:
+        if element.keyword in redactDict:
+            value = redactDict[element.keyword]
+            if value is not None and value != '':
+                element.value = value
+            else:
+                del ds[element.tag]
+    if kind is None:
+        ds.ModifiedImageDescription = deidField
+    if pixelEnd is None:
+        ds.save_as(destpath)
+    else:
+        with open(path, 'rb') as fsrc, open(destpath, 'wb') as fdst:
+            ds.save_as(fdst)
+            copy_byte_range(fsrc, fdst, pixelPos, pixelEnd - pixelPos)
+    return destpath, kind, ds.SeriesNumber
+
+
 def redact_format_dicom(item, tempdir, redactList, title, labelImage, macroImage):  # noqa
     """
     Redact dicom files.
@@ -1380,39 +2008,43 @@ def redact_format_dicom(item, tempdir, redactList, title, labelImage, macroImage
     macropath = None
     destfiles = []
     maxSeriesNum = 0
-    for path in files:
-        # we can't do stop_before_pixels=True, as it wouldn't copy the image
-        ds = pydicom.dcmread(path)
-        destpath = os.path.join(tempdir, f'{ds.SOPInstanceUID}.dcm')
-        imgtype = getattr(ds, 'ImageType', None)
-        if 'LABEL' in imgtype:
-            if 'label' in redactList['images']:
+    deidField = get_deid_field(item)
+    workers = max(1, min(DicomRedactWorkers, len(files)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(
+            redact_dicom_instance, path, tempdir, redactList, redactDict, deidField)
+            for path in files]
+        for future in futures:
+            result = future.result()
+            if result is None:
                 continue
-            labelpath = destpath
-        elif 'OVERVIEW' in imgtype:
-            if 'macro' in redactList['images']:
+            destpath, kind, seriesNum = result
+            if kind == 'label':
+                labelpath = destpath
+            elif kind == 'macro':
+                macropath = destpath
+            destfiles.append(destpath)
+            maxSeriesNum = max(maxSeriesNum, seriesNum)
+        # Each new label and macro instance is its own file, so they can be
+        # written at the same time as long as the reference instance isn't
+        # one of the files being replaced.
+        rewritten = {labelpath if labelImage else None, macropath if macroImage else None}
+        refpath = next((path for path in destfiles if path not in rewritten), destfiles[0])
+        writes = []
+        for image, imgpath, imgtype, seriesNum in (
+                (labelImage, labelpath, 'LABEL', maxSeriesNum + 1),
+                (macroImage, macropath, 'OVERVIEW', maxSeriesNum + 2)):
+            if not image:
                 continue
-            macropath = destpath
-        for element in ds:
-            if element.keyword in redactDict:
-                value = redactDict[element.keyword]
-                if value is not None and value != '':
-                    element.value = value
-                else:
-                    del ds[element.tag]
-        if destpath not in {labelpath, macropath}:
-            ds.ModifiedImageDescription = get_deid_field(item)
-        ds.save_as(destpath)
-        destfiles.append(destpath)
-        maxSeriesNum = max(maxSeriesNum, ds.SeriesNumber)
-    if labelImage:
-        path = write_dicom_image(labelImage, labelpath, destfiles[0], 'LABEL', maxSeriesNum + 1)
-        if path and path not in destfiles:
-            destfiles.append(path)
-    if macroImage:
-        path = write_dicom_image(macroImage, macropath, destfiles[0], 'OVERVIEW', maxSeriesNum + 2)
-        if path and path not in destfiles:
-            destfiles.append(path)
+            future = executor.submit(
+                write_dicom_image, image, imgpath, refpath, imgtype, seriesNum)
+            if refpath in rewritten:
+                future.result()
+            writes.append(future)
+        for future in writes:
+            path = future.result()
+            if path and path not in destfiles:
+                destfiles.append(path)
     return destfiles, 'application/dicom'
 
 
@@ -1622,7 +2254,7 @@ def redact_format_philips(item, tempdir, redactList, title, labelImage, macroIma
             dictToEtree(xmldict), encoding='utf8', method='xml').decode(),
     }
     outputPath = os.path.join(tempdir, 'philips.tiff')
-    tifftools.write_tiff(ifds, outputPath)
+    write_redacted_tiff(tiffinfo, ifds, outputPath, redactList)
     return outputPath, 'image/tiff'
 
 
@@ -1681,19 +2313,22 @@ def imageToBase64(image, quality=85):
     return base64.b64encode(jpeg.getvalue()).decode()
 
 
-def redact_format_isyntax_images(tree, redactList, labelImage, macroImage, quality=90, prune=0):
+def redact_format_isyntax_images(tree, redactList, labelImage, macroImage, prune=0):
     """
-    Redact images from an isyntax file.  This accepts a quality parameter, so
-    that images can be shrunk to fit the available space.
+    Redact images from an isyntax file.  The data of the new label and macro
+    images is set to placeholder text, so that the rest of the xml can be
+    serialized once and the images encoded to fit the available space.
 
     :param tree: An ElementTree with the xml.  Possibly modified.
     :param redactList: the list of redactions (see get_redact_list).
     :param labelImage: a PIL image with a new label image.
     :param macroImage: a PIL image with a new macro image.  None to keep or
         redact the current macro image.
-    :param quality: the jpeg quality, where 100 is best quality.
     :param prune: if set, try to prune this many images for space.
+    :returns: a dictionary whose keys are the placeholder text as bytes and
+        whose values are the PIL images that replace them.
     """
+    placeholders = {}
     for key, pkey, img, idx in [
             ('macro', 'MACROIMAGE', macroImage, 0),
             ('label', 'LABELIMAGE', labelImage, 1)]:
@@ -1705,7 +2340,6 @@ def redact_format_isyntax_images(tree, redactList, labelImage, macroImage, quali
                 xentry.getparent().remove(xentry)
                 continue
         if img:
-            img64 = imageToBase64(img, quality)
             xentry = tree.find(
                 './Attribute[@Name="PIM_DP_SCANNED_IMAGES"]/Array/DataObject[Attribute="' +
                 pkey + '"]/Attribute[@Name="PIM_DP_IMAGE_DATA"]')
@@ -1723,7 +2357,81 @@ def redact_format_isyntax_images(tree, redactList, labelImage, macroImage, quali
             if xentry is None:
                 logger.info('Cannot add %s image' % key)
             else:
-                xentry.text = img64
+                xentry.text = 'WSI_DEID_%s_DATA' % pkey
+                placeholders[xentry.text.encode()] = img
+    return placeholders
+
+
+def redact_format_isyntax_metadata(old, redactList, newkeys, addKeys=True):
+    """
+    Parse the xml header of an isyntax file and redact its metadata.
+
+    :param old: the original xml header.
+    :param redactList: the list of redactions (see get_redact_list).
+    :param newkeys: a dictionary of keys that can be added if they are not in
+        the original header.
+    :param addKeys: if False, don't add keys that aren't in the original
+        header.
+    :returns: an ElementTree with the redacted xml.
+    """
+    tree = lxmlElementTree.fromstring(old, lxmlElementTree.XMLParser(remove_blank_text=True))
+    for mkey in redactList['metadata']:
+        processed = False
+        if mkey.startswith('internal;isyntax;'):
+            key = mkey.split(';', 2)[-1].upper()
+            value = redactList['metadata'][mkey]['value']
+            if key == 'BARCODE':
+                value = base64.b64encode(value.encode()).decode()
+            for xentry in tree.findall('Attribute'):
+                xkey = str(xentry.get('Name'))
+                if xkey == 'DICOM_' + key or (
+                        xkey.startswith('PI') and xkey.endswith('_' + key)):
+                    if redactList['metadata'][mkey]['value'] is not None:
+                        xentry.text = value
+                    else:
+                        xentry.getparent().remove(xentry)
+                    processed = True
+                    break
+            if (not processed and addKeys and key in newkeys and
+                    redactList['metadata'][mkey]['value']):
+                tree.append(lxmlElementTree.fromstring(
+                    '<Attribute Name="%s" Group="%s" Element="%s" '
+                    'PMSVR="%s">%s</Attribute>' % (
+                        newkeys[key]['name'], newkeys[key]['group'],
+                        newkeys[key]['element'], newkeys[key]['pmsvr'],
+                        xml.sax.saxutils.escape(value))))
+                processed = True
+        if not processed:
+            logger.info('Cannot redact %s' % mkey)
+    return tree
+
+
+def isyntax_strip_xml(result, stripping):
+    """
+    Remove whitespace between xml elements.
+
+    :param result: the serialized xml.
+    :param stripping: 0 to leave the xml as is, 1 to remove newlines before
+        closing tags, 2 to also remove newlines and tabs between elements, 3
+        to remove all newlines and tabs.
+    :returns: the stripped xml.
+    """
+    if stripping >= 1:
+        result = result.replace(b'>\n</', b'></')
+    if stripping >= 2:
+        result = result.replace(b'>\n<', b'><')
+        result = result.replace(b'>\t<', b'><')
+    if stripping >= 3:
+        result = result.replace(b'\n', b'')
+        result = result.replace(b'\t', b'')
+    return result
+
+
+# The jpeg qualities tried for isyntax label and macro images, best first.
+# The xml is only fully stripped of whitespace at IsyntaxStripQuality or
+# below.
+IsyntaxImageQualities = list(range(90, 15, -5))
+IsyntaxStripQuality = 80
 
 
 def redact_format_isyntax(item, tempdir, redactList, title, labelImage, macroImage):  # noqa
@@ -1741,6 +2449,7 @@ def redact_format_isyntax(item, tempdir, redactList, title, labelImage, macroIma
         its mimetype.
     """
     from . import __version__
+    from .import_export import copyFile
 
     newkeys = {
         'SOFTWARE_VERSIONS': {
@@ -1777,67 +2486,54 @@ def redact_format_isyntax(item, tempdir, redactList, title, labelImage, macroIma
             tileSource.getInternalMetadata()['isyntax'].get('software_versions', '') +
             ' "DSA Redaction %s' % __version__ + '"').strip())
     old = open(sourcePath, 'rb').read(tileSource._xmllen)
-    quality = 90
-    stripping = 0
-    prune = 0
-    while True:
-        tree = lxmlElementTree.fromstring(old, lxmlElementTree.XMLParser(remove_blank_text=True))
-        for mkey in redactList['metadata']:
-            processed = False
-            if mkey.startswith('internal;isyntax;'):
-                key = mkey.split(';', 2)[-1].upper()
-                value = redactList['metadata'][mkey]['value']
-                if key == 'BARCODE':
-                    value = base64.b64encode(value.encode()).decode()
-                for xentry in tree.findall('Attribute'):
-                    xkey = str(xentry.get('Name'))
-                    if xkey == 'DICOM_' + key or (
-                            xkey.startswith('PI') and xkey.endswith('_' + key)):
-                        if redactList['metadata'][mkey]['value'] is not None:
-                            xentry.text = value
-                        else:
-                            xentry.getparent().remove(xentry)
-                        processed = True
-                        break
-                if (not processed and prune < 3 and key in newkeys and
-                        redactList['metadata'][mkey]['value']):
-                    tree.append(lxmlElementTree.fromstring(
-                        '<Attribute Name="%s" Group="%s" Element="%s" '
-                        'PMSVR="%s">%s</Attribute>' % (
-                            newkeys[key]['name'], newkeys[key]['group'],
-                            newkeys[key]['element'], newkeys[key]['pmsvr'],
-                            xml.sax.saxutils.escape(value))))
-                    processed = True
-            if not processed:
-                logger.info('Cannot redact %s' % mkey)
-        stripping = 0
-        redact_format_isyntax_images(
-            tree, redactList, labelImage, macroImage, quality=quality, prune=prune)
-        result = header + lxmlElementTree.tostring(
+    encoded = {}
+
+    def imageLength(placeholder, quality):
+        if (placeholder, quality) not in encoded:
+            encoded[(placeholder, quality)] = imageToBase64(
+                placeholders[placeholder], quality).encode()
+        return len(encoded[(placeholder, quality)]) - len(placeholder)
+
+    def fit(quality):
+        length = sum(imageLength(placeholder, quality) for placeholder in placeholders)
+        for stripping in range(4 if quality <= IsyntaxStripQuality else 3):
+            if stripping not in stripped:
+                stripped[stripping] = isyntax_strip_xml(template, stripping)
+            if len(stripped[stripping]) + length <= tileSource._xmllen:
+                return stripping
+        return None
+
+    for prune in range(4):
+        tree = redact_format_isyntax_metadata(old, redactList, newkeys, prune < 3)
+        placeholders = redact_format_isyntax_images(
+            tree, redactList, labelImage, macroImage, prune=prune)
+        template = header + lxmlElementTree.tostring(
             tree, encoding='UTF-8', method='xml', pretty_print=False)
-        if len(result) > tileSource._xmllen:
-            result = result.replace(b'>\n</', b'></')
-            stripping = 1
-        if len(result) > tileSource._xmllen:
-            result = result.replace(b'>\n<', b'><')
-            result = result.replace(b'>\t<', b'><')
-            stripping = 2
-        if len(result) > tileSource._xmllen and quality <= 80:
-            result = result.replace(b'\n', b'')
-            result = result.replace(b'\t', b'')
-            stripping = 3
-        if len(result) <= tileSource._xmllen:
-            break
-        if quality <= 20:
-            prune += 1
-            quality = 90
-            if prune > 3:
-                break
+        stripped = {}
+        # Find the best quality where the xml fits.  This assumes that
+        # images don't get larger as the quality is reduced.
+        low, high = 0, len(IsyntaxImageQualities) - 1
+        if fit(IsyntaxImageQualities[low]) is not None:
+            high = low
+        elif fit(IsyntaxImageQualities[high]) is None:
             continue
-        quality -= 5
-    if len(result) > tileSource._xmllen:
+        while low < high:
+            mid = (low + high) // 2
+            if fit(IsyntaxImageQualities[mid]) is None:
+                low = mid + 1
+            else:
+                high = mid
+        quality = IsyntaxImageQualities[low]
+        stripping = fit(quality)
+        result = stripped[stripping]
+        for placeholder in placeholders:
+            result = result.replace(placeholder, encoded[(placeholder, quality)])
+        break
+    else:
+        length = len(isyntax_strip_xml(template, 3)) + sum(
+            imageLength(placeholder, IsyntaxImageQualities[-1]) for placeholder in placeholders)
         raise Exception('Generated XML is too long (original is %d, new is %d)' % (
-                        tileSource._xmllen, len(result)))
+                        tileSource._xmllen, length))
     logger.info('Old xml was %d bytes; new is %d with quality %d, stripping %d, prune %d',
                 tileSource._xmllen, len(result), quality, stripping, prune)
     if len(result) < tileSource._xmllen:
@@ -1847,16 +2543,11 @@ def redact_format_isyntax(item, tempdir, redactList, title, labelImage, macroIma
     if not ext:
         ext = '.isyntax'
     outputPath = os.path.join(tempdir, 'philips' + ext)
-    with open(outputPath, 'wb') as dest:
-        with open(sourcePath, 'rb') as src:
-            dest.write(result)
-            src.seek(tileSource._xmllen)
-            chunk = 1024 ** 2
-            while True:
-                data = src.read(chunk)
-                if not len(data):
-                    break
-                dest.write(data)
+    # The new header is the same length as the original, so copy the file
+    # (as a reflink or within the kernel if possible) and overwrite the header
+    copyFile(sourcePath, outputPath)
+    with open(outputPath, 'r+b') as dest:
+        dest.write(result)
     return outputPath, 'image/isyntax'
 
 
@@ -1967,27 +2658,226 @@ def get_allow_list():
     return 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/-:&.'
 
 
-def get_text_from_associated_image(tile_source, label, reader):
-    starttime = time.time()
+def get_ocr_key(tile_source):
+    """
+    Get the name of the associated image that should be used for OCR and
+    barcode reading.
+
+    :param tile_source: a large_image tile source.
+    :returns: the associated image key.
+    """
+    image_format = determine_format(tile_source)
+    key = 'label'
+    if image_format in ['aperio', 'philips', 'isyntax', 'ometiff', 'dicom']:
+        key = 'label'
+    elif image_format == 'hamamatsu':
+        key = 'macro'
+    return key
+
+
+def get_ocr_settings(label):
+    """
+    Get the settings used to run OCR on an associated image.
+
+    :param label: the associated image key.
+    :returns: a dictionary with the maximum size of the image used for OCR,
+        the parameters passed to the easyocr reader, whether an adaptive
+        rotation search is used, and, if so, the ocr_parse_values setting
+        that determines when the search can stop.
+    """
+    adaptive = config.getConfig('ocr_adaptive_rotation') is not False
+    return {
+        'maxSize': 2048 if label == 'macro' else 1024,
+        'readtext': {
+            'allowlist': get_allow_list(),
+            'contrast_ths': 0.75,
+            'adjust_contrast': 1.0,
+        },
+        'adaptive': adaptive,
+        'parse': (config.getConfig('ocr_parse_values') or []) if adaptive else None,
+    }
+
+
+def ocr_cache_key(image, kind, settings=None):
+    """
+    Compute a key for caching the results of reading text or barcodes from an
+    image.
+
+    :param image: a PIL image.
+    :param kind: the kind of result, such as 'ocr' or 'barcode'.
+    :param settings: a json-serializable value with any settings that affect
+        the result.
+    :returns: a hex digest of the image pixels and settings.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(
+        [kind, image.mode, image.size, settings], sort_keys=True).encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+def get_associated_image(tile_source, label):
+    """
+    Get an associated image as a decoded PIL image.
+
+    :param tile_source: a large_image tile source.
+    :param label: the associated image key.
+    :returns: a PIL image.
+    """
     associated_image, _ = tile_source.getAssociatedImage(label)
     associated_image = PIL.Image.open(io.BytesIO(associated_image))
+    associated_image.load()
+    return associated_image
+
+
+def get_associated_image_for_ocr(tile_source, label, associated_image=None):
+    """
+    Get an associated image reduced to the size used for OCR.
+
+    :param tile_source: a large_image tile source.
+    :param label: the associated image key.
+    :param associated_image: if not None, the decoded associated image.
+    :returns: a PIL image.
+    """
+    if associated_image is None:
+        associated_image = get_associated_image(tile_source, label)
     logger.info('%s %s size %r', tile_source.item['name'], label, associated_image.size)
-    maxSize = 2048 if label == 'macro' else 1024
+    maxSize = get_ocr_settings(label)['maxSize']
     if max(associated_image.size) > maxSize:
+        associated_image = associated_image.copy()
         associated_image.thumbnail((maxSize, maxSize), PIL.Image.LANCZOS)
+    return associated_image
+
+
+def ocr_rotations(image):
+    """
+    Get the rotations of an image that are checked for text.
+
+    :param image: a PIL image.
+    :returns: a list of PIL images.
+    """
+    return [image] + [image.transpose(rotate) for rotate in [
+        PIL.Image.ROTATE_90, PIL.Image.ROTATE_180, PIL.Image.ROTATE_270]]
+
+
+def ocr_rotation_order(image, orientation=False):
+    """
+    Rank the rotations returned by ocr_rotations by how likely they are to
+    have upright text.  If there is a barcode on the image, its orientation
+    is used for the first choice.  Otherwise, rows of text make the intensity
+    profile along the image's rows vary more than along its columns, so
+    rotations that keep the current rows horizontal are tried first if that
+    profile varies more.  Upright is preferred to upside down since that is
+    more common.
+
+    :param image: a PIL image.
+    :param orientation: the orientation of a barcode on the image in
+        clockwise degrees as found by get_image_barcode, None if the image
+        has no barcode, or False if this is not known, in which case the image
+        is checked for a barcode.
+    :returns: a list of indices into the list of rotations.
+    """
+    order = [0, 2, 1, 3]
+    gray = image.convert('L')
+    if max(gray.size) > 512:
+        gray = gray.copy()
+        gray.thumbnail((512, 512), PIL.Image.LANCZOS)
+    data = np.asarray(gray, dtype=float)
+    # Text is darker than its background; count how dark each pixel is
+    # relative to the typical brightness.
+    dark = np.clip(np.median(data) - data, 0, None)
+    rowScore = np.std(dark.mean(axis=1))
+    colScore = np.std(dark.mean(axis=0))
+    if colScore > rowScore:
+        order = [1, 3, 0, 2]
+    if orientation is False:
+        orientation = None
+        try:
+            import zxingcpp
+
+            for barcode in zxingcpp.read_barcodes(gray):
+                orientation = barcode.orientation
+                break
+        except Exception:
+            pass
+    if orientation is not None:
+        # Barcode orientation is clockwise in degrees; the rotations are
+        # counterclockwise
+        best = round(orientation / 90) % 4
+        order = [best] + [idx for idx in order if idx != best]
+    return order
+
+
+def get_ocr_parse_matchers(parselist, quiet=False):
+    """
+    Compile the entries of the ocr_parse_values setting.
+
+    :param parselist: the list of parse entries.
+    :param quiet: if False, log entries that can't be compiled.
+    :returns: a list of (key, compiled regular expression, confidence)
+        tuples.
+    """
+    matchers = []
+    for parseentry in parselist or []:
+        key = parseentry.get('key')
+        if not key:
+            continue
+        try:
+            if 'regex' in parseentry:
+                matcher = re.compile(parseentry['regex'])
+            else:
+                matcher = re.compile('^' + ''.join(
+                    '[0-9]' if c == '#' else '[A-Za-z]' if c == '@' else
+                    re.escape(c) for c in parseentry['pattern']) + '$')
+        except Exception:
+            if not quiet:
+                logger.debug(f'Failed to generate matcher for {parseentry}')
+            continue
+        matchers.append((key, matcher, parseentry.get('confidence', 0.9)))
+    return matchers
+
+
+# When there are no ocr_parse_values, the rotation search stops when at least
+# this many words of more than one character are found with this confidence
+OCRSufficientWords = 3
+OCRSufficientConfidence = 0.9
+
+
+def ocr_results_sufficient(words, matchers):
+    """
+    Check if the OCR results of the rotations tried so far are good enough
+    that the remaining rotations don't need to be tried.
+
+    :param words: a dictionary of found text as returned by
+        aggregate_ocr_results.
+    :param matchers: a list of compiled ocr_parse_values as returned by
+        get_ocr_parse_matchers.  If this is not empty, the results are
+        sufficient if every key has a confident match.
+    :returns: True if the results are sufficient.
+    """
+    if matchers:
+        keys = {key for key, _, _ in matchers}
+        for key, matcher, confidence in matchers:
+            if key in keys and any(
+                    record['average_confidence'] >= confidence and matcher.match(word)
+                    for word, record in words.items()):
+                keys.discard(key)
+        return not keys
+    return sum(1 for word, record in words.items() if len(word) > 1 and
+               record['average_confidence'] >= OCRSufficientConfidence) >= OCRSufficientWords
+
+
+def aggregate_ocr_results(text_results_list):
+    """
+    Combine the OCR results of several rotations of an image.
+
+    :param text_results_list: a list of results from easyocr, each of which
+        is a list of text box coordinates, text, and confidence.
+    :returns: a dictionary of found text, each with a count and an
+        average_confidence, sorted so the most confident is first.
+    """
     words = {}
-    for rotate in [None, PIL.Image.ROTATE_90, PIL.Image.ROTATE_180, PIL.Image.ROTATE_270]:
-        if rotate is not None:
-            rotated_image = associated_image.transpose(rotate)
-        text_results = reader.readtext(
-            np.asarray(associated_image if rotate is None else rotated_image),
-            allowlist=get_allow_list(),
-            contrast_ths=0.75,
-            adjust_contrast=1.0,
-            # This probably isn't useful if we are already trying all rotations
-            # rotation_info=[90, 180, 270],
-            # Note: batch_size didn't help anything
-        )
+    for text_results in text_results_list:
         for result in text_results:
             # easyocr returns the text box coordinates, text, and confidence
             _, found_text, confidence = result
@@ -1999,12 +2889,163 @@ def get_text_from_associated_image(tile_source, label, reader):
             result_info['average_confidence'] = result_avg_conf
             words[found_text] = result_info
     # Sort so the most confident is first
-    words = {k: v for _, k, v in sorted((-v['average_confidence'], k, v) for k, v in words.items())}
-    logger.info('Ran OCR on %s %s in %5.3fs', tile_source.item['name'],
-                label, time.time() - starttime)
+    return {k: v for _, k, v in sorted(
+        (-v['average_confidence'], k, v) for k, v in words.items())}
+
+
+def get_text_from_associated_image(
+        tile_source, label, reader=None, associated_image=None, orientation=False):
+    """
+    Run OCR on an associated image of a tile source.
+
+    :param tile_source: a large_image tile source.
+    :param label: the associated image key.
+    :param reader: the easyocr reader.  If None, OCR is done by the pool of
+        OCR worker processes.
+    :param associated_image: if not None, the decoded associated image.
+    :param orientation: the barcode orientation of the image (see
+        ocr_rotation_order).
+    :returns: a dictionary of found text.
+    """
+    return get_text_from_associated_images(
+        [(tile_source, label, associated_image)], reader, batch_images=None,
+        orientations=[orientation])[0]
+
+
+def _run_ocr_batches(images, params, reader=None, batch_images=16):
+    """
+    Run OCR on a list of images.
+
+    :param images: a list of (key, numpy array) tuples.
+    :param params: a dictionary of parameters for the easyocr reader.
+    :param reader: the easyocr reader.  If None, the work is distributed to
+        the pool of OCR worker processes.
+    :param batch_images: the maximum number of images in a batch.  If None,
+        images are read individually.  Otherwise, images with the same shape
+        are read in small batches so that the text detection model runs on a
+        batch of images at once.  Images are never padded or resized to make
+        a batch, so each image is read exactly as it would be individually.
+    :returns: a list of (key, easyocr result) tuples in the order of the
+        images.
+    """
+    if batch_images is None:
+        arrays = [entry[1] for entry in images]
+        if reader is None:
+            results = ocr.readtext(arrays, params)()
+        else:
+            results = [reader.readtext(array, **params) for array in arrays]
+        return [(entry[0], result) for entry, result in zip(images, results)]
+    shapes = {}
+    for pos, entry in enumerate(images):
+        shapes.setdefault(entry[1].shape, []).append(pos)
+    batches = []
+    for group in shapes.values():
+        for start in range(0, len(group), batch_images):
+            batch = group[start:start + batch_images]
+            batch_arrays = [images[pos][1] for pos in batch]
+            if reader is None:
+                batches.append((batch, ocr.readtext(batch_arrays, params, batch_images)))
+            else:
+                batches.append((batch, reader.readtext_batched(
+                    batch_arrays, **params, batch_size=batch_images)))
+    results = [None] * len(images)
+    for batch, batchResults in batches:
+        if reader is None:
+            batchResults = batchResults()
+        for pos, result in zip(batch, batchResults):
+            results[pos] = (images[pos][0], result)
+    return results
+
+
+def get_text_from_associated_images(sources, reader=None, batch_images=16, orientations=None):
+    """
+    Run OCR on the associated images of several tile sources.
+
+    Each image is checked for text in four rotations.  If the
+    ocr_adaptive_rotation setting is not False, the rotations are ranked by
+    ocr_rotation_order and only the most likely rotation is read first; the
+    remaining rotations are only read for images where this doesn't find
+    enough confident text (see ocr_results_sufficient).
+
+    :param sources: a list of (tile source, associated image key) tuples.
+        Each tuple may have a third value of the decoded associated image.
+    :param reader: the easyocr reader.  If None, the batches are distributed
+        to the pool of OCR worker processes.
+    :param batch_images: the maximum number of images in a batch.  If None,
+        images are read individually rather than in batches.
+    :param orientations: if not None, a list with the barcode orientation of
+        each source (see ocr_rotation_order).  This avoids reading barcodes
+        again to rank the rotations of images whose barcodes have already
+        been read.
+    :returns: a list with one entry per source.  Each entry is a dictionary
+        of found text as returned by aggregate_ocr_results or None if the
+        associated image could not be read.
+    """
+    starttime = time.time()
+    settings = get_ocr_settings('label')
+    matchers = get_ocr_parse_matchers(settings['parse'], quiet=True)
+    rotations = {}
+    pending = []
+    text_results = [None] * len(sources)
+    for idx, source in enumerate(sources):
+        tile_source, label = source[:2]
+        try:
+            associated_image = get_associated_image_for_ocr(
+                tile_source, label, *source[2:]).convert('RGB')
+        except Exception:
+            logger.exception('Failed to get %s image for OCR', label)
+            continue
+        text_results[idx] = []
+        rotations[idx] = [np.asarray(rotated_image) for rotated_image in ocr_rotations(
+            associated_image)]
+        order = ocr_rotation_order(
+            associated_image, orientations[idx] if orientations else False,
+        ) if settings['adaptive'] else [0, 1, 2, 3]
+        pending.append((idx, order))
+    passes = 0
+    while pending:
+        # The first pass of an adaptive search only reads the most likely
+        # rotation of each image; later passes read all remaining rotations.
+        first = settings['adaptive'] and not passes
+        images = [((idx, rot), rotations[idx][rot])
+                  for idx, order in pending for rot in (order[:1] if first else order)]
+        for (idx, _), result in _run_ocr_batches(
+                images, settings['readtext'], reader, batch_images):
+            text_results[idx].append(result)
+        pending = [(idx, order[1:]) for idx, order in pending if first and not (
+            ocr_results_sufficient(aggregate_ocr_results(text_results[idx]), matchers))]
+        passes += 1
+    words = [aggregate_ocr_results(result) if result is not None else None
+             for result in text_results]
+    if len(sources) == 1:
+        logger.info('Ran OCR on %s %s in %5.3fs', sources[0][0].item['name'],
+                    sources[0][1], time.time() - starttime)
+    else:
+        logger.info('Ran OCR on %d images in %5.3fs', len(sources), time.time() - starttime)
     return words
 
 
+def get_cached_text(tile_source, key):
+    """
+    Get the decoded associated image used for OCR and any cached OCR results
+    for it.
+
+    :param tile_source: a large_image tile source.
+    :param key: the associated image key.
+    :returns: the decoded associated image, the cache key, and the cached
+        results or None if there are no cached results.
+    """
+    from .models import OCRCache
+
+    associated_image = get_associated_image(tile_source, key)
+    cacheKey = ocr_cache_key(associated_image, 'ocr', get_ocr_settings(key))
+    cached = OCRCache().getResult(cacheKey)
+    if cached is not None:
+        logger.info('Using cached OCR results for %s %s', tile_source.item['name'], key)
+        cached = dict(cached)
+    return associated_image, cacheKey, cached
+
+
 def get_image_text(item):
     """
     Use OCR to identify and return text on any associated image.
@@ -2012,17 +3053,18 @@ def get_image_text(item):
     :param item: a girder item.
     :returns: a list of found text .
     """
-    reader = get_reader()
+    from .models import OCRCache
+
     results = []
     tile_source = ImageItem().tileSource(item)
-    image_format = determine_format(tile_source)
-    key = 'label'
-    if image_format in ['aperio', 'philips', 'isyntax', 'ometiff', 'dicom']:
-        key = 'label'
-    elif image_format == 'hamamatsu':
-        key = 'macro'
+    key = get_ocr_key(tile_source)
     try:
-        results = get_text_from_associated_image(tile_source, key, reader)
+        associated_image, cacheKey, results = get_cached_text(tile_source, key)
+        if results is None:
+            results = get_text_from_associated_image(
+                tile_source, key, associated_image=associated_image,
+                orientation=get_cached_barcode_orientation(associated_image))
+            OCRCache().setResult(cacheKey, 'ocr', [[k, v] for k, v in results.items()])
     except Exception:
         results = {}
         logger.exception('Failed in OCR')
@@ -2030,24 +3072,118 @@ def get_image_text(item):
     return results
 
 
-def read_barcodes(img):
+def get_images_text(items):
+    """
+    Use OCR to identify and return text on the associated images of several
+    items at once.
+
+    :param items: a list of girder items.
+    :returns: a list of found text dictionaries, one per item.
+    """
+    from .models import OCRCache
+
+    keys = [None] * len(items)
+    results = [{}] * len(items)
+    sources = []
+    for idx, item in enumerate(items):
+        try:
+            tile_source = ImageItem().tileSource(item)
+            keys[idx] = get_ocr_key(tile_source)
+            associated_image, cacheKey, cached = get_cached_text(tile_source, keys[idx])
+            if cached is not None:
+                results[idx] = cached
+            else:
+                sources.append((idx, cacheKey, (tile_source, keys[idx], associated_image),
+                                get_cached_barcode_orientation(associated_image)))
+        except Exception:
+            logger.exception('Failed to get image for OCR for %s', item['name'])
+    if len(sources):
+        try:
+            found = get_text_from_associated_images(
+                [source for _, _, source, _ in sources],
+                orientations=[orientation for _, _, _, orientation in sources])
+            for (idx, cacheKey, _, _), result in zip(sources, found):
+                if result is not None:
+                    results[idx] = result
+                    OCRCache().setResult(cacheKey, 'ocr', [[k, v] for k, v in result.items()])
+        except Exception:
+            logger.exception('Failed in OCR')
+    for item, key, result in zip(items, keys, results):
+        if key is not None:
+            ImageItem().setMetadata(item, {f'{key}_ocr': result})
+    return results
+
+
+# Change this if read_barcodes changes in a way that affects its results so
+# that cached barcode results are not reused
+BarcodeReaderVersion = 4
+
+
+def barcode_candidate_regions(barcodes, img, margin=0.25, maxRegions=16):
     """
-    Read barcodes from a PIL image.  This also checks if taking subregions of
-    the image yield barcodes.  All unique barcodes are returned.
+    Get the regions of an image where the barcode reader located a barcode
+    but could not decode it.
+
+    :param barcodes: a list of zxingcpp barcodes read with return_errors.
+    :param img: the PIL Image that was read.
+    :param margin: the fraction of the barcode's size to add on each side of
+        its bounding box.
+    :param maxRegions: the maximum number of regions to return.  The largest
+        regions are returned.
+    :returns: a list of (left, top, right, bottom) boxes in image pixels.
+    """
+    regions = []
+    for barcode in barcodes:
+        if barcode.valid:
+            continue
+        pos = barcode.position
+        corners = [pos.top_left, pos.top_right, pos.bottom_right, pos.bottom_left]
+        left, right = min(pt.x for pt in corners), max(pt.x for pt in corners)
+        top, bottom = min(pt.y for pt in corners), max(pt.y for pt in corners)
+        dx, dy = int((right - left) * margin) + 1, int((bottom - top) * margin) + 1
+        box = (max(left - dx, 0), max(top - dy, 0),
+               min(right + dx, img.width), min(bottom + dy, img.height))
+        if box[2] > box[0] and box[3] > box[1] and box not in regions:
+            regions.append(box)
+    regions.sort(key=lambda box: -(box[2] - box[0]) * (box[3] - box[1]))
+    return regions[:maxRegions]
+
+
+def read_barcodes(img, maxScale=4):
+    """
+    Read barcodes from a PIL image.  The whole image is read once; the reader
+    also checks downscaled versions of the image.  Barcodes that the reader
+    locates but can't decode are then read again from just their region,
+    since barcodes are sometimes only decoded when the reader sees a smaller
+    area.  If no barcodes are found, overlapping crops of the image are read
+    at increasing scales, as small barcodes on a large image are sometimes
+    only found this way; this stops at the first scale that finds a barcode.
+    All unique barcodes are returned.
 
     :param img: a PIL Image.
+    :param maxScale: the largest number of crops across the width and height
+        of the image when no barcodes are found on the whole image.
     :returns: a list of zxingcpp barcodes.
     """
     import zxingcpp
 
+    gray = img.convert('L')
+    found = zxingcpp.read_barcodes(gray, return_errors=True)
     results = []
-    for scale in range(1, 4 + 1):
-        w2 = img.width // scale
-        h2 = img.height // scale
-        for yy in range(0, img.height - h2 + 1, h2 // 2):
-            for xx in range(0, img.width - w2 + 1, w2 // 2):
-                barcodes = zxingcpp.read_barcodes(img.crop((xx, yy, xx + w2, yy + h2)))
-                for result in barcodes:
+    for barcodes in [found] + [
+            zxingcpp.read_barcodes(gray.crop(box))
+            for box in barcode_candidate_regions(found, gray)]:
+        for result in barcodes:
+            if result.valid and result.text not in {r.text for r in results}:
+                results.append(result)
+    for scale in range(2, maxScale + 1):
+        if results:
+            break
+        w2 = gray.width // scale
+        h2 = gray.height // scale
+        for yy in range(0, gray.height - h2 + 1, max(h2 // 2, 1)):
+            for xx in range(0, gray.width - w2 + 1, max(w2 // 2, 1)):
+                for result in zxingcpp.read_barcodes(gray.crop((xx, yy, xx + w2, yy + h2))):
                     if result.text not in {r.text for r in results}:
                         results.append(result)
     return results
@@ -2060,26 +3196,52 @@ def get_image_barcode(item):
     :param item: a girder item.
     :returns: a list of found text .
     """
+    from .models import OCRCache
+
     results = []
     tile_source = ImageItem().tileSource(item)
-    image_format = determine_format(tile_source)
-    key = 'label'
-    if image_format in ['aperio', 'philips', 'isyntax', 'ometiff', 'dicom']:
-        key = 'label'
-    elif image_format == 'hamamatsu':
-        key = 'macro'
-    associated_image, _ = tile_source.getAssociatedImage(key)
-    associated_image = PIL.Image.open(io.BytesIO(associated_image))
-    results = {}
-    try:
-        barcodes = read_barcodes(associated_image)
-        results = [entry.text for entry in barcodes]
-    except Exception:
-        logger.exception('Failed in barcode reader')
+    key = get_ocr_key(tile_source)
+    associated_image = get_associated_image(tile_source, key)
+    cacheKey = ocr_cache_key(associated_image, 'barcode', BarcodeReaderVersion)
+    results = OCRCache().getResult(cacheKey)
+    if isinstance(results, dict):
+        results = results['text']
+    if results is None:
+        results = {}
+        try:
+            barcodes = read_barcodes(associated_image)
+            results = [entry.text for entry in barcodes]
+            # The orientation is used to choose which rotation of the image
+            # to read first when running OCR (see ocr_rotation_order)
+            OCRCache().setResult(cacheKey, 'barcode', {
+                'text': results,
+                'orientation': barcodes[0].orientation if barcodes else None})
+        except Exception:
+            logger.exception('Failed in barcode reader')
     item = ImageItem().setMetadata(item, {f'{key}_barcode': results})
     return results
 
 
+def get_cached_barcode_orientation(associated_image):
+    """
+    Get the orientation of the first barcode on an image from the results of
+    get_image_barcode.
+
+    :param associated_image: the decoded associated image.
+    :returns: the orientation in clockwise degrees, None if the image has no
+        barcodes, or False if the image's barcodes haven't been read.
+    """
+    from .models import OCRCache
+
+    cached = OCRCache().getResult(ocr_cache_key(
+        associated_image, 'barcode', BarcodeReaderVersion))
+    if isinstance(cached, dict):
+        return cached.get('orientation')
+    # Results cached before the orientation was stored only say if there are
+    # no barcodes
+    return None if cached == [] else False
+
+
 def get_image_name(prefix, info, item, forFolder=False):
     template = config.getConfig(
         'name_template' if not forFolder else 'folder_template') or '{tokenId}'
@@ -2116,22 +3278,9 @@ def parse_ocr_values(item, quiet=False):
     if not parselist or not len(parselist):
         return {}
     results = {}
-    for parseentry in parselist:
-        key = parseentry['key']
-        if not key or key in results:
-            continue
-        try:
-            if 'regex' in parseentry:
-                matcher = re.compile(parseentry['regex'])
-            else:
-                matcher = re.compile('^' + ''.join(
-                    '[0-9]' if c == '#' else '[A-Za-z]' if c == '@' else
-                    re.escape(c) for c in parseentry['pattern']) + '$')
-        except Exception:
-            if not quiet:
-                logger.debug(f'Failed to generate matcher for {parseentry}')
+    for key, matcher, confidence in get_ocr_parse_matchers(parselist, quiet):
+        if key in results:
             continue
-        confidence = parseentry.get('confidence', 0.9)
         for label, record in ocrdata.items():
             if record.get('average_confidence', 0) < confidence:
                 continue
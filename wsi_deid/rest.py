@@ -1,14 +1,17 @@
+import concurrent.futures
 import copy
 import datetime
 import json
 import os
 import re
+import shutil
 import tempfile
 import threading
 import time
 
 import girder_large_image
 import histomicsui.handlers
+import psutil
 from bson import ObjectId
 from girder import logger
 from girder.api import access
@@ -27,7 +30,7 @@ from girder.utility.progress import ProgressContext, setResponseTimeLimit
 from girder_jobs.models.job import Job
 from girder_large_image.models.image_item import ImageItem
 
-from . import config, import_export, process
+from . import config, import_export, jobs, process
 from .constants import PluginSettings, ProjectFolders, TokenOnlyPrefix
 
 IngestLock = threading.Lock()
@@ -133,13 +136,93 @@ def quarantine_item(item, user, *args, **kwargs):
 histomicsui.handlers.quarantine_item = quarantine_item
 
 
-def process_item(item, user=None):  # noqa
+def redact_item_files(item, tempdir):
+    """
+    Generate the redacted files for an item without modifying the item.
+
+    :param item: the item model to redact.
+    :param tempdir: a directory for work files and the redacted files.
+    :returns: a list of redacted file paths and a dictionary of information
+        about the redaction.
+    """
+    try:
+        filepaths, info = process.redact_item(item, tempdir)
+    except Exception as e:
+        logger.exception('Failed to redact item')
+        raise RestException(e.args[0])
+    if not isinstance(filepaths, list):
+        filepaths = [filepaths]
+    return filepaths, info
+
+
+def redact_worker_count(count):
+    """
+    Determine how many items should be redacted concurrently.  This is limited
+    by the redact_concurrency setting (0 to use the number of CPUs) and by the
+    available memory based on the redact_memory_per_worker setting (in GB).
+
+    :param count: the number of items that will be redacted.
+    :returns: the number of items to redact concurrently.
+    """
+    workers = int(config.getConfig('redact_concurrency') or 0) or os.cpu_count() or 1
+    memoryPerWorker = float(config.getConfig('redact_memory_per_worker') or 0)
+    if memoryPerWorker > 0:
+        workers = min(workers, int(
+            psutil.virtual_memory().available / (memoryPerWorker * 1024 ** 3)))
+    return max(1, min(workers, count))
+
+
+def redact_items_ahead(items):
+    """
+    Generate the redacted files for a list of items, redacting several items
+    concurrently.  Results are yielded in the order of the items.  Only a few
+    items beyond the current one are redacted ahead of time, and the files of
+    each result are removed when the next result is requested.  If an item
+    fails to redact, its exception is raised in its place, and the items that
+    were being redacted ahead of it are cancelled or allowed to finish and
+    then discarded.
+
+    :param items: a list of item models to redact.
+    :yields: for each item, a list of redacted file paths and a dictionary of
+        information about the redaction.
+    """
+    workers = redact_worker_count(len(items))
+    pending = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for idx in range(len(items)):
+            for nextidx in range(idx, min(idx + workers, len(items))):
+                if nextidx not in pending:
+                    tempdir = tempfile.mkdtemp(prefix='wsi_deid')
+                    pending[nextidx] = (tempdir, executor.submit(
+                        redact_item_files, items[nextidx], tempdir))
+            tempdir, future = pending[idx]
+            try:
+                yield future.result()
+            finally:
+                del pending[idx]
+                shutil.rmtree(tempdir, ignore_errors=True)
+    finally:
+        # If an item failed or the results are no longer wanted, cancel the
+        # items that haven't started and wait for the ones that have, so no
+        # redaction is left writing to a directory we are about to remove.
+        for _, future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+        for tempdir, _ in pending.values():
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def process_item(item, user=None, redacted=None):  # noqa
     """
     Copy an item to the original folder.  Modify the item by processing it and
     generating a new, redacted file.  Move the item to the processed folder.
 
     :param item: the item model to move.
     :param user: the user performing the processing.
+    :param redacted: if not None, the list of redacted file paths and the
+        redaction information returned by redact_item_files.  Otherwise, the
+        redacted files are generated.
     :returns: the item after move.
     """
     from . import __version__
@@ -154,62 +237,58 @@ def process_item(item, user=None):  # noqa
     if not origFolder or not procFolder:
         msg = 'The appropriate folder does not exist.'
         raise RestException(msg)
-    creator = User().load(item['creatorId'], force=True)
     # Generate the redacted file first, so if it fails we don't do anything
     # else
-    with tempfile.TemporaryDirectory(prefix='wsi_deid') as tempdir:
-        try:
-            filepaths, info = process.redact_item(item, tempdir)
-        except Exception as e:
-            logger.exception('Failed to redact item')
-            raise RestException(e.args[0])
-        if not isinstance(filepaths, list):
-            filepaths = [filepaths]
-        origFolder, _ = create_folder_hierarchy(item, user, origFolder)
-        origItem = Item().copyItem(item, creator, folder=origFolder)
-        origItem = Item().setMetadata(origItem, {
-            'wsi_deidProcessed': {
-                'itemId': str(item['_id']),
-                'time': datetime.datetime.utcnow().isoformat(),
-                'user': str(user['_id']) if user else None,
-            },
-        })
-        ImageItem().delete(item)
-        origSize = 0
-        for childFile in Item().childFiles(item):
-            origSize += childFile['size']
-            File().remove(childFile)
-        newName = item['name']
-        if len(process.splitallext(newName)[1]) <= 1:
-            newName = process.splitallext(item['name'])[0] + process.splitallext(filepaths[0])[1]
-        if len(filepaths) > 1:
-            newName = process.splitallext(item['name'])[0] + os.path.splitext(filepaths[0])[1]
-        newSize = 0
-        for filepath in filepaths:
-            newSize += os.path.getsize(filepath)
-            with open(filepath, 'rb') as f:
-                Upload().uploadFromFile(
-                    f, size=os.path.getsize(filepath),
-                    name=os.path.basename(filepath) if len(filepaths) > 1 else newName,
-                    parentType='item', parent=item, user=creator,
-                    mimeType=info['mimetype'])
-        item = Item().load(item['_id'], force=True)
-        if len(filepaths) > 1:
-            for idx in range(len(filepaths)):
-                try:
-                    ImageItem().delete(item)
-                except Exception:
-                    pass
-                item = Item().load(item['_id'], force=True)
-                try:
-                    ImageItem().createImageItem(
-                        item, list(Item().childFiles(item))[idx], user=user, createJob=False)
-                    break
-                except Exception:
-                    if idx + 1 == len(filepaths):
-                        raise
+    if redacted is None:
+        with tempfile.TemporaryDirectory(prefix='wsi_deid') as tempdir:
+            return process_item(item, user, redact_item_files(item, tempdir))
+    filepaths, info = redacted
+    creator = User().load(item['creatorId'], force=True)
+    origFolder, _ = create_folder_hierarchy(item, user, origFolder)
+    origItem = Item().copyItem(item, creator, folder=origFolder)
+    origItem = Item().setMetadata(origItem, {
+        'wsi_deidProcessed': {
+            'itemId': str(item['_id']),
+            'time': datetime.datetime.utcnow().isoformat(),
+            'user': str(user['_id']) if user else None,
+        },
+    })
+    ImageItem().delete(item)
+    origSize = 0
+    for childFile in Item().childFiles(item):
+        origSize += childFile['size']
+        File().remove(childFile)
+    newName = item['name']
+    if len(process.splitallext(newName)[1]) <= 1:
+        newName = process.splitallext(item['name'])[0] + process.splitallext(filepaths[0])[1]
+    if len(filepaths) > 1:
+        newName = process.splitallext(item['name'])[0] + os.path.splitext(filepaths[0])[1]
+    newSize = 0
+    for filepath in filepaths:
+        newSize += os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            Upload().uploadFromFile(
+                f, size=os.path.getsize(filepath),
+                name=os.path.basename(filepath) if len(filepaths) > 1 else newName,
+                parentType='item', parent=item, user=creator,
+                mimeType=info['mimetype'])
+    item = Item().load(item['_id'], force=True)
+    if len(filepaths) > 1:
+        for idx in range(len(filepaths)):
+            try:
+                ImageItem().delete(item)
+            except Exception:
+                pass
             item = Item().load(item['_id'], force=True)
-        item['name'] = newName
+            try:
+                ImageItem().createImageItem(
+                    item, list(Item().childFiles(item))[idx], user=user, createJob=False)
+                break
+            except Exception:
+                if idx + 1 == len(filepaths):
+                    raise
+        item = Item().load(item['_id'], force=True)
+    item['name'] = newName
     item.setdefault('meta', {})
     item['meta'].setdefault('redacted', [])
     item['meta']['redacted'].append({
@@ -258,6 +337,121 @@ def ocr_item(item, user):
     }
 
 
+def action_for_item(item, user, action, options=None):
+    """
+    Given an item, user, an action, return a function and parameters to
+    execute that action.
+
+    :param item: an item document.
+    :param user: the user document.
+    :param action: an action string.
+    :returns: the action function, a tuple of arguments to pass to it, the
+        name of the action, and the present participle of the action.
+    """
+    actionmap = {
+        'quarantine': (
+            histomicsui.handlers.quarantine_item, (item, user, False),
+            'quarantine', 'quarantining'),
+        'unquarantine': (
+            histomicsui.handlers.restore_quarantine_item, (item, user),
+            'unquarantine', 'unquaranting'),
+        'reject': (
+            move_item, (item, user, PluginSettings.HUI_REJECTED_FOLDER, options),
+            'reject', 'rejecting'),
+        'finish': (
+            move_item, (item, user, PluginSettings.HUI_FINISHED_FOLDER),
+            'approve', 'approving'),
+        'process': (
+            process_item, (item, user),
+            'redact', 'redacting'),
+        'ocr': (
+            ocr_item, (item, user),
+            'scan', 'scanning'),
+    }
+    return actionmap[action]
+
+
+def item_list_action(action, items, user, ctx, job=None):
+    """
+    Perform an action on a list of items in order.  Processing stops at the
+    first item where the action fails.
+
+    :param action: an action string.
+    :param items: a list of item documents.
+    :param user: the user document.
+    :param ctx: a progress context.
+    :param job: if not None, a job used to log the status of each item.
+    """
+    with ItemActionLock:
+        ItemActionList.extend(items)
+    # Redact items concurrently, but finish them in order
+    redactions = redact_items_ahead(items) if action == 'process' else None
+    try:
+        for idx, item in enumerate(items):
+            actionfunc, actionargs, actname, pp = action_for_item(item, user, action)
+            ctx.update(
+                message='%s %s' % (pp.capitalize(), item['name']),
+                total=len(items), current=idx)
+            if job is not None:
+                job = Job().updateJob(
+                    job, log='%s %s\n' % (pp.capitalize(), item['name']),
+                    progressTotal=len(items), progressCurrent=idx)
+            try:
+                if redactions is not None:
+                    actionargs += (next(redactions), )
+                actionfunc(*actionargs)
+                if job is not None:
+                    # Record finished items so a resumed job can skip them
+                    Job().collection.update_one(
+                        {'_id': job['_id']}, {'$addToSet': {'kwargs.done': str(item['_id'])}})
+            except Exception as exc:
+                logger.exception('Failed to %s item' % actname)
+                ctx.update('Error %s %s' % (pp, item['name']))
+                if job is not None:
+                    Job().updateJob(job, log='Failed to %s %s: %s\n' % (
+                        actname, item['name'], exc))
+                raise
+        ctx.update(message='Done %s' % pp, total=len(items), current=len(items))
+        if job is not None:
+            Job().updateJob(job, progressTotal=len(items), progressCurrent=len(items))
+    finally:
+        if redactions is not None:
+            redactions.close()
+        with ItemActionLock:
+            for item in items:
+                ItemActionList.remove(item)
+
+
+def batch_process_job(action, items, user, resume=False):
+    """
+    Start a job that performs an action on a list of items.
+
+    :param action: an action string.
+    :param items: a list of item documents.
+    :param user: the user document.
+    :param resume: if True, the job is continuing a previous job, and items
+        that have already had the action performed are skipped.  The ids of
+        items that are finished are recorded in the job's kwargs.done list.
+    :returns: the job document.
+    """
+    jobStart = datetime.datetime.now().strftime('%Y%m%d %H%M%S')
+    actname = action_for_item(items[0], user, action)[2]
+    job = Job().createLocalJob(
+        module='wsi_deid.jobs',
+        function='start_batch_process_job',
+        title=f'Batch {actname} of {len(items)} items: {user["login"]}, {jobStart}',
+        type='wsi_deid.batch_process',
+        user=user,
+        asynchronous=True,
+        args=(action, [str(item['_id']) for item in items]),
+        kwargs={'resume': resume},
+    )
+    # The job is run by this process, so claim it before it is queued.
+    jobs.batch_process_job_claim(job)
+    Job().scheduleJob(job=job)
+    return job
+
+
 def get_first_item(folder, user, exclude=None, excludeFolders=False):
     """
     Get the first item in a folder or any subfolder of that folder.  The items
@@ -361,37 +555,7 @@ class WSIDeIDResource(Resource):
         return import_export.isProjectFolder(folder)
 
     def _actionForItem(self, item, user, action, options=None):
-        """
-        Given an item, user, an action, return a function and parameters to
-        execute that action.
-
-        :param item: an item document.
-        :param user: the user document.
-        :param action: an action string.
-        :returns: the action function, a tuple of arguments to pass to it, the
-            name of the action, and the present participle of the action.
-        """
-        actionmap = {
-            'quarantine': (
-                histomicsui.handlers.quarantine_item, (item, user, False),
-                'quarantine', 'quarantining'),
-            'unquarantine': (
-                histomicsui.handlers.restore_quarantine_item, (item, user),
-                'unquarantine', 'unquaranting'),
-            'reject': (
-                move_item, (item, user, PluginSettings.HUI_REJECTED_FOLDER, options),
-                'reject', 'rejecting'),
-            'finish': (
-                move_item, (item, user, PluginSettings.HUI_FINISHED_FOLDER),
-                'approve', 'approving'),
-            'process': (
-                process_item, (item, user),
-                'redact', 'redacting'),
-            'ocr': (
-                ocr_item, (item, user),
-                'scan', 'scanning'),
-        }
-        return actionmap[action]
+        return action_for_item(item, user, action, options)
 
     @autoDescribeRoute(
         Description('Perform an action on an item.')
@@ -704,7 +868,10 @@ class WSIDeIDResource(Resource):
         return response
 
     @autoDescribeRoute(
-        Description('Perform an action on a list of items.')
+        Description('Perform an action on a list of items in a background job.')
+        .notes('Returns an object with the action, the number of items (count), '
+               'and, if there are any items, the id of the background job (jobId).  '
+               'The status of each item is logged in the job.')
         .jsonParam('ids', 'A list of item ids to redact', required=True)
         # Allow all users to do redaction actions; change to WRITE otherwise
         .param('action', 'Action to perform on the item.  One of process, '
@@ -715,47 +882,21 @@ class WSIDeIDResource(Resource):
     )
     @access.user
     def itemListAction(self, ids, action):
-        setResponseTimeLimit(86400)
-        if not len(ids):
-            return
         user = self.getCurrentUser()
         items = [Item().load(id=id, user=user, level=AccessType.READ) for id in ids]
-        self._itemListAction(action, items, user)
-        return len(items)
+        return self._itemListAction(action, items, user)
 
     def _itemListAction(self, action, items, user):
-        actionfunc, actionargs, actname, pp = self._actionForItem(items[0], user, action)
-        with ItemActionLock:
-            ItemActionList.extend(items)
-        try:
-            with ProgressContext(
-                True, user=user, title='%s items' % pp.capitalize(),
-                message='%s %s' % (pp.capitalize(), items[0]['name']),
-                total=len(items), current=0,
-            ) as ctx:
-                try:
-                    for idx, item in enumerate(items):
-                        actionfunc, actionargs, actname, pp = self._actionForItem(
-                            item, user, action)
-                        ctx.update(
-                            message='%s %s' % (pp.capitalize(), item['name']),
-                            total=len(items), current=idx)
-                        try:
-                            actionfunc(*actionargs)
-                        except Exception:
-                            logger.exception('Failed to %s item' % actname)
-                            ctx.update('Error %s %s' % (pp, item['name']))
-                            raise
-                    ctx.update(message='Done %s' % pp, total=len(items), current=len(items))
-                except Exception:
-                    pass
-        finally:
-            with ItemActionLock:
-                for item in items:
-                    ItemActionList.remove(item)
+        if not len(items):
+            return {'action': action, 'count': 0}
+        job = batch_process_job(action, items, user)
+        return {'action': action, 'count': len(items), 'jobId': job['_id']}
 
     @autoDescribeRoute(
-        Description('Perform an action on a folder of items.')
+        Description('Perform an action on a folder of items in a background job.')
+        .notes('Returns an object with the action, the number of items (count), '
+               'and, if there are any items, the id of the background job (jobId).  '
+               'The status of each item is logged in the job.')
         .modelParam('id', 'The folder ID', model=Folder, level=AccessType.READ)
         .param('action', 'Action to perform on the item.  One of process, '
                'reject, quarantine, unquarantine, finish, ocr.', paramType='path',
@@ -768,7 +909,6 @@ class WSIDeIDResource(Resource):
     )
     @access.user
     def folderAction(self, folder, action, limit=None, recurse=False):
-        setResponseTimeLimit(86400)
         user = self.getCurrentUser()
         text = '_recurse_:' if recurse else None
         filters = {'largeImage.fileId': {'$exists': True}}
@@ -777,8 +917,7 @@ class WSIDeIDResource(Resource):
         items = list(self._item_find(
             folder['_id'], text=text, name=None, limit=limit, offset=0,
             sort=sort, filters=filters))
-        self._itemListAction(action, items, user)
-        return len(items)
+        return self._itemListAction(action, items, user)
 
     @autoDescribeRoute(
         Description('Get the list of known and allowed image names for refiling.')
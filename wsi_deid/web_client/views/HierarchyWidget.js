@@ -40,7 +40,9 @@ function performAction(action) {
         export: { done: 'Recent export task completed.', fail: 'Failed to export recent items.  Check export file location for disk drive space or other system issues.' },
         exportall: { done: 'Export all task completed.', fail: 'Failed to export all items.  Check export file location for disk drive space or other system issues.' },
         exportreport: { done: 'Report task completed.', fail: 'Failed to generate report.' },
-        ocrall: { done: 'Started background job to find label text on WSIs in this folder.', fail: 'Failed to start background task to find label text for images.' }
+        ocrall: { done: 'Started background job to find label text on WSIs in this folder.', fail: 'Failed to start background task to find label text for images.' },
+        'list/process': { done: 'Started background job to redact checked items.', fail: 'Failed to start background job to redact checked items.' },
+        'list/finish': { done: 'Started background job to approve checked items.', fail: 'Failed to start background job to approve checked items.' }
     };
 
     const data = {};
@@ -137,6 +139,11 @@ function performAction(action) {
                 text = 'No new items without existing label text metadata.';
             }
         }
+        if (action.startsWith('list/') && resp && resp.jobId) {
+            events.once('g:alert', () => {
+                $('#g-alerts-container:last div.alert:last').append($('<span> </span>')).append($('<a/>').text('Track its progress here.').attr('href', `/#job/${resp.jobId}`));
+            }, this);
+        }
         if (resp.reportItemId) {
             events.once('g:alert', () => {
                 $('#g-alerts-container:last div.alert:last').append($('<span> </span>')).append($('<a/>').text('See the Excel report for more details.').attr('href', `/#item/${resp.reportItemId}`));